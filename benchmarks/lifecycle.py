@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Benchmark of the release lifecycle against a local stand-in host.
+
+A synthetic git repository of configurable size is created in a temporary
+directory along with a project layout as expected by :py:mod:`fabliip.releases`
+and fake ``drush``, ``mysql``, ``mysqldump`` and ``pg_dump`` executables. The
+release lifecycle, the Drupal modules synchronization and the database
+dump/restore are then run through :py:class:`fabliip.testing.LocalHost` and the
+wall time, number of remote commands and bytes moved are reported for each
+step.
+
+Usage::
+
+    python benchmarks/lifecycle.py --files 2000 --file-size 4096 --json out.json
+
+Comparing two runs is then a matter of diffing the JSON files.
+"""
+import argparse
+import binascii
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from fabric import api  # noqa
+from fabric.context_managers import hide  # noqa
+
+from fabliip import drupal, releases  # noqa
+from fabliip.database import mysql, pgsql  # noqa
+from fabliip.testing import LocalHost  # noqa
+
+
+FAKE_DRUSH = r"""#!/bin/sh
+# Fake drush: pm-list returns the modules listed in $FAKE_DRUSH_ROOT
+# php-script reports every operation of the session script as successful
+case "$*" in
+    *"pm-list --status=enabled"*) cat "$FAKE_DRUSH_ROOT/enabled" ;;
+    *"pm-list"*) cat "$FAKE_DRUSH_ROOT/disabled" ;;
+    *"php-script"*)
+        eval script=\${$#}
+        sed -n "s/^  array('\([a-z_]*\)', function.*/FABLIIP_RESULT\
+ {\"operation\": \"\1\", \"success\": true, \"result\": null}/p" "$script"
+        ;;
+esac
+"""
+
+FAKE_MYSQLDUMP = """#!/bin/sh
+head -c {size} /dev/zero | tr '\\0' 'x'
+"""
+
+FAKE_PG_DUMP = FAKE_MYSQLDUMP
+
+FAKE_MYSQL = """#!/bin/sh
+cat > /dev/null
+"""
+
+
+def write_executable(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, 0o755)
+
+
+def git(repository, *args):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(('git', '-C', repository) + args,
+                              stdout=devnull, stderr=devnull)
+
+
+def create_repository(path, files, file_size, directories, tags):
+    """
+    Create a git repository with ``files`` files of ``file_size`` bytes spread
+    in ``directories`` directories and commit them once per tag, modifying a
+    tenth of the files between each tag.
+    """
+    os.makedirs(path)
+    git(path, 'init', '-q')
+    git(path, 'config', 'user.email', 'benchmark@example.com')
+    git(path, 'config', 'user.name', 'Benchmark')
+
+    for tag_number, tag in enumerate(tags):
+        for i in range(files):
+            if tag_number > 0 and i % 10 != 0:
+                continue
+
+            directory = os.path.join(path, 'dir%d' % (i % directories))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            with open(os.path.join(directory, 'file%d.txt' % i), 'wb') as f:
+                f.write(binascii.hexlify(os.urandom(file_size // 2)))
+
+        git(path, 'add', '-A')
+        git(path, 'commit', '-q', '-m', 'Release %s' % tag)
+        git(path, 'tag', tag)
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+
+    return size
+
+
+def setup_project(root, options):
+    """
+    Create the project layout and the fake executables and set the
+    corresponding Fabric env variables.
+    """
+    tags = ['1.0.%d' % i for i in range(options.releases)]
+
+    source = os.path.join(root, 'source')
+    create_repository(source, options.files, options.file_size,
+                      options.directories, tags)
+
+    project_root = os.path.join(root, 'project')
+    repository_root = os.path.join(project_root, 'repository.git')
+    subprocess.check_call(['git', 'clone', '-q', '--bare', source,
+                           repository_root])
+
+    for directory in ('releases', 'shared/media', 'backups', 'bin', 'drush'):
+        os.makedirs(os.path.join(project_root, directory))
+
+    modules = ['module%d' % i for i in range(options.modules)]
+    with open(os.path.join(project_root, 'modules.enabled'), 'w') as f:
+        f.write('\n'.join(modules[::2]))
+    with open(os.path.join(project_root, 'modules.disabled'), 'w') as f:
+        f.write('\n'.join(modules[1::2]))
+    with open(os.path.join(project_root, 'drush', 'enabled'), 'w') as f:
+        f.write('\n'.join(modules[1::2]))
+    with open(os.path.join(project_root, 'drush', 'disabled'), 'w') as f:
+        f.write('\n'.join(modules[::2]))
+
+    bin_dir = os.path.join(project_root, 'bin')
+    write_executable(os.path.join(bin_dir, 'drush'), FAKE_DRUSH)
+    write_executable(os.path.join(bin_dir, 'mysqldump'),
+                     FAKE_MYSQLDUMP.format(size=options.database_size))
+    write_executable(os.path.join(bin_dir, 'pg_dump'),
+                     FAKE_PG_DUMP.format(size=options.database_size))
+    write_executable(os.path.join(bin_dir, 'mysql'), FAKE_MYSQL)
+
+    api.env.project_root = project_root
+    api.env.drupal_root = project_root
+    api.env.releases_root = os.path.join(project_root, 'releases')
+    api.env.repository_root = repository_root
+    api.env.shared_root = os.path.join(project_root, 'shared')
+    api.env.shared_files = {'media': 'media'}
+
+    if options.release_cache:
+        api.env.release_cache_root = os.path.join(project_root,
+                                                  'release_cache')
+
+    os.environ['FAKE_DRUSH_ROOT'] = os.path.join(project_root, 'drush')
+
+    return tags, bin_dir
+
+
+def get_steps(tags, options):
+    """
+    Return the list of ``(name, callable)`` steps to benchmark.
+    """
+    steps = []
+
+    for i, tag in enumerate(tags):
+        release_name = '2014083018%04d_%s' % (i, tag)
+
+        steps.extend([
+            ('create_release', lambda t=tag, r=release_name:
+                releases.create_release(t, r)),
+            ('link_shared_files', lambda r=release_name:
+                releases.link_shared_files(r)),
+            ('activate_release', lambda r=release_name:
+                releases.activate_release(r)),
+        ])
+
+    if options.release_cache:
+        # Redeploy the first tag, which is in the cache by now, under a name
+        # that sorts first so that it's removed by clean_old_releases
+        steps.append(('create_release (cached)', lambda: releases.create_release(
+            tags[0], '2014083017%04d_%s' % (0, tags[0]))))
+
+    steps.extend([
+        ('clean_old_releases', lambda: releases.clean_old_releases(
+            keep=options.keep)),
+        # Invalidates the release it rolls back from
+        ('rollback', releases.rollback),
+        ('enable_disable_modules', drupal.enable_disable_modules),
+        ('mysql.dump', lambda: mysql.dump(
+            os.path.join(api.env.project_root, 'backups', 'db.sql'), 'db',
+            password='')),
+        ('mysql.restore', lambda: mysql.restore(
+            os.path.join(api.env.project_root, 'backups', 'db.sql'), 'db',
+            password='')),
+        ('pgsql.dump', lambda: pgsql.dump(
+            os.path.join(api.env.project_root, 'backups', 'db.pgdump'), 'db',
+            host='localhost', password='')),
+    ])
+
+    return steps
+
+
+def run_benchmark(options):
+    root = tempfile.mkdtemp(prefix='fabliip-benchmark-')
+    results = []
+
+    try:
+        tags, bin_dir = setup_project(root, options)
+        steps = get_steps(tags, options)
+
+        with hide('everything'), LocalHost(path=[bin_dir]) as host:
+            for name, step in steps:
+                host.reset()
+                size_before = directory_size(api.env.project_root)
+                start = time.time()
+                step()
+                wall_time = time.time() - start
+                stats = host.stats()
+
+                results.append({
+                    'step': name,
+                    'wall_time': wall_time,
+                    'commands': stats['commands'],
+                    'bytes_sent': stats['bytes_sent'],
+                    'bytes_received': stats['bytes_received'],
+                    'bytes_written': (directory_size(api.env.project_root)
+                                      - size_before),
+                })
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        'parameters': vars(options),
+        'steps': results,
+        'total': {
+            'wall_time': sum(r['wall_time'] for r in results),
+            'commands': sum(r['commands'] for r in results),
+        },
+    }
+
+
+def print_report(report):
+    line = '{step:<25} {wall_time:>10} {commands:>9} {bytes_sent:>11}'\
+           ' {bytes_received:>15} {bytes_written:>14}'
+    print(line.format(step='step', wall_time='time (s)', commands='commands',
+                      bytes_sent='bytes sent', bytes_received='bytes received',
+                      bytes_written='bytes written'))
+
+    for result in report['steps']:
+        formatted = dict(result, wall_time='%.3f' % result['wall_time'])
+        print(line.format(**formatted))
+
+    print('Total: {wall_time:.3f}s, {commands} commands'.format(
+        **report['total']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=1000,
+                        help='Number of files in the synthetic repository')
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help='Size of each file in bytes')
+    parser.add_argument('--directories', type=int, default=20,
+                        help='Number of directories to spread the files in')
+    parser.add_argument('--releases', type=int, default=3,
+                        help='Number of releases to create')
+    parser.add_argument('--keep', type=int, default=2,
+                        help='Number of releases kept by clean_old_releases')
+    parser.add_argument('--modules', type=int, default=50,
+                        help='Number of Drupal modules')
+    parser.add_argument('--database-size', type=int, default=10 * 1024 * 1024,
+                        help='Size of the fake database dumps in bytes')
+    parser.add_argument('--release-cache', action='store_true',
+                        help='Enable the release tree cache')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results as JSON to the given file')
+    options = parser.parse_args()
+
+    report = run_benchmark(options)
+    print_report(report)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
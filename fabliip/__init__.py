@@ -1,2 +1,8 @@
+import os
+
 __version_tuple__ = (0, 3, 9)
 __version__ = '.'.join(map(str, __version_tuple__))
+
+if os.environ.get('FABLIIP_PROFILE_STARTUP'):
+    from . import profiling
+    profiling.enable()
@@ -0,0 +1,78 @@
+import base64
+import fnmatch
+import re
+
+
+SNAPSHOT_SEPARATOR = '__snap_'
+MAX_DATABASE_NAME_LENGTH = 63
+
+
+def has_data(table, include_data=None, exclude_data=None):
+    """
+    Return True if the data of the given table should be part of a dump.
+
+    Arguments:
+        table -- The name of the table
+        include_data -- List of shell-style patterns (eg. ``cache_*``) of the
+        tables to dump the data of, or None to dump the data of all tables
+        exclude_data -- List of shell-style patterns of the tables to only dump
+        the schema of. Takes precedence over ``include_data``.
+    """
+    def matches(patterns):
+        return any(fnmatch.fnmatchcase(table, pattern) for pattern in patterns)
+
+    return ((include_data is None or matches(include_data))
+            and not matches(exclude_data or []))
+
+
+def print_table_sizes(table_sizes, include_data=None, exclude_data=None):
+    """
+    Print the given list of ``(table, size)`` tuples, marking the tables whose
+    data is excluded by the given patterns (see :py:func:`has_data`).
+    """
+    for table, size in table_sizes:
+        print("{size:>12} {table}{excluded}".format(
+            size=size, table=table,
+            excluded='' if has_data(table, include_data, exclude_data)
+            else ' (schema only)'
+        ))
+
+
+def get_snapshot_name(database_name, release_name):
+    """
+    Return the name of the snapshot of the given database for the given
+    release, eg. ``mydb__snap_20140830180015_1_2_3``.
+    """
+    snapshot_name = '{database_name}{separator}{release_name}'.format(
+        database_name=database_name,
+        separator=SNAPSHOT_SEPARATOR,
+        release_name=re.sub(r'\W', '_', release_name),
+    )
+
+    if len(snapshot_name) > MAX_DATABASE_NAME_LENGTH:
+        raise ValueError("The snapshot name {name} is longer than {length}"
+                         " characters".format(name=snapshot_name,
+                                              length=MAX_DATABASE_NAME_LENGTH))
+
+    return snapshot_name
+
+
+def filter_snapshots(database_name, databases):
+    """
+    Return the sorted list of the snapshots of the given database among the
+    given database names (oldest to newest if the releases are named after
+    their date).
+    """
+    prefix = database_name + SNAPSHOT_SEPARATOR
+
+    return sorted(name for name in databases if name.startswith(prefix))
+
+
+def pipe_sql(sql):
+    """
+    Return a shell command writing the given SQL statements to stdout, to be
+    piped to a database client without having to escape them.
+    """
+    return 'echo {sql} | base64 -d'.format(
+        sql=base64.b64encode(sql.encode('utf-8')).decode('ascii')
+    )
@@ -1,27 +1,357 @@
-from getpass import getpass
+import json
 
 from fabric import api
 
+from . import (filter_snapshots, get_snapshot_name, has_data, pipe_sql,
+               print_table_sizes)
+from .. import metrics, preflight
+from ..releases import determine_release_name
+from ..utils import run_python
+
 DEFAULT_HOST = '127.0.0.1'
+DEFAULT_JOBS = 4
+
+
+PARALLEL_DUMP_SCRIPT = """
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+directory, database, jobs, tables, schema_only_tables = sys.argv[1:6]
+connection = sys.argv[6:]
+tables = json.loads(tables)
+schema_only_tables = json.loads(schema_only_tables)
+
+TABLE_MARKER = re.compile(br'^-- Table structure for table `(.+)`$')
+FOOTER_MARKER = b'/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;'
+
+if not os.path.isdir(directory):
+    os.makedirs(directory)
+
+# Spread the tables over the workers so that they dump about the same amount
+# of data
+chunks = [[] for i in range(max(1, min(int(jobs), len(tables))))]
+chunk_sizes = [0] * len(chunks)
+for table, size in sorted(tables, key=lambda table: -table[1]):
+    smallest = chunk_sizes.index(min(chunk_sizes))
+    chunks[smallest].append(table)
+    chunk_sizes[smallest] += size
+
+
+def mysqldump(tables, path, *options):
+    with open(path, 'wb') as f:
+        return subprocess.Popen(['mysqldump'] + list(options) + connection
+                                + [database] + tables, stdout=f)
+
+
+def has_snapshot(process, path):
+    # mysqldump starts its transaction before it dumps the first table
+    if process.poll() is not None:
+        return True
+
+    with open(path, 'rb') as f:
+        return b'\\n-- Table structure for table `' in f.read(1048576)
+
+
+# Hold a global read lock while the workers start their transactions so that
+# they all see the same snapshot
+lock = subprocess.Popen(['mysql', '-n', '-N', '-B'] + connection + [database],
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+lock.stdin.write(b"FLUSH TABLES WITH READ LOCK; SELECT 'locked';\\n")
+lock.stdin.flush()
+if lock.stdout.readline().strip() != b'locked':
+    sys.exit("Couldn't lock the tables of " + database)
+
+lock_start = time.time()
+workers = []
+for i, chunk in enumerate(chunk for chunk in chunks if chunk):
+    path = os.path.join(directory, '.chunk%d.sql' % i)
+    workers.append((mysqldump(chunk, path, '--single-transaction'), path, True))
+
+while not all(has_snapshot(process, path) for process, path, data in workers):
+    time.sleep(0.01)
+
+lock.stdin.write(b'UNLOCK TABLES;\\n')
+lock.stdin.close()
+lock.wait()
+lock_time = time.time() - lock_start
+
+if schema_only_tables:
+    path = os.path.join(directory, '.schema.sql')
+    workers.append((mysqldump(schema_only_tables, path, '--no-data'), path,
+                    False))
+
+if any(process.wait() != 0 for process, path, data in workers):
+    sys.exit('mysqldump failed')
+
+# Split the output of each worker in one file per table, keeping the header
+# and footer setting the session variables apart
+manifest = {'database': database, 'tables': [], 'header': 'header.sql',
+            'footer': 'footer.sql', 'lock_time': lock_time}
+
+for process, path, data in workers:
+    header, footer, output = [], [], None
+
+    with open(path, 'rb') as f:
+        for line in f:
+            match = TABLE_MARKER.match(line.rstrip(b'\\n'))
+            if match:
+                if output is not None:
+                    output.close()
+                name = match.group(1).decode('utf-8')
+                output = open(os.path.join(directory, name + '.sql'), 'wb')
+                manifest['tables'].append({'name': name, 'file': name + '.sql',
+                                           'data': data})
+            elif line.startswith(FOOTER_MARKER) or footer:
+                footer.append(line)
+                continue
+            elif output is None:
+                header.append(line)
+                continue
+
+            output.write(line)
+
+    if output is not None:
+        output.close()
+    os.remove(path)
+
+    for name, lines in (('header.sql', header), ('footer.sql', footer)):
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.writelines(lines)
+
+for table in manifest['tables']:
+    table['size'] = os.path.getsize(os.path.join(directory, table['file']))
+
+with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+print(json.dumps({
+    'tables': len(manifest['tables']),
+    'bytes': sum(table['size'] for table in manifest['tables']),
+    'lock_time': lock_time,
+}))
+"""
+
+
+PARALLEL_RESTORE_SCRIPT = """
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+directory, database, jobs = sys.argv[1:4]
+connection = sys.argv[4:]
+
+with open(os.path.join(directory, 'manifest.json')) as f:
+    manifest = json.load(f)
+
+with open(os.path.join(directory, manifest['header']), 'rb') as f:
+    header = f.read()
+with open(os.path.join(directory, manifest['footer']), 'rb') as f:
+    footer = f.read()
+
+SECONDARY_KEY = re.compile(br'^\\s+(UNIQUE |FULLTEXT |SPATIAL )?KEY ')
+FOREIGN_KEY = re.compile(br'^\\s+CONSTRAINT ')
+
+index_statements = []
+errors = []
+
+
+def mysql(write):
+    # Return whether the statements written by the given function were run
+    process = subprocess.Popen(['mysql'] + connection + [database],
+                               stdin=subprocess.PIPE)
+
+    # mysql stops reading at the first failing statement, in which case the
+    # pipe is broken
+    try:
+        write(process.stdin)
+        succeeded = True
+    except IOError:
+        succeeded = False
+
+    try:
+        process.stdin.close()
+    except IOError:
+        succeeded = False
+
+    return process.wait() == 0 and succeeded
+
 
+def write_table(table, stdin):
+    stdin.write(header)
 
-def dump(backup_path, database_name, user='root', host=None, password=None):
+    with open(os.path.join(directory, table['file']), 'rb') as f:
+        line = f.readline()
+        while line and not line.startswith(b'CREATE TABLE '):
+            stdin.write(line)
+            line = f.readline()
+
+        definitions = []
+        while line and not line.startswith(b')'):
+            definitions.append(line)
+            line = f.readline()
+
+        # Create the secondary indexes once the data is loaded, unless a
+        # foreign key relies on them
+        keys = [key for key in definitions if SECONDARY_KEY.match(key)]
+        if (table['data'] and keys
+                and not any(FOREIGN_KEY.match(key) for key in definitions)):
+            definitions = [key for key in definitions if key not in keys]
+            definitions[-1] = definitions[-1].rstrip().rstrip(b',') + b'\\n'
+            index_statements.append(b'ALTER TABLE `' + table['name'].encode('utf-8')
+                                    + b'` ' + b', '.join(
+                                        b'ADD ' + key.strip().rstrip(b',')
+                                        for key in keys) + b';\\n')
+
+        stdin.writelines(definitions)
+        stdin.write(line)
+        shutil.copyfileobj(f, stdin, 1048576)
+
+    stdin.write(footer)
+
+
+def load(table):
+    if not mysql(lambda stdin: write_table(table, stdin)):
+        errors.append(table['name'])
+
+
+def create_indexes(statement):
+    if not mysql(lambda stdin: stdin.write(statement)):
+        errors.append(statement.decode('utf-8').strip())
+
+
+def run_parallel(function, items):
+    items_queue = queue.Queue()
+    for item in items:
+        items_queue.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = items_queue.get_nowait()
+            except queue.Empty:
+                return
+            function(item)
+
+    threads = [threading.Thread(target=worker) for i in range(int(jobs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+run_parallel(load, sorted(manifest['tables'], key=lambda table: -table['size']))
+run_parallel(create_indexes, list(index_statements))
+
+if errors:
+    sys.exit('Restore failed for ' + ', '.join(errors))
+
+print(json.dumps({
+    'tables': len(manifest['tables']),
+    'deferred_indexes': len(index_statements),
+}))
+"""
+
+
+# Generates the statements adding the foreign keys of the current database to
+# the snapshot, the references to the tables of the current database being
+# replaced by references to the snapshot
+FOREIGN_KEYS_SQL = """
+SELECT CONCAT(
+    'ALTER TABLE `', kcu.table_name, '` ADD CONSTRAINT `', kcu.constraint_name,
+    '` FOREIGN KEY (', GROUP_CONCAT(CONCAT('`', kcu.column_name, '`')
+                                    ORDER BY kcu.ordinal_position),
+    ') REFERENCES `', IF(kcu.referenced_table_schema = DATABASE(),
+                         '{snapshot}', kcu.referenced_table_schema),
+    '`.`', kcu.referenced_table_name, '` (',
+    GROUP_CONCAT(CONCAT('`', kcu.referenced_column_name, '`')
+                 ORDER BY kcu.ordinal_position),
+    ') ON DELETE ', rc.delete_rule, ' ON UPDATE ', rc.update_rule, ';'
+)
+FROM information_schema.key_column_usage kcu
+JOIN information_schema.referential_constraints rc
+    ON rc.constraint_schema = kcu.constraint_schema
+    AND rc.table_name = kcu.table_name
+    AND rc.constraint_name = kcu.constraint_name
+WHERE kcu.table_schema = DATABASE() AND kcu.referenced_table_name IS NOT NULL
+GROUP BY kcu.table_name, kcu.constraint_name, kcu.referenced_table_schema,
+    kcu.referenced_table_name, rc.delete_rule, rc.update_rule
+"""
+
+
+def dump(backup_path, database_name, user='root', host=None, password=None,
+         include_data=None, exclude_data=None, report_sizes=False):
     """
     Backup MySQL database as a MySQL archive.
     If host is set to None, 127.0.0.1 will be used.
     If password is set to None, a prompt will ask a password.
+
+    The ``include_data`` and ``exclude_data`` arguments are lists of
+    shell-style patterns (eg. ``cache_*``) of the tables to dump the data of.
+    Excluded tables are dumped without their data, see
+    :py:func:`fabliip.database.has_data`. If ``report_sizes`` is True, the size
+    of each table is printed before the dump.
     """
     if host is None:
         host = DEFAULT_HOST
 
-    api.run('mysqldump {database_name} -h{host} -u{user} {password_param} > {backup_path}'
-            .format(
-                database_name=database_name,
-                host=host,
-                user=user,
-                password_param=get_password_param(user, password),
-                backup_path=backup_path,
-            ))
+    password_param = get_password_param(user, password)
+
+    if report_sizes:
+        print_table_sizes(
+            get_table_sizes(database_name, user, host,
+                            password_param=password_param),
+            include_data, exclude_data
+        )
+
+    dump_command = 'mysqldump {database_name} -h{host} -u{user} {password_param}'.format(
+        database_name=database_name,
+        host=host,
+        user=user,
+        password_param=password_param,
+    )
+
+    if include_data is None and exclude_data is None:
+        schema_only_tables = []
+    else:
+        schema_only_tables = [
+            table for table in get_tables(database_name, user, host,
+                                          password_param=password_param)
+            if not has_data(table, include_data, exclude_data)
+        ]
+
+    if schema_only_tables:
+        api.run('{{ {dump_command} {ignore_tables} && {dump_command} --no-data {tables}; }} > {backup_path}'
+                .format(
+                    dump_command=dump_command,
+                    ignore_tables=' '.join(
+                        '--ignore-table={database_name}.{table}'.format(
+                            database_name=database_name, table=table
+                        ) for table in schema_only_tables
+                    ),
+                    tables=' '.join(schema_only_tables),
+                    backup_path=backup_path,
+                ))
+    else:
+        api.run('{dump_command} > {backup_path}'.format(
+            dump_command=dump_command, backup_path=backup_path
+        ))
+
+    if metrics.is_enabled():
+        metrics.observe_file_size('fabliip_dump_size_bytes', backup_path,
+                                  database=database_name, engine='mysql')
 
 
 def restore(backup_path, database_name, user='root', host=None, password=None):
@@ -43,12 +373,324 @@ def restore(backup_path, database_name, user='root', host=None, password=None):
             ))
 
 
+def dump_parallel(backup_path, database_name, user='root', host=None,
+                  password=None, jobs=None, include_data=None,
+                  exclude_data=None):
+    """
+    Backup MySQL database over ``jobs`` parallel connections to one file per
+    table in the ``backup_path`` directory, along with a ``manifest.json``
+    file listing them. Return a dictionary with the number of ``tables``
+    dumped, their size in ``bytes`` and the time in seconds the tables were
+    locked (``lock_time``).
+
+    All the connections share the same consistent snapshot: a global read
+    lock is held while the ``mysqldump`` processes start their transaction
+    (``--single-transaction``), which only blocks the writes for a moment but
+    means the snapshot is only consistent for the transactional (InnoDB)
+    tables. Only the tables and their triggers are dumped, not the views or
+    routines.
+
+    ``jobs`` defaults to the number of CPUs of the host if it's known (see
+    :py:mod:`fabliip.preflight`), 4 otherwise.
+
+    See :py:func:`dump` for the other arguments and :py:func:`restore_parallel`
+    to restore the backup.
+    """
+    if host is None:
+        host = DEFAULT_HOST
+
+    if jobs is None:
+        jobs = preflight.get_fact('cpus', DEFAULT_JOBS)
+
+    password_param = get_password_param(user, password)
+    table_sizes = get_table_sizes(database_name, user, host,
+                                  password_param=password_param)
+
+    with api.hide('commands'):
+        output = run_python(
+            PARALLEL_DUMP_SCRIPT, backup_path, database_name, jobs,
+            json.dumps([(table, size) for table, size in table_sizes
+                        if has_data(table, include_data, exclude_data)]),
+            json.dumps([table for table, size in table_sizes
+                        if not has_data(table, include_data, exclude_data)]),
+            *get_connection_args(user, host, password_param)
+        )
+
+    stats = json.loads(output.splitlines()[-1])
+    print("Dumped {tables} tables ({bytes} bytes), tables locked for"
+          " {lock_time:.2f}s".format(**stats))
+
+    if metrics.is_enabled():
+        metrics.observe_file_size('fabliip_dump_size_bytes', backup_path,
+                                  database=database_name, engine='mysql')
+
+    return stats
+
+
+def restore_parallel(backup_path, database_name, user='root', host=None,
+                     password=None, jobs=None):
+    """
+    Restore MySQL database from a backup made by :py:func:`dump_parallel`,
+    loading ``jobs`` tables at a time, biggest first. The secondary indexes of
+    the tables without foreign keys are created once their data is loaded.
+    Return a dictionary with the number of ``tables`` restored and of
+    ``deferred_indexes`` statements.
+
+    ``jobs`` defaults to the number of CPUs of the host if it's known (see
+    :py:mod:`fabliip.preflight`), 4 otherwise.
+    """
+    if host is None:
+        host = DEFAULT_HOST
+
+    if jobs is None:
+        jobs = preflight.get_fact('cpus', DEFAULT_JOBS)
+
+    with api.hide('commands'):
+        output = run_python(
+            PARALLEL_RESTORE_SCRIPT, backup_path, database_name, jobs,
+            *get_connection_args(user, host,
+                                 get_password_param(user, password))
+        )
+
+    return json.loads(output.splitlines()[-1])
+
+
+def query(sql, database_name, user='root', host=None, password=None,
+          password_param=None):
+    """
+    Run the given SQL statements and return their tab-separated output, without
+    column names.
+    If host is set to None, 127.0.0.1 will be used.
+    If password is set to None, a prompt will ask a password, unless
+    password_param (as returned by get_password_param) is given.
+    """
+    if host is None:
+        host = DEFAULT_HOST
+
+    if password_param is None:
+        password_param = get_password_param(user, password)
+
+    with api.hide('commands'):
+        return api.run('{pipe_sql} | mysql -h{host} -u{user} {password_param} -N -B {database_name}'
+                       .format(
+                           database_name=database_name,
+                           host=host,
+                           user=user,
+                           password_param=password_param,
+                           pipe_sql=pipe_sql(sql),
+                       ))
+
+
+def get_tables(database_name, user='root', host=None, password=None,
+               password_param=None):
+    """
+    Return the list of the base tables of the given database.
+    """
+    output = query("SELECT table_name FROM information_schema.tables"
+                   " WHERE table_schema = DATABASE()"
+                   " AND table_type = 'BASE TABLE'",
+                   database_name, user, host, password, password_param)
+
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def get_triggers(database_name, user='root', host=None, password=None,
+                 password_param=None):
+    """
+    Return the list of the triggers of the given database.
+    """
+    output = query("SELECT trigger_name FROM information_schema.triggers"
+                   " WHERE trigger_schema = DATABASE()",
+                   database_name, user, host, password, password_param)
+
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def check_no_triggers(database_name, user='root', host=None, password=None,
+                      password_param=None):
+    """
+    Raise an exception if the given database has triggers, which the snapshots
+    don't support.
+    """
+    triggers = get_triggers(database_name, user, host, password,
+                            password_param)
+
+    if triggers:
+        raise Exception("The database {database} has triggers ({triggers}),"
+                        " which snapshots don't support: they're not copied"
+                        " and would be dropped when restoring a snapshot. Use"
+                        " a dump instead".format(database=database_name,
+                                                 triggers=', '.join(triggers)))
+
+
+def get_table_sizes(database_name, user='root', host=None, password=None,
+                    password_param=None):
+    """
+    Return a list of ``(table, size)`` tuples of the base tables of the given
+    database, sorted by decreasing size (data and indexes, in bytes).
+    """
+    output = query("SELECT table_name, data_length + index_length"
+                   " FROM information_schema.tables"
+                   " WHERE table_schema = DATABASE()"
+                   " AND table_type = 'BASE TABLE'"
+                   " ORDER BY 2 DESC",
+                   database_name, user, host, password, password_param)
+
+    return [(table, int(size)) for table, size in
+            (line.split() for line in output.splitlines() if line.strip())]
+
+
+def create_snapshot(database_name, release_name=None, user='root',
+                    host=None, password=None, jobs=DEFAULT_JOBS):
+    """
+    Create a server-side copy of the given database as a rollback point for
+    the given release, copying its tables over ``jobs`` parallel connections.
+    This is much faster than a dump but only copies the tables (not the views
+    or routines), and the copy is only consistent if the database is not
+    written to in the meantime (eg. in maintenance mode). The foreign keys
+    are added to the copied tables once all of them are copied, pointing to the
+    copied tables. Return the name of the snapshot.
+
+    Databases with triggers are not supported and raise an exception.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+    """
+    if host is None:
+        host = DEFAULT_HOST
+
+    snapshot_name = get_snapshot_name(database_name,
+                                      determine_release_name(release_name))
+    password_param = get_password_param(user, password)
+    check_no_triggers(database_name, user, host,
+                      password_param=password_param)
+    tables = get_tables(database_name, user, host,
+                        password_param=password_param)
+
+    query('CREATE DATABASE `{snapshot}`'.format(snapshot=snapshot_name), '',
+          user, host, password_param=password_param)
+
+    api.run("printf '%s\\n' {tables} | xargs -P {jobs} -I{{}}"
+            " mysql -h{host} -u{user} {password_param} -e '"
+            "SET foreign_key_checks = 0;"
+            " CREATE TABLE `{snapshot}`.`{{}}` LIKE `{database}`.`{{}}`;"
+            " INSERT INTO `{snapshot}`.`{{}}` SELECT * FROM `{database}`.`{{}}`'"
+            .format(
+                tables=' '.join(tables),
+                jobs=jobs,
+                host=host,
+                user=user,
+                password_param=password_param,
+                snapshot=snapshot_name,
+                database=database_name,
+            ))
+
+    # CREATE TABLE ... LIKE doesn't copy the foreign keys, so generate the
+    # statements adding them from the source database and run them in the
+    # snapshot. The data is already there, so it isn't checked again
+    with api.hide('commands'):
+        api.run("{pipe_sql} | mysql -h{host} -u{user} {password_param} -N -B"
+                " {database} | mysql -h{host} -u{user} {password_param}"
+                " --init-command='SET foreign_key_checks = 0' {snapshot}"
+                .format(
+                    pipe_sql=pipe_sql(FOREIGN_KEYS_SQL.format(
+                        snapshot=snapshot_name)),
+                    host=host,
+                    user=user,
+                    password_param=password_param,
+                    snapshot=snapshot_name,
+                    database=database_name,
+                ))
+
+    return snapshot_name
+
+
+def get_snapshots(database_name, user='root', host=None, password=None,
+                  password_param=None):
+    """
+    Return the list of the snapshots of the given database, sorted by oldest
+    to newest.
+    """
+    return filter_snapshots(database_name, query(
+        'SHOW DATABASES', '', user, host, password, password_param
+    ).split())
+
+
+def prune_snapshots(database_name, keep=5, user='root', host=None,
+                    password=None):
+    """
+    Drop the old snapshots of the given database, keeping x snapshots defined
+    by the ``keep`` parameter.
+    """
+    password_param = get_password_param(user, password)
+    snapshots = get_snapshots(database_name, user, host,
+                              password_param=password_param)
+
+    if snapshots[:-keep]:
+        query(''.join('DROP DATABASE `{snapshot}`;'.format(snapshot=snapshot)
+                      for snapshot in snapshots[:-keep]),
+              '', user, host, password_param=password_param)
+
+
+def restore_snapshot(database_name, release_name=None, user='root', host=None,
+                     password=None):
+    """
+    Replace the tables of the given database by the ones of its snapshot for
+    the given release, in a single atomic ``RENAME TABLE`` statement. The
+    snapshot is dropped afterwards, so it can't be restored twice. Raise an
+    exception if the database has triggers, since they would be dropped along
+    with the replaced tables.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+    """
+    snapshot_name = get_snapshot_name(database_name,
+                                      determine_release_name(release_name))
+    old_name = database_name + '__old'
+    password_param = get_password_param(user, password)
+
+    check_no_triggers(database_name, user, host,
+                      password_param=password_param)
+
+    current_tables = get_tables(database_name, user, host,
+                                password_param=password_param)
+    snapshot_tables = get_tables(snapshot_name, user, host,
+                                 password_param=password_param)
+
+    renames = [
+        '`{database}`.`{table}` TO `{old}`.`{table}`'.format(
+            database=database_name, old=old_name, table=table
+        ) for table in current_tables
+    ] + [
+        '`{snapshot}`.`{table}` TO `{database}`.`{table}`'.format(
+            snapshot=snapshot_name, database=database_name, table=table
+        ) for table in snapshot_tables
+    ]
+
+    query("""
+        DROP DATABASE IF EXISTS `{old}`;
+        CREATE DATABASE `{old}`;
+        RENAME TABLE {renames};
+        DROP DATABASE `{old}`;
+        DROP DATABASE `{snapshot}`;
+    """.format(old=old_name, renames=', '.join(renames),
+               snapshot=snapshot_name),
+        '', user, host, password_param=password_param)
+
+
 def get_password_param(user, password):
     """
     Ask a password in the prompt
     """
     if password is None:
+        from getpass import getpass
         password = getpass('Enter database password for {user}: '
                            .format(user=user))
 
     return '-p{password}'.format(password=password) if password != '' else ''
+
+
+def get_connection_args(user, host, password_param):
+    """
+    Return the list of the connection arguments of the MySQL clients.
+    """
+    return (['-h{host}'.format(host=host), '-u{user}'.format(user=user)]
+            + ([password_param] if password_param else []))
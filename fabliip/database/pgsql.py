@@ -1,33 +1,215 @@
-from getpass import getpass
-
 from fabric import api
 
+from . import (filter_snapshots, get_snapshot_name, has_data, pipe_sql,
+               print_table_sizes)
+from .. import metrics
+from ..releases import determine_release_name
+
+MAINTENANCE_DATABASE = 'postgres'
+
 
 def dump(backup_path, database_name, user='postgres', host=None,
-         password=None):
+         password=None, include_data=None, exclude_data=None,
+         report_sizes=False):
     """
     Backs up the given database to the given file as a PostgreSQL archive. If
     host is set to None, a local connection will be used, so you'll need to be
     able to sudo to the given user. Otherwise, a standard password connection
     will be used and the user will be asked for a password.
+
+    The ``include_data`` and ``exclude_data`` arguments are lists of
+    shell-style patterns (eg. ``cache_*``) of the tables to dump the data of.
+    Excluded tables are dumped without their data, see
+    :py:func:`fabliip.database.has_data`. If ``report_sizes`` is True, the size
+    of each table is printed before the dump.
+    """
+    if host is not None and password is None:
+        from getpass import getpass
+        password = getpass('Enter database password for {user}: '
+                              .format(user=user))
+
+    if report_sizes:
+        print_table_sizes(
+            get_table_sizes(database_name, user, host, password),
+            include_data, exclude_data
+        )
+
+    if include_data is not None:
+        # pg_dump has no option to only include the data of some tables, so
+        # exclude the data of all the other tables
+        exclude_data = [
+            table for table in get_tables(database_name, user, host, password)
+            if not has_data(table, include_data, exclude_data)
+        ]
+
+    run_command('pg_dump -Fc {connection} {exclude_data} {database_name} > {backup_path}'
+        .format(
+            connection=get_connection_args(user, host),
+            exclude_data=' '.join(
+                "--exclude-table-data='{pattern}'".format(pattern=pattern)
+                for pattern in exclude_data or []
+            ),
+            database_name=database_name,
+            backup_path=backup_path,
+        ), user, host, password)
+
+    if metrics.is_enabled():
+        metrics.observe_file_size('fabliip_dump_size_bytes', backup_path,
+                                  database=database_name, engine='pgsql')
+
+
+def query(sql, database_name, user='postgres', host=None, password=None):
+    """
+    Run the given SQL statements and return their unaligned output (columns
+    separated by ``|``), without column names. See :py:func:`dump` for the connection arguments.
+    """
+    with api.hide('commands'):
+        return run_command('{pipe_sql} | psql {connection} -At -v ON_ERROR_STOP=1 {database_name}'
+                           .format(
+                               connection=get_connection_args(user, host),
+                               pipe_sql=pipe_sql(sql),
+                               database_name=database_name,
+                           ), user, host, password)
+
+
+def get_tables(database_name, user='postgres', host=None, password=None):
+    """
+    Return the list of the tables of the given database that are in the search
+    path (usually the ``public`` schema).
+    """
+    output = query("SELECT tablename FROM pg_tables"
+                   " WHERE schemaname = ANY (current_schemas(false))",
+                   database_name, user, host, password)
+
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
+def get_table_sizes(database_name, user='postgres', host=None, password=None):
+    """
+    Return a list of ``(table, size)`` tuples of the tables of the given
+    database that are in the search path, sorted by decreasing size (data,
+    indexes and toast, in bytes).
+    """
+    output = query("SELECT tablename,"
+                   " pg_total_relation_size(quote_ident(tablename))"
+                   " FROM pg_tables"
+                   " WHERE schemaname = ANY (current_schemas(false))"
+                   " ORDER BY 2 DESC",
+                   database_name, user, host, password)
+
+    return [(table, int(size)) for table, size in
+            (line.strip().split('|') for line in output.splitlines()
+             if line.strip())]
+
+
+def create_snapshot(database_name, release_name=None, user='postgres',
+                    host=None, password=None):
+    """
+    Create a server-side copy of the given database as a rollback point for
+    the given release, using the database as a template. This is much faster
+    than a dump but requires that no other session is connected to the
+    database while the snapshot is taken: new connections are refused during
+    the copy and the sessions connected to the database are terminated
+    (requires PostgreSQL 9.5). Return the name of the snapshot.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+    """
+    snapshot_name = get_snapshot_name(database_name,
+                                      determine_release_name(release_name))
+
+    query("""
+        ALTER DATABASE "{database}" ALLOW_CONNECTIONS false;
+        SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+        WHERE datname = '{database}' AND pid <> pg_backend_pid();
+    """.format(database=database_name), MAINTENANCE_DATABASE, user, host,
+        password)
+
+    try:
+        query('CREATE DATABASE "{snapshot}" TEMPLATE "{database}"'.format(
+            snapshot=snapshot_name, database=database_name
+        ), MAINTENANCE_DATABASE, user, host, password)
+    finally:
+        query('ALTER DATABASE "{database}" ALLOW_CONNECTIONS true'.format(
+            database=database_name
+        ), MAINTENANCE_DATABASE, user, host, password)
+
+    return snapshot_name
+
+
+def get_snapshots(database_name, user='postgres', host=None, password=None):
+    """
+    Return the list of the snapshots of the given database, sorted by oldest
+    to newest.
+    """
+    return filter_snapshots(database_name, query(
+        "SELECT datname FROM pg_database", MAINTENANCE_DATABASE, user, host,
+        password
+    ).split())
+
+
+def prune_snapshots(database_name, keep=5, user='postgres', host=None,
+                    password=None):
+    """
+    Drop the old snapshots of the given database, keeping x snapshots defined
+    by the ``keep`` parameter.
+    """
+    snapshots = get_snapshots(database_name, user, host, password)
+
+    if snapshots[:-keep]:
+        query(''.join('DROP DATABASE "{snapshot}";'.format(snapshot=snapshot)
+                      for snapshot in snapshots[:-keep]),
+              MAINTENANCE_DATABASE, user, host, password)
+
+
+def restore_snapshot(database_name, release_name=None, user='postgres',
+                     host=None, password=None):
+    """
+    Replace the given database by its snapshot for the given release. The
+    snapshot is renamed to the database name, so it can't be restored twice.
+    The sessions connected to the database are terminated.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+    """
+    snapshot_name = get_snapshot_name(database_name,
+                                      determine_release_name(release_name))
+    old_name = database_name + '__old'
+
+    query("""
+        SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+        WHERE datname = '{database}' AND pid <> pg_backend_pid();
+        ALTER DATABASE "{database}" RENAME TO "{old}";
+        ALTER DATABASE "{snapshot}" RENAME TO "{database}";
+        DROP DATABASE "{old}";
+    """.format(database=database_name, old=old_name, snapshot=snapshot_name),
+        MAINTENANCE_DATABASE, user, host, password)
+
+
+def get_connection_args(user='postgres', host=None):
+    """
+    Return the connection arguments of the PostgreSQL client commands run with
+    :py:func:`run_command`: none for a local connection, the user and host
+    otherwise.
+    """
+    if host is None:
+        return ''
+
+    return '-U {user} -h {host}'.format(user=user, host=host)
+
+
+def run_command(command, user='postgres', host=None, password=None):
+    """
+    Run the given PostgreSQL client command, which must include the arguments
+    returned by :py:func:`get_connection_args`. If host is set to None, the
+    command is run as the given system user with a local connection.
+    Otherwise, the given password is used (and asked if it's None).
     """
     if host is None:
-        api.sudo('pg_dump -Fc {database_name} > {backup_path}'
-                 .format(
-                     database_name=database_name,
-                     backup_path=backup_path,
-                 ), user=user)
-    else:
-        if password is None:
-            password = getpass('Enter database password for {user}: '
-                                  .format(user=user))
-
-        with api.shell_env(PGPASSWORD=password):
-            api.run('pg_dump -Fc -U {user} -h {host} {database_name} >'
-                    ' {backup_path}'
-                    .format(
-                        user=user,
-                        host=host,
-                        database_name=database_name,
-                        backup_path=backup_path,
-                    ))
+        return api.sudo(command, user=user)
+
+    if password is None:
+        from getpass import getpass
+        password = getpass('Enter database password for {user}: '
+                              .format(user=user))
+
+    with api.shell_env(PGPASSWORD=password):
+        return api.run(command)
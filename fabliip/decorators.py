@@ -1,8 +1,12 @@
+from collections import OrderedDict
 from functools import wraps
 
 from fabric import api
 
+from . import profiling
 
+
+@profiling.timed('multisite')
 def multisite(func):
     """
     Mark a task as being multisite.
@@ -71,22 +75,150 @@ def multisite(func):
         selected_environment = func.__name__
 
         if site is not None:
-            if site not in api.env.sites:
-                raise Exception(
-                    "Site {site} is not part of the possible sites ({sites})"
-                    .format(site=site, sites=api.env.sites.keys())
-                )
-
-            if selected_environment not in api.env.sites[site]:
-                raise Exception(
-                    "Site {site} has no {env} environment"
-                    .format(site=site, env=selected_environment)
-                )
-
-            for setting, value in api.env.sites[site][selected_environment].iteritems():
-                api.env[setting] = value
+            site_settings = get_site_settings(site, selected_environment)
 
-            api.env.site = site
+            for setting, value in site_settings.iteritems():
+                api.env[setting] = value
 
         return func(*args, **kwargs)
     return wrapper
+
+
+def get_site_settings(site, environment):
+    """
+    Return a copy of the settings of the given site for the given environment,
+    as defined in ``env.sites``, with the ``site`` key set to the site name.
+    """
+    if site not in api.env.sites:
+        raise Exception(
+            "Site {site} is not part of the possible sites ({sites})"
+            .format(site=site, sites=api.env.sites.keys())
+        )
+
+    if environment not in api.env.sites[site]:
+        raise Exception(
+            "Site {site} has no {env} environment"
+            .format(site=site, env=environment)
+        )
+
+    site_settings = dict(api.env.sites[site][environment])
+    site_settings['site'] = site
+
+    return site_settings
+
+
+def execute_multisite(task, environment, sites=None, shared_task=None,
+                      shared_key=('repository_root',), pool_size=None,
+                      args=(), kwargs=None):
+    """
+    Execute the given task for several sites of ``env.sites`` concurrently and
+    return a dictionary ``{site: {host: result}}``.
+
+    Each site runs in its own process with its settings for the given
+    environment applied on top of a copy of ``env`` (the global ``env`` is
+    left untouched). The hosts of a site are taken from its ``hosts`` setting,
+    or from ``env.hosts`` if it doesn't define any.
+
+    Work that is identical for sites sharing a host can be given as
+    ``shared_task``: it is executed once per host and distinct values of the
+    settings listed in ``shared_key``, before any site task is started. For
+    example to fetch the repository only once on hosts where several sites
+    share the same ``repository_root``::
+
+        def fetch():
+            git.update_remote_repository_root(tag)
+
+        def deploy_site():
+            releases.create_release(tag)
+            releases.activate_release()
+
+        execute_multisite(deploy_site, 'prod', shared_task=fetch)
+
+    Arguments:
+        task -- The callable to execute for each site
+        environment -- The environment to use (eg. prod)
+        sites -- The list of site names (default all the sites that have the
+        given environment)
+        shared_task -- Callable to execute once per group of sites sharing a
+        host and the same values for the ``shared_key`` settings
+        shared_key -- The settings that identify identical shared work
+        pool_size -- The maximum number of concurrent processes (default no
+        limit)
+        args, kwargs -- Arguments passed to ``task``
+    """
+    if sites is None:
+        sites = sorted(
+            site for site, environments in api.env.sites.iteritems()
+            if environment in environments
+        )
+
+    sites_settings = OrderedDict(
+        (site, get_site_settings(site, environment)) for site in sites
+    )
+
+    if shared_task is not None:
+        groups = OrderedDict()
+
+        for site_settings in sites_settings.itervalues():
+            for host in site_settings.get('hosts', api.env.hosts):
+                key = (host,) + tuple(site_settings.get(setting)
+                                      for setting in shared_key)
+                groups.setdefault(key, (site_settings, [host]))
+
+        _execute_concurrently(
+            shared_task,
+            OrderedDict(
+                (' '.join(str(part) for part in key), group)
+                for key, group in groups.iteritems()
+            ),
+            pool_size
+        )
+
+    return _execute_concurrently(
+        task,
+        OrderedDict(
+            (site, (site_settings, site_settings.get('hosts', api.env.hosts)))
+            for site, site_settings in sites_settings.iteritems()
+        ),
+        pool_size, args, kwargs
+    )
+
+
+def _execute_concurrently(task, jobs, pool_size=None, args=(), kwargs=None):
+    """
+    Run ``task`` for each ``{name: (settings, hosts)}`` item of ``jobs`` in a
+    separate process, with the given settings applied, and return a dictionary
+    ``{name: {host: result}}``. Aborts if any of the jobs failed.
+    """
+    import multiprocessing
+    from fabric.job_queue import JobQueue
+
+    kwargs = kwargs or {}
+    queue = multiprocessing.Queue()
+    job_queue = JobQueue(pool_size or len(jobs), queue)
+
+    for name, (settings, hosts) in jobs.iteritems():
+        def inner(name=name, settings=settings, hosts=hosts):
+            with api.settings(**settings):
+                queue.put({
+                    'name': name,
+                    'result': api.execute(task, hosts=hosts, *args, **kwargs),
+                })
+
+        process = multiprocessing.Process(target=inner)
+        process.name = name
+        job_queue.append(process)
+
+    job_queue.close()
+    results = job_queue.run()
+
+    failed = [name for name, result in results.iteritems()
+              if result['exit_code'] != 0]
+    if failed:
+        api.abort("Execution of {task} failed for {names}".format(
+            task=getattr(task, '__name__', task), names=', '.join(failed)
+        ))
+
+    return dict(
+        (name, result['results']) for name, result in results.iteritems()
+    )
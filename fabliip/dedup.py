@@ -0,0 +1,163 @@
+"""
+Deduplication of identical files across releases.
+
+Releases are usually near-identical copies of the same code tree. The
+:py:func:`deduplicate` function replaces the files that are identical across
+the releases of ``releases_root`` by reflinks on filesystems that support them
+(or by hardlinks if asked to) so they only use disk and page cache once.
+
+Files are first grouped by size and only the files sharing their size with
+another file are hashed. The hashes are persisted in an index file in the
+releases root along with the size, mtime and inode of each file, so that
+subsequent runs only hash new or modified files.
+
+Since hardlinked files share their contents, a file modified in place in one
+release is modified in all of them. The ``hardlink`` mode is thus never used
+unless it's explicitly asked for, through the ``dedup_mode`` env variable or
+the ``mode`` argument, and should only be if your releases are never modified
+in place after their creation. Without it, the deduplication is skipped on the
+hosts that aren't known to support reflinks.
+"""
+import json
+import os
+
+from fabric import api
+
+from . import preflight
+from .utils import run_python
+
+
+INDEX_FILE = '.dedup_index.json'
+MODES = ('hardlink', 'reflink')
+
+
+DEDUP_SCRIPT = """
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import sys
+
+root, index_path, mode = sys.argv[1:4]
+
+try:
+    with open(index_path) as f:
+        index = json.load(f)
+except (IOError, ValueError):
+    index = {}
+
+new_index = {}
+files_by_size = {}
+stats = {'files': 0, 'hashed': 0, 'linked': 0, 'bytes_reclaimed': 0}
+
+for dirpath, dirnames, filenames in os.walk(root):
+    for name in filenames:
+        path = os.path.join(dirpath, name)
+        st = os.lstat(path)
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0 and path != index_path:
+            stats['files'] += 1
+            files_by_size.setdefault(st.st_size, []).append((path, st))
+
+
+def get_hash(path, st):
+    key = [st.st_size, st.st_mtime, st.st_ino]
+    entry = index.get(path)
+
+    if entry is not None and entry[:3] == key:
+        digest = entry[3]
+    else:
+        stats['hashed'] += 1
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+
+    new_index[path] = key + [digest]
+    return digest
+
+
+for size, files in files_by_size.items():
+    if len(files) < 2:
+        continue
+
+    groups = {}
+    for path, st in files:
+        key = (get_hash(path, st), st.st_dev, st.st_mode, st.st_uid, st.st_gid)
+        groups.setdefault(key, []).append((path, st))
+
+    for group in groups.values():
+        source_path, source_st = group[0]
+
+        for path, st in group[1:]:
+            if st.st_ino == source_st.st_ino:
+                continue
+
+            tmp_path = path + '.dedup'
+            if mode == 'reflink':
+                subprocess.check_call(['cp', '--reflink=always', '-p',
+                                       source_path, tmp_path])
+            else:
+                os.link(source_path, tmp_path)
+            os.rename(tmp_path, path)
+
+            stats['linked'] += 1
+            if st.st_nlink == 1:
+                stats['bytes_reclaimed'] += size
+
+            new_st = os.lstat(path)
+            new_index[path] = [new_st.st_size, new_st.st_mtime,
+                               new_st.st_ino, new_index[path][3]]
+
+with open(index_path + '.tmp', 'w') as f:
+    json.dump(new_index, f)
+os.rename(index_path + '.tmp', index_path)
+
+print(json.dumps(stats))
+"""
+
+
+def deduplicate(root=None, mode=None):
+    """
+    Replace the files that are identical across the releases by hardlinks or
+    reflinks and return a dictionary with the number of files scanned, hashed
+    and linked and the number of bytes reclaimed, or None if the
+    deduplication was skipped.
+
+    Arguments:
+        root -- The directory to deduplicate (default ``releases_root`` env
+        variable)
+        mode -- Either ``hardlink`` or ``reflink`` (default ``dedup_mode`` env
+        variable, or ``reflink`` if the host is known to support it, see
+        :py:mod:`fabliip.preflight`). If no mode is given and reflinks are not
+        known to be supported, nothing is done
+    """
+    if root is None:
+        root = api.env.releases_root
+
+    if mode is None:
+        mode = api.env.get('dedup_mode') or (
+            'reflink' if preflight.get_fact('reflink') else None
+        )
+
+    if mode is None:
+        # Hardlinks share the contents of the files across releases, they're
+        # only used if explicitly asked for
+        print("Skipping deduplication, the host is not known to support"
+              " reflinks (set dedup_mode to hardlink to use hardlinks)")
+        return None
+
+    if mode not in MODES:
+        raise ValueError("Unknown deduplication mode {mode}, must be one of"
+                         " {modes}".format(mode=mode, modes=', '.join(MODES)))
+
+    with api.hide('commands'):
+        output = run_python(DEDUP_SCRIPT, root,
+                            os.path.join(root, INDEX_FILE), mode)
+
+    stats = json.loads(output.splitlines()[-1])
+    print("Deduplicated {linked} files out of {files}, {bytes_reclaimed} bytes"
+          " reclaimed".format(**stats))
+
+    return stats
@@ -7,11 +7,99 @@ directory of your Drupal project.
 
 This module requires `drush` to be installed on the remote server.
 """
+import base64
 from contextlib import nested
+import fnmatch
+import json
+import posixpath
 
 from fabric import api
 
 from fabliip.file import file_exists
+from fabliip.utils import iter_run_lines
+from fabliip.vcs.git import get_changed_files
+
+
+SESSION_RESULT_MARKER = 'FABLIIP_RESULT '
+
+# PHP code clearing each of the caches that can be cleared independently
+CACHE_CLEAR_OPERATIONS = {
+    'all': 'drupal_flush_all_caches();',
+    'theme-registry': 'drupal_theme_rebuild();',
+    'menu': 'menu_rebuild();',
+    'css-js': ('_drupal_flush_css_js(); drupal_clear_css_cache();'
+               ' drupal_clear_js_cache();'),
+    'views': "if (module_exists('views')) { views_invalidate_cache(); }",
+    'page-block': ("cache_clear_all('*', 'cache_page', TRUE);"
+                   " cache_clear_all('*', 'cache_block', TRUE);"),
+}
+
+# Patterns of the tables whose data is not worth dumping, see
+# get_dump_exclude_data_patterns
+DUMP_EXCLUDE_DATA_TABLES = (
+    'cache',
+    'cache_*',
+    'watchdog',
+    'sessions',
+    'search_*',
+    'flood',
+    'semaphore',
+)
+
+# Patterns of file names and the caches to clear when such a file changes, the
+# first matching pattern wins. Files that don't match any pattern require a
+# full cache clear. The files changing the rendered HTML also clear the page
+# and block caches, otherwise anonymous users keep getting the old pages until
+# they expire.
+CACHE_INVALIDATION_RULES = (
+    ('*.views_default.inc', ('views', 'page-block')),
+    ('*.views.inc', ('views', 'page-block')),
+    ('*.features.menu_*.inc', ('menu', 'page-block')),
+    ('*.tpl.php', ('theme-registry', 'page-block')),
+    ('template.php', ('theme-registry', 'page-block')),
+    ('*.css', ('css-js', 'page-block')),
+    ('*.js', ('css-js', 'page-block')),
+    ('*.scss', ()),
+    ('*.less', ()),
+    ('*.txt', ()),
+    ('*.md', ()),
+    ('*.png', ()),
+    ('*.jpg', ()),
+    ('*.gif', ()),
+    ('*.svg', ()),
+    ('*.ico', ()),
+    ('*.woff', ()),
+    ('*.ttf', ()),
+    ('*.eot', ()),
+    ('modules.*', ()),
+)
+
+SESSION_SCRIPT = """<?php
+$operations = array(
+%(operations)s
+);
+
+foreach ($operations as $operation) {
+  try {
+    $result = call_user_func($operation[1]);
+    $success = TRUE;
+  }
+  catch (Exception $e) {
+    $result = $e->getMessage();
+    $success = FALSE;
+  }
+
+  print '%(marker)s' . json_encode(array(
+    'operation' => $operation[0],
+    'success' => $success,
+    'result' => $result,
+  )) . PHP_EOL;
+
+  if (!$success) {
+    break;
+  }
+}
+"""
 
 
 def drush(command):
@@ -26,6 +114,156 @@ def drush(command):
     return output
 
 
+def iter_drush_lines(command):
+    """
+    Runs a drush command on the server and returns an iterator over the lines
+    of its output as they arrive.
+
+    Requires the `drupal_root` environment variable to be set.
+    """
+    with api.cd(api.env.drupal_root):
+        return iter_run_lines('drush -y {command}'.format(command=command))
+
+
+class DrushSession(object):
+    """
+    Queue of operations run inside a single Drupal bootstrap.
+
+    Running a drush command bootstraps Drupal every time, which takes a few
+    seconds on big sites. A session instead queues the operations and runs
+    them all at once in a generated PHP script executed with ``drush
+    php-script``::
+
+        with drupal.DrushSession() as session:
+            session.set_maintenance_mode(True)
+            session.enable_modules(['views', 'ctools'])
+            session.clear_cache()
+
+        print(session.results)
+
+    The operations are run in order and the execution stops at the first
+    failing operation, in which case :py:meth:`run` raises an exception.
+    :py:meth:`run` returns (and :py:attr:`results` holds) a list of
+    dictionaries with the ``operation`` name, its ``success`` and its
+    ``result`` (or error message), one per operation that was run.
+
+    Requires the `drupal_root` environment variable to be set.
+    """
+    def __init__(self):
+        self.operations = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, name, code):
+        """
+        Queue an operation. ``code`` is the body of a PHP function that runs
+        in the bootstrapped Drupal and whose return value (JSON serializable)
+        is the result of the operation.
+        """
+        self.operations.append((name, code))
+
+    def variable_set(self, name, value):
+        self.add('variable_set', 'variable_set({name}, {value});'.format(
+            name=php_value(name), value=php_value(value)
+        ))
+
+    def set_maintenance_mode(self, enabled):
+        self.variable_set('maintenance_mode', 1 if enabled else 0)
+
+    def enable_modules(self, modules):
+        self.add('enable_modules', """
+            if (!module_enable({modules})) {{
+              throw new Exception('Some dependencies are missing');
+            }}
+            return {modules};""".format(modules=php_value(list(modules))))
+
+    def disable_modules(self, modules):
+        self.add('disable_modules', """
+            module_disable({modules});
+            return {modules};""".format(modules=php_value(list(modules))))
+
+    def clear_cache(self, cache='all'):
+        """
+        Clear the given cache, one of the keys of
+        :py:data:`CACHE_CLEAR_OPERATIONS` (default all).
+        """
+        self.add('clear_cache', CACHE_CLEAR_OPERATIONS[cache])
+
+    def get_script(self):
+        """
+        Return the PHP script running the queued operations.
+        """
+        return SESSION_SCRIPT % {
+            'operations': ',\n'.join(
+                "  array('{name}', function () {{ {code} }})".format(
+                    name=name,
+                    code=' '.join(line.strip() for line in code.splitlines())
+                    .strip()
+                ) for name, code in self.operations
+            ),
+            'marker': SESSION_RESULT_MARKER,
+        }
+
+    def run(self):
+        """
+        Run the queued operations in a single drush bootstrap and return their
+        results. Raise an exception if an operation failed or if the session
+        stopped before running all of them.
+        """
+        self.results = []
+
+        if not self.operations:
+            return self.results
+
+        script = base64.b64encode(self.get_script().encode('utf-8'))
+
+        with api.cd(api.env.drupal_root):
+            output = api.run(
+                'script=$(mktemp --suffix=.php)'
+                ' && echo {script} | base64 -d > $script'
+                ' && drush -y php-script $script;'
+                ' status=$?; rm -f $script; exit $status'.format(
+                    script=script.decode('ascii')
+                )
+            )
+
+        for line in output.splitlines():
+            if line.startswith(SESSION_RESULT_MARKER):
+                self.results.append(
+                    json.loads(line[len(SESSION_RESULT_MARKER):])
+                )
+
+        if self.results and not self.results[-1]['success']:
+            raise Exception("Operation {operation} failed: {result}".format(
+                **self.results[-1]))
+
+        if len(self.results) < len(self.operations):
+            raise Exception("The drush session stopped after {done} of"
+                            " {total} operations".format(
+                                done=len(self.results),
+                                total=len(self.operations)))
+
+        self.operations = []
+
+        return self.results
+
+
+def php_value(value):
+    """
+    Return a PHP expression evaluating to the given JSON serializable value.
+    """
+    return "json_decode(base64_decode('{value}'), TRUE)".format(
+        value=base64.b64encode(json.dumps(value).encode('utf-8'))
+        .decode('ascii')
+    )
+
+
 def enable_disable_modules(site=None):
     """
     Enables and disables modules on the Drupal install to reflect the status of
@@ -34,10 +272,13 @@ def enable_disable_modules(site=None):
     The optional `site` parameter allows you to have a multisite project
     with a global modules.enabled/disabled file and a site-specific
     modules.site.enabled/disabled file.
+
+    Return True if any module was enabled or disabled, which can be passed as
+    the ``modules_changed`` argument of :py:func:`clear_changed_caches`.
     """
     with nested(api.cd(api.env.project_root), api.hide('commands')):
-        enabled_modules = set(api.run('cat modules.enabled').splitlines())
-        disabled_modules = set(api.run('cat modules.disabled').splitlines())
+        enabled_modules = set(iter_run_lines('cat modules.enabled'))
+        disabled_modules = set(iter_run_lines('cat modules.disabled'))
 
         if site is not None:
             site_enabled_modules_file = 'modules.%s.enabled' % site
@@ -50,10 +291,10 @@ def enable_disable_modules(site=None):
                                 " modules.{site}.disabled)".format(site=site))
 
             site_enabled_modules = set(
-                api.run('cat modules.%s.enabled' % site).splitlines()
+                iter_run_lines('cat modules.%s.enabled' % site)
             )
             site_disabled_modules = set(
-                api.run('cat modules.%s.disabled' % site).splitlines()
+                iter_run_lines('cat modules.%s.disabled' % site)
             )
 
             enabled_modules |= site_enabled_modules
@@ -62,37 +303,38 @@ def enable_disable_modules(site=None):
         enabled_modules -= disabled_modules
 
         current_enabled_modules = set(
-            drush('pm-list --status=enabled --pipe').splitlines()
+            iter_drush_lines('pm-list --status=enabled --pipe')
         )
 
         current_disabled_modules = set(
-            drush('pm-list --status="disabled,not installed" --pipe')
-            .splitlines()
+            iter_drush_lines('pm-list --status="disabled,not installed" --pipe')
         )
 
+    session = DrushSession()
+
     modules_to_enable = current_disabled_modules & enabled_modules
     if modules_to_enable:
         print("The following modules are being enabled: {modules}".format(
             modules=", ".join(modules_to_enable))
         )
+        session.enable_modules(modules_to_enable)
     else:
         print("No modules to enable")
 
-    for module in modules_to_enable:
-        drush('pm-enable %s' % module)
-        clear_cache()
-
     modules_to_disable = current_enabled_modules & disabled_modules
     if modules_to_disable:
         print("The following modules are being disabled: {modules}".format(
             modules=", ".join(modules_to_disable))
         )
+        session.disable_modules(modules_to_disable)
     else:
         print("No modules to disable")
 
-    for module in modules_to_disable:
-        drush('pm-disable %s' % module)
-        clear_cache()
+    if session.operations:
+        session.clear_cache()
+        session.run()
+
+    return bool(modules_to_enable or modules_to_disable)
 
 
 def set_maintenance_mode(enabled):
@@ -107,3 +349,95 @@ def clear_cache():
     Clears the Drupal cache.
     """
     drush('cc all')
+
+
+def plan_cache_clear(changed_paths, modules_changed=False):
+    """
+    Return the set of caches that need to be cleared after the given files
+    changed, according to :py:data:`CACHE_INVALIDATION_RULES`. The set only
+    contains ``all`` if a full cache clear is needed, which is the case if
+    ``modules_changed`` is True (ie. modules were enabled or disabled) or if
+    any of the files doesn't match a rule (eg. a ``.module`` or ``.info``
+    file).
+    """
+    if modules_changed:
+        return set(['all'])
+
+    caches = set()
+
+    for path in changed_paths:
+        filename = posixpath.basename(path)
+
+        for pattern, pattern_caches in CACHE_INVALIDATION_RULES:
+            if fnmatch.fnmatch(filename, pattern):
+                caches.update(pattern_caches)
+                break
+        else:
+            return set(['all'])
+
+    return caches
+
+
+def clear_caches(caches):
+    """
+    Clear the given caches in a single drush bootstrap, or run a full cache
+    clear if ``all`` is part of them.
+    """
+    if 'all' in caches:
+        clear_cache()
+        return
+
+    if not caches:
+        print("No caches to clear")
+        return
+
+    print("The following caches are being cleared: {caches}".format(
+        caches=", ".join(sorted(caches)))
+    )
+
+    with DrushSession() as session:
+        for cache in sorted(caches):
+            session.clear_cache(cache)
+
+
+def clear_changed_caches(first_commit, last_commit, modules_changed=False):
+    """
+    Clear only the caches affected by the files that changed between
+    first_commit and last_commit in the remote repository (see
+    :py:func:`plan_cache_clear`).
+
+    Requires the `repository_root` environment variable to be set.
+    """
+    clear_caches(plan_cache_clear(
+        get_changed_files(first_commit, last_commit, run_locally=False),
+        modules_changed
+    ))
+
+
+def get_database_settings():
+    """
+    Return the database settings of the Drupal site as a dictionary (driver,
+    database, username, prefix, etc).
+    """
+    with api.hide('commands', 'output'):
+        output = drush('sql-conf --format=json')
+
+    return json.loads(output)
+
+
+def get_dump_exclude_data_patterns():
+    """
+    Return the patterns of the tables whose data doesn't need to be part of a
+    backup (caches, logs, sessions, search index), taking the table prefix of
+    the site into account. The patterns can be passed as the ``exclude_data``
+    argument of the database ``dump`` functions::
+
+        mysql.dump(backup_path, database_name,
+                   exclude_data=drupal.get_dump_exclude_data_patterns())
+    """
+    prefix = get_database_settings().get('prefix') or ''
+
+    if isinstance(prefix, dict):
+        prefix = prefix.get('default', '')
+
+    return [prefix + table for table in DUMP_EXCLUDE_DATA_TABLES]
@@ -3,6 +3,8 @@ from contextlib import nested
 from fabric import api
 from fabric.context_managers import quiet
 
+from .utils import iter_run_lines
+
 
 def ls(path):
     """
@@ -18,6 +20,18 @@ def ls(path):
     return files_list
 
 
+def iter_ls(path):
+    """
+    Return an iterator over the files in the given directory as they are
+    listed, omitting . and .., without building the whole list in memory.
+
+    Arguments:
+        path -- The path of the directory to get the files from
+    """
+    with nested(api.cd(path), quiet()):
+        return iter_run_lines('for i in *; do echo $i; done')
+
+
 def file_exists(path):
     """
     Checks if the given path exists on the host and returns True if that's the
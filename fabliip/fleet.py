@@ -0,0 +1,553 @@
+"""
+Concurrent execution of fabliip operations on many hosts.
+
+Fabric runs a task on several hosts with one thread or process per host, which
+doesn't scale to hundreds of hosts. This module runs the operations of all the
+hosts in a single event loop instead: operations are generators that yield the
+commands to run (with :py:func:`run`) and get back their output, and the loop
+multiplexes the output of the running commands with ``poll``. Commands are
+sent over ``ssh`` connections pooled with ``ControlMaster``, so each host is
+only connected to once::
+
+    from fabliip import fleet
+
+    def deploy(tag, release_name):
+        yield fleet.update_remote_repository_root(tag)
+        yield fleet.create_release(tag, release_name)
+        yield fleet.link_shared_files(release_name)
+        yield fleet.activate_release(release_name)
+        releases = yield fleet.get_releases()
+        raise fleet.Return(releases[-1])
+
+    results, failures = fleet.Fleet(env.hosts, concurrency=100).run(
+        deploy, '1.2.3', '20140830180015_1.2.3'
+    )
+
+An operation can yield another operation to run it and get its return value,
+and returns its own value by raising :py:class:`Return` (generators can't
+return values in Python 2). A failed command raises :py:class:`CommandFailed`
+in the operation, unless it was run with ``warn_only=True``. ``env.host_string``
+is set to the host of the operation while it runs, and the other Fabric env
+variables (``releases_root``, etc) are used as usual.
+
+The number of commands running at the same time is limited globally
+(``concurrency``) and per host (``per_host``). Operations on the same host, eg.
+for several sites, can be run at once with :py:meth:`Fleet.execute`. Each
+running command holds two file descriptors, so the concurrency is also bounded
+by the limit of open files of the process (``ulimit -n``).
+
+The :py:class:`LocalTransport` runs the commands in a local shell instead of
+over ``ssh``, eg. to test the operations against local stand-in directories.
+
+The operations of this module don't emit the signals of
+:py:mod:`fabliip.signals`.
+"""
+from collections import defaultdict, deque
+import errno
+import os
+import resource
+import select
+import subprocess
+import time
+import types
+
+from fabric import api
+
+from . import release_cache
+from .releases import FAILED_RELEASE_SUFFIX, get_release_path
+from .sync import get_shell_command
+
+
+DEFAULT_CONCURRENCY = 100
+DEFAULT_PER_HOST = 4
+CONTROL_PATH = os.path.join('~', '.ssh', 'fabliip-%C')
+CONTROL_PERSIST = 60
+READ_SIZE = 65536
+# File descriptors kept for everything else than the running commands
+RESERVED_FDS = 64
+POLL_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+_COMPLETED = object()
+
+
+class Return(Exception):
+    """
+    Raised by an operation to return the given value.
+    """
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class CommandFailed(Exception):
+    """
+    Raised in an operation when one of its commands failed.
+    """
+    def __init__(self, host, command, output):
+        super(CommandFailed, self).__init__(
+            "Command `{command}` failed on {host} with return code {code}:"
+            " {stderr}".format(command=command, host=host,
+                               code=output.return_code, stderr=output.stderr)
+        )
+        self.host = host
+        self.command = command
+        self.output = output
+
+
+class Output(str):
+    """
+    Output of a command, with its ``return_code``, ``stderr`` and whether it
+    ``succeeded`` or ``failed``. Like the output of :py:func:`fabric.api.run`,
+    it's a byte string on Python 2.
+    """
+    def __new__(cls, stdout, stderr, return_code):
+        output = super(Output, cls).__new__(cls, stdout)
+        output.stderr = stderr
+        output.return_code = return_code
+        output.succeeded = return_code == 0
+        output.failed = not output.succeeded
+
+        return output
+
+
+class Command(object):
+    """
+    Command yielded by an operation, see :py:func:`run`.
+    """
+    def __init__(self, command, warn_only=False):
+        self.command = command
+        self.warn_only = warn_only
+
+
+def run(command, warn_only=False):
+    """
+    Return a command to yield from an operation to run it on the host of the
+    operation. The value of the ``yield`` is the :py:class:`Output` of the
+    command.
+    """
+    return Command(command, warn_only)
+
+
+class SSHTransport(object):
+    """
+    Run the commands over ``ssh``, reusing one master connection per host.
+
+    Arguments:
+        control_path -- The path of the master connection sockets (default
+        ``~/.ssh/fabliip-%C``)
+        control_persist -- The time in seconds the master connections stay open
+        once idle (default 60)
+    """
+    def __init__(self, control_path=CONTROL_PATH,
+                 control_persist=CONTROL_PERSIST):
+        self.ssh_options = [
+            'BatchMode=yes',
+            'ControlMaster=auto',
+            'ControlPath={path}'.format(path=os.path.expanduser(control_path)),
+            'ControlPersist={persist}'.format(persist=control_persist),
+        ]
+
+    def spawn(self, host, command):
+        return subprocess.Popen(
+            get_shell_command(host, command, self.ssh_options),
+            stdin=open(os.devnull), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, close_fds=True
+        )
+
+
+class LocalTransport(object):
+    """
+    Run the commands of every host in a local shell and record them in
+    ``commands`` as ``(host, command, return code, duration)`` tuples.
+
+    Arguments:
+        path -- A list of directories to prepend to the ``PATH`` of the
+        executed commands, eg. to provide fake ``drush`` executables
+    """
+    def __init__(self, path=None):
+        self.path = path or []
+        self.commands = []
+
+    def spawn(self, host, command):
+        environment = dict(os.environ)
+        if self.path:
+            environment['PATH'] = os.pathsep.join(
+                self.path + [environment.get('PATH', '')]
+            )
+
+        return subprocess.Popen(
+            ['/bin/bash', '-c', command], stdin=open(os.devnull),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
+            env=environment
+        )
+
+    def record(self, host, command, return_code, duration):
+        self.commands.append((host, command, return_code, duration))
+
+
+class _Job(object):
+    """
+    Operation running on a host, with its stack of nested operations.
+    """
+    def __init__(self, index, host, operation, settings):
+        self.index = index
+        self.host = host
+        self.stack = [operation]
+        self.settings = settings or {}
+
+
+class _RunningCommand(object):
+    def __init__(self, job, command, process):
+        self.job = job
+        self.command = command
+        self.process = process
+        self.start = time.time()
+        self.stdout_fd = process.stdout.fileno()
+        self.stderr_fd = process.stderr.fileno()
+        self.output = {self.stdout_fd: [], self.stderr_fd: []}
+        self.open_fds = set(self.output)
+
+
+class Fleet(object):
+    """
+    Event loop running operations on many hosts.
+
+    Arguments:
+        hosts -- The list of hosts :py:meth:`run` runs operations on (default
+        ``hosts`` env variable)
+        concurrency -- The maximum number of commands running at the same time
+        (default 100)
+        per_host -- The maximum number of commands running at the same time on
+        a host (default 4)
+        transport -- The transport used to run the commands (default
+        :py:class:`SSHTransport`)
+
+    Raise ValueError if ``concurrency`` is too high for the limit of open files
+    of the process.
+    """
+    def __init__(self, hosts=None, concurrency=DEFAULT_CONCURRENCY,
+                 per_host=DEFAULT_PER_HOST, transport=None):
+        max_concurrency = get_max_concurrency()
+        if concurrency > max_concurrency:
+            raise ValueError(
+                "A concurrency of {concurrency} needs more file descriptors"
+                " than allowed by the limit of open files, use at most"
+                " {max_concurrency} or raise the limit (ulimit -n)".format(
+                    concurrency=concurrency, max_concurrency=max_concurrency)
+            )
+
+        self.hosts = list(hosts if hosts is not None else api.env.hosts)
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.transport = transport or SSHTransport()
+
+    def run(self, operation, *args, **kwargs):
+        """
+        Run the given operation with the given arguments on every host and
+        return a tuple ``(results, failures)`` of dictionaries ``{host: return
+        value}`` and ``{host: exception}``.
+        """
+        outcomes = self.execute([
+            (host, operation(*args, **kwargs)) for host in self.hosts
+        ])
+        results, failures = {}, {}
+
+        for host, (succeeded, value) in zip(self.hosts, outcomes):
+            (results if succeeded else failures)[host] = value
+
+        return results, failures
+
+    def execute(self, jobs):
+        """
+        Run the given operations concurrently and return the list of their
+        outcomes as ``(succeeded, return value or exception)`` tuples.
+
+        Arguments:
+            jobs -- List of ``(host, operation)`` or ``(host, operation,
+            settings)`` tuples, ``operation`` being a started operation (eg.
+            ``fleet.get_releases()``) and ``settings`` a dictionary of env
+            variables to set while the operation runs (eg. for multisite
+            deployments)
+        """
+        outcomes = [None] * len(jobs)
+        ready = deque(
+            (_Job(index, job[0], job[1], job[2] if len(job) > 2 else None),
+             None, None)
+            for index, job in enumerate(jobs)
+        )
+        waiting = deque()
+        # {fd: running command}
+        running = {}
+        running_per_host = defaultdict(int)
+        poller = select.poll()
+
+        while ready or waiting or running:
+            while ready:
+                job, value, error = ready.popleft()
+                command = self._step(job, value, error, outcomes)
+                if command is not None:
+                    waiting.append((job, command))
+
+            # Start the waiting commands within the concurrency limits
+            still_waiting = deque()
+            running_commands = len(set(running.values()))
+
+            for job, command in waiting:
+                if (running_commands < self.concurrency
+                        and running_per_host[job.host] < self.per_host):
+                    # A command that can't be started only fails its own
+                    # operation
+                    try:
+                        started = _RunningCommand(
+                            job, command,
+                            self.transport.spawn(job.host, command.command)
+                        )
+                    except Exception as e:
+                        ready.append((job, None, e))
+                        continue
+
+                    for fd in started.open_fds:
+                        running[fd] = started
+                        poller.register(fd, POLL_EVENTS)
+                    running_commands += 1
+                    running_per_host[job.host] += 1
+                else:
+                    still_waiting.append((job, command))
+
+            waiting = still_waiting
+
+            if not running:
+                continue
+
+            try:
+                events = poller.poll()
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                started = running[fd]
+                data = os.read(fd, READ_SIZE)
+
+                if data:
+                    started.output[fd].append(data)
+                    continue
+
+                poller.unregister(fd)
+                del running[fd]
+                started.open_fds.discard(fd)
+
+                if not started.open_fds:
+                    running_per_host[started.job.host] -= 1
+
+                    try:
+                        ready.append(self._finish(started))
+                    except Exception as e:
+                        ready.append((started.job, None, e))
+
+        return outcomes
+
+    def _finish(self, started):
+        """
+        Wait for the given command to exit and return the ``(job, value,
+        error)`` tuple resuming its operation.
+        """
+        process = started.process
+        process.stdout.close()
+        process.stderr.close()
+        return_code = process.wait()
+
+        if hasattr(self.transport, 'record'):
+            self.transport.record(started.job.host, started.command.command,
+                                  return_code, time.time() - started.start)
+
+        output = Output(
+            _to_str(b''.join(started.output[started.stdout_fd]).strip()),
+            _to_str(b''.join(started.output[started.stderr_fd]).strip()),
+            return_code
+        )
+
+        if output.failed and not started.command.warn_only:
+            return (started.job, None,
+                    CommandFailed(started.job.host, started.command.command,
+                                  output))
+
+        return started.job, output, None
+
+    def _step(self, job, value, error, outcomes):
+        """
+        Resume the operation of the given job with the given value or
+        exception until it yields a command, which is returned, or completes.
+        """
+        while True:
+            operation = job.stack[-1]
+            yielded = _COMPLETED
+
+            try:
+                with api.settings(host_string=job.host, **job.settings):
+                    if error is not None:
+                        yielded = operation.throw(error)
+                    else:
+                        yielded = operation.send(value)
+            except (Return, StopIteration) as e:
+                value, error = getattr(e, 'value', None), None
+            except Exception as e:
+                value, error = None, e
+
+            if yielded is _COMPLETED:
+                job.stack.pop()
+                if not job.stack:
+                    outcomes[job.index] = ((False, error) if error is not None
+                                           else (True, value))
+                    return None
+                continue
+
+            if isinstance(yielded, types.GeneratorType):
+                job.stack.append(yielded)
+                value, error = None, None
+            elif isinstance(yielded, Command):
+                return yielded
+            else:
+                value, error = None, TypeError(
+                    "Operations can only yield commands or operations, got"
+                    " {value!r}".format(value=yielded)
+                )
+
+
+def _to_str(data):
+    return data if str is bytes else data.decode('utf-8', 'replace')
+
+
+def get_max_concurrency():
+    """
+    Return the maximum number of commands that can run at the same time given
+    the limit of open files of the process.
+    """
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return float('inf')
+
+    return max(1, (soft_limit - RESERVED_FDS) // 2)
+
+
+def ls(path):
+    """
+    Operation returning the list of the files in the given directory, see
+    :py:func:`fabliip.file.ls`.
+    """
+    files = yield run('cd {path} && for i in *; do echo $i; done'.format(
+        path=path), warn_only=True)
+
+    raise Return(files.replace('\r', '').split('\n'))
+
+
+def file_exists(path):
+    """
+    Operation returning whether the given path exists, see
+    :py:func:`fabliip.file.file_exists`.
+    """
+    result = yield run('test -e {path}'.format(path=path), warn_only=True)
+
+    raise Return(result.succeeded)
+
+
+def update_remote_repository_root(tag):
+    """
+    Operation fetching the latest git objects, checking out the given tag and
+    updating the submodules in a single command, see
+    :py:func:`fabliip.vcs.git.update_remote_repository_root`.
+    """
+    yield run('cd {repository_root} && git fetch -t -p'
+              ' && git checkout {tag} && git submodule sync'
+              ' && git submodule update --init'.format(
+                  repository_root=api.env.repository_root, tag=tag))
+
+
+def drush(command):
+    """
+    Operation running a drush command and returning its output, see
+    :py:func:`fabliip.drupal.drush`.
+    """
+    output = yield run('cd {drupal_root} && drush -y {command}'.format(
+        drupal_root=api.env.drupal_root, command=command))
+
+    raise Return(output)
+
+
+def get_releases():
+    """
+    Operation returning the list of releases sorted by oldest to newest, see
+    :py:func:`fabliip.releases.get_releases`.
+    """
+    files = yield ls(api.env.releases_root)
+
+    raise Return([release for release in sorted(files)
+                  if not release.endswith(FAILED_RELEASE_SUFFIX)])
+
+
+def create_release(tag, release_name=None):
+    """
+    Operation creating a release from the given tag in a single command, see
+    :py:func:`fabliip.releases.create_release`. Releases are not deduplicated.
+    """
+    release_path = get_release_path(release_name)
+
+    if release_cache.is_enabled():
+        output = yield run(release_cache.get_materialize_command(tag,
+                                                                 release_path))
+        raise Return(release_cache.parse_materialize_output(output))
+
+    yield run('mkdir -p {release_path} && tmpfile=$(mktemp)'
+              ' && git archive --output=$tmpfile --remote={remote} {version}'
+              ' && tar xf $tmpfile -C {release_path};'
+              ' status=$?; rm -f $tmpfile; exit $status'.format(
+                  release_path=release_path,
+                  remote=api.env.repository_root,
+                  version=tag))
+
+
+def link_shared_files(release_name=None):
+    """
+    Operation creating the links to the shared files in a single command, see
+    :py:func:`fabliip.releases.link_shared_files`.
+    """
+    release_path = get_release_path(release_name)
+
+    yield run(' && '.join(
+        'ln -sfn {target} {link_path}'.format(
+            target=os.path.join(api.env.shared_root, target),
+            link_path=os.path.join(release_path, link_path))
+        for target, link_path in api.env.shared_files.iteritems()
+    ) or 'true')
+
+
+def activate_release(release_name=None):
+    """
+    Operation making the ``current`` symlink point to the given release, see
+    :py:func:`fabliip.releases.activate_release`.
+    """
+    yield run('cd {project_root} && ln -sfn {target} new_current'
+              ' && mv -Tf new_current current'.format(
+                  project_root=api.env.project_root,
+                  target=get_release_path(release_name)))
+
+
+def clean_old_releases(keep=5):
+    """
+    Operation removing the old releases, keeping ``keep`` releases, and
+    pruning the release cache if it's enabled, see
+    :py:func:`fabliip.releases.clean_old_releases`. Return the list of removed
+    releases.
+    """
+    releases = yield get_releases()
+    removed = releases[:-keep]
+
+    if removed:
+        yield run('rm -rf {paths}'.format(paths=' '.join(
+            get_release_path(release) for release in removed)))
+
+    if release_cache.is_enabled():
+        yield run(release_cache.get_prune_command())
+
+    raise Return(removed)
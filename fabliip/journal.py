@@ -0,0 +1,330 @@
+"""
+Resumable deployments.
+
+Within the :py:func:`resume` context manager, every function decorated with
+:py:func:`fabliip.signals.register` (such as :py:func:`create_release
+<fabliip.releases.create_release>` or the tasks decorated with
+:py:func:`fabliip.signals.task`) is recorded in a journal on the host once it
+has completed. If the deployment fails and is run again for the same release,
+the steps that already completed are skipped and the deployment restarts
+where it stopped. Failed steps are retried with an exponential backoff before
+giving up::
+
+    from fabliip import journal, releases
+
+    @task
+    def deploy(tag):
+        env.release_name = (journal.get_pending_release(tag)
+                            or '{date}_{tag}'.format(date=..., tag=tag))
+
+        with journal.resume():
+            releases.create_release(tag)
+            releases.link_shared_files()
+            releases.activate_release()
+
+The steps are identified by their name and the number of times they were
+called within the block, so the block must call them in the same order each
+time. Skipped steps return the value they returned when they completed if it
+could be serialized to JSON, None otherwise. The journal is removed once the
+block completes.
+
+The journals are kept in the ``.journal`` directory of ``releases_root``, one
+file per release. The `journal_retries` and `journal_backoff` environment
+variables set the number of retries of a failed step (default 2) and the
+delay in seconds before the first retry (default 5), which doubles with each
+retry.
+
+:py:func:`execute` runs a task on each host and keeps track of the hosts it
+failed on, so that running it again with the same arguments only retries these
+hosts.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import base64
+import json
+import os
+import time
+
+from fabric import api
+from fabric.context_managers import quiet
+
+from . import signals
+from .releases import determine_release_name
+
+
+JOURNAL_DIRECTORY = '.journal'
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 5
+STATE_FILE = '.fabliip_failed_hosts.json'
+
+_journal = None
+
+
+def get_journal_path(release_name=None):
+    """
+    Return the absolute path to the journal of the given release.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+    """
+    return os.path.join(api.env.releases_root, JOURNAL_DIRECTORY,
+                        determine_release_name(release_name))
+
+
+def get_pending_release(tag=None):
+    """
+    Return the name of the most recent release having a journal, ie. whose
+    deployment didn't complete, or None if there's no such release.
+
+    Arguments:
+        tag -- Only consider the releases of the given tag
+    """
+    with quiet():
+        output = api.run("ls -1 {directory}".format(directory=os.path.join(
+            api.env.releases_root, JOURNAL_DIRECTORY)))
+
+    if output.failed:
+        return None
+
+    releases = sorted(
+        release for release in output.splitlines()
+        if release and (tag is None or release.endswith('_%s' % tag))
+    )
+
+    return releases[-1] if releases else None
+
+
+def read(release_name=None):
+    """
+    Return the completed steps of the journal of the given release as a
+    dictionary ``{step: entry}``, the entries being dictionaries with the
+    ``result`` of the step and the ``occurrences`` of each step once it
+    completed.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+    """
+    path = get_journal_path(release_name)
+
+    with quiet():
+        output = api.run("mkdir -p {directory} && touch {path} && cat {path}"
+                         .format(directory=os.path.dirname(path), path=path))
+
+    completed = {}
+    for line in output.splitlines():
+        # The last line can be truncated if the connection was lost while it
+        # was written
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+
+        completed[entry['step']] = entry
+
+    return completed
+
+
+@contextmanager
+def resume(release_name=None, retries=None, backoff=None):
+    """
+    Context manager recording the steps completed in its block in the journal
+    of the given release, and skipping the steps already recorded.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+
+    Arguments:
+        release_name -- The name of the release (usually a date like YmdHMS)
+        retries -- The number of times a failed step is retried (default
+        ``journal_retries`` env variable or 2)
+        backoff -- The delay in seconds before the first retry (default
+        ``journal_backoff`` env variable or 5)
+    """
+    global _journal
+
+    release_name = determine_release_name(release_name)
+    completed = read(release_name)
+
+    if completed:
+        print("Resuming release {release}, {count} steps already completed"
+              .format(release=release_name, count=len(completed)))
+
+    _journal = {
+        'path': get_journal_path(release_name),
+        'completed': completed,
+        'occurrences': defaultdict(int),
+        'retries': (retries if retries is not None
+                    else api.env.get('journal_retries', DEFAULT_RETRIES)),
+        'backoff': (backoff if backoff is not None
+                    else api.env.get('journal_backoff', DEFAULT_BACKOFF)),
+    }
+
+    try:
+        yield
+        with quiet():
+            api.run("rm -f {path}".format(path=_journal['path']))
+    finally:
+        _journal = None
+
+
+def _append(step, result):
+    try:
+        json.dumps(result)
+    except (TypeError, ValueError):
+        result = None
+
+    entry = {
+        'step': step,
+        'result': result,
+        'occurrences': dict(_journal['occurrences']),
+        'time': time.time(),
+    }
+
+    with quiet():
+        api.run("echo {entry} | base64 -d >> {path}".format(
+            entry=base64.b64encode(json.dumps(entry).encode('utf-8') + b'\n')
+            .decode('ascii'),
+            path=_journal['path'],
+        ))
+
+    _journal['completed'][step] = entry
+
+
+@signals.intercept
+def _run_step(name, call):
+    if _journal is None:
+        return call()
+
+    _journal['occurrences'][name] += 1
+    step = '{name}#{occurrence}'.format(
+        name=name, occurrence=_journal['occurrences'][name])
+
+    if step in _journal['completed']:
+        print("Skipping {name}, already completed".format(name=name))
+        entry = _journal['completed'][step]
+
+        # Count the steps called by the skipped step as if it had been run
+        for other_name, occurrence in entry.get('occurrences', {}).items():
+            _journal['occurrences'][other_name] = max(
+                occurrence, _journal['occurrences'][other_name])
+
+        return entry.get('result')
+
+    # The steps called by this step must keep their numbering when it's
+    # retried, so that the ones that completed are skipped
+    occurrences = dict(_journal['occurrences'])
+    attempt = 0
+
+    while True:
+        try:
+            result = call()
+            break
+        except (Exception, SystemExit) as e:
+            # Only retry the innermost step that failed, not the steps
+            # calling it
+            if getattr(e, 'journal_retried', False) \
+                    or attempt >= _journal['retries']:
+                e.journal_retried = True
+                raise
+
+            delay = _journal['backoff'] * 2 ** attempt
+            attempt += 1
+            print("{name} failed, retrying in {delay}s (retry {attempt} of"
+                  " {retries})".format(name=name, delay=delay, attempt=attempt,
+                                       retries=_journal['retries']))
+            time.sleep(delay)
+            _journal['occurrences'] = defaultdict(int, occurrences)
+
+    _append(step, result)
+
+    return result
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_state(path, state):
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def _get_task_name(task):
+    return getattr(task, 'name', None) or task.__name__
+
+
+def _get_arguments_key(args, kwargs):
+    return json.dumps([list(args), kwargs], sort_keys=True, default=repr)
+
+
+def execute(task, *args, **kwargs):
+    """
+    Execute the given task on each host with :py:func:`fabric.api.execute`,
+    carrying on with the other hosts if it fails on one of them. The hosts the
+    task failed on are saved in a local state file (``journal_state_file`` env
+    variable, default ``.fabliip_failed_hosts.json``) along with the arguments
+    of the task, and the next call for the same task with the same arguments
+    only executes it on these hosts (use :py:func:`reset_failed_hosts` to
+    execute it on all the hosts again). Abort if the task failed on any host,
+    otherwise return the dictionary ``{host: return value}``.
+
+    The hosts are given by the ``hosts`` keyword argument or the ``hosts`` env
+    variable. Other arguments are passed to the task. The hosts are processed
+    serially.
+    """
+    hosts = kwargs.pop('hosts', None) or api.env.hosts
+    state_path = api.env.get('journal_state_file', STATE_FILE)
+    task_name = _get_task_name(task)
+    arguments = _get_arguments_key(args, kwargs)
+
+    state = _load_state(state_path)
+    failed = state.get(task_name)
+
+    if failed and failed.get('arguments') == arguments:
+        hosts = ([host for host in hosts if host in failed['hosts']]
+                 or failed['hosts'])
+        print("Retrying {task} on the hosts it failed on: {hosts}".format(
+            task=task_name, hosts=', '.join(hosts)))
+    elif failed:
+        print("Executing {task} on all the hosts, the hosts it failed on"
+              " ({hosts}) were for other arguments".format(
+                  task=task_name, hosts=', '.join(failed['hosts'])))
+
+    results = {}
+    failed_hosts = []
+
+    for host in hosts:
+        try:
+            results.update(api.execute(task, hosts=[host], *args, **kwargs))
+        except (Exception, SystemExit):
+            failed_hosts.append(host)
+
+    if failed_hosts:
+        state[task_name] = {'arguments': arguments, 'hosts': failed_hosts}
+    else:
+        state.pop(task_name, None)
+
+    _save_state(state_path, state)
+
+    if failed_hosts:
+        api.abort("{task} failed on {hosts}, run it again with the same"
+                  " arguments to retry these hosts only".format(task=task_name, hosts=', '.join(failed_hosts)))
+
+    return results
+
+
+def reset_failed_hosts(task=None):
+    """
+    Forget the hosts the given task (or all the tasks if it's None) failed on,
+    so that the next :py:func:`execute` runs it on all the hosts.
+    """
+    state_path = api.env.get('journal_state_file', STATE_FILE)
+
+    if task is None:
+        state = {}
+    else:
+        state = _load_state(state_path)
+        state.pop(_get_task_name(task), None)
+
+    _save_state(state_path, state)
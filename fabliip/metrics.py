@@ -0,0 +1,302 @@
+"""
+Collection and export of deployment metrics.
+
+Once enabled, the collector measures the duration of every function decorated
+with :py:func:`fabliip.signals.register` (including the tasks decorated with
+:py:func:`fabliip.signals.task`), along with the metrics reported by the
+fabliip helpers (size of the database dumps and of the releases, release cache
+hits, bytes synchronized, etc). Every metric is labelled with the host
+(``env.host_string``), the site (``env.site``, see
+:py:func:`fabliip.decorators.multisite`) and, for the steps, the name of the
+function and whether it succeeded (``status`` label, ``success`` or
+``failure``). The ``fabliip_run_success`` gauge tells whether the last
+outermost step of the run succeeded.
+
+At the end of the run, the metrics are aggregated in counters and histograms
+and written to the metrics directory both in the Prometheus text format
+(``fabliip.prom``, eg. for the textfile collector of the node exporter) and as
+JSON lines appended to ``fabliip.jsonl``::
+
+    from fabliip import metrics
+
+    metrics.enable('/var/lib/node_exporter/textfile')
+
+The directory can also be set with the `metrics_path` environment variable.
+
+Measurements are spooled to a file in the metrics directory while the run is in
+progress, so the metrics of the tasks executed in parallel are collected too.
+"""
+from collections import OrderedDict
+import atexit
+import json
+import os
+import time
+
+from fabric import api
+
+from . import signals
+
+
+PROMETHEUS_FILE = 'fabliip.prom'
+JSON_FILE = 'fabliip.jsonl'
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_BUCKETS = tuple(10 ** exponent for exponent in range(3, 12))
+
+_run = None
+
+
+def enable(path=None):
+    """
+    Start collecting the metrics and write them to the given directory at the
+    end of the run.
+
+    Arguments:
+        path -- The directory to write the metrics to (default ``metrics_path``
+        env variable)
+    """
+    global _run
+
+    if _run is not None:
+        return
+
+    if path is None:
+        path = api.env.metrics_path
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    start = time.time()
+    _run = {
+        'id': '{start:.0f}-{pid}'.format(start=start, pid=os.getpid()),
+        'pid': os.getpid(),
+        'start': start,
+        'path': path,
+        # Number of steps being run, to know when the outermost step ends
+        'depth': 0,
+        'status': 'success',
+    }
+
+    signals.intercept(_time_step)
+    atexit.register(write)
+
+
+def is_enabled():
+    """
+    Return True if the metrics are being collected.
+    """
+    return _run is not None
+
+
+def increment(name, value=1, **labels):
+    """
+    Increment the given counter. The ``host`` and ``site`` labels are added to
+    the given labels.
+    """
+    _record('counter', name, value, labels)
+
+
+def observe(name, value, **labels):
+    """
+    Add the given value to the given histogram. The ``host`` and ``site``
+    labels are added to the given labels.
+    """
+    _record('histogram', name, value, labels)
+
+
+def observe_file_size(name, path, **labels):
+    """
+    Add the size in bytes of the given remote file or directory to the given
+    histogram.
+    """
+    with api.settings(api.hide('everything'), warn_only=True):
+        size = api.run("du -sb {path} | cut -f1".format(path=path))
+
+    if size.succeeded and size.isdigit():
+        observe(name, int(size), **labels)
+
+
+def _get_spool_path():
+    return os.path.join(_run['path'], '.fabliip-{id}.events'.format(
+        id=_run['id']))
+
+
+def _record(metric_type, name, value, labels):
+    if _run is None:
+        return
+
+    event_labels = {
+        'host': api.env.host_string or '',
+        'site': api.env.get('site') or '',
+    }
+    event_labels.update(labels)
+
+    # A single write per event so that the lines written by parallel tasks
+    # don't get mixed up
+    with open(_get_spool_path(), 'a') as f:
+        f.write(json.dumps({
+            'type': metric_type,
+            'name': name,
+            'value': value,
+            'labels': event_labels,
+        }) + '\n')
+
+
+def _time_step(name, call):
+    if _run is None:
+        return call()
+
+    run = _run
+    run['depth'] += 1
+    start = time.time()
+    status = 'failure'
+
+    try:
+        return_value = call()
+        status = 'success'
+
+        return return_value
+    finally:
+        run['depth'] -= 1
+        if run['depth'] == 0:
+            run['status'] = status
+
+        observe('fabliip_step_duration_seconds', time.time() - start,
+                step=name, status=status)
+
+
+def get_buckets(name):
+    """
+    Return the histogram buckets used for the given metric.
+    """
+    return SIZE_BUCKETS if name.endswith('_bytes') else DURATION_BUCKETS
+
+
+def aggregate(events):
+    """
+    Aggregate the given events in a dictionary ``{(name, labels): series}``,
+    labels being a sorted tuple of ``(label, value)`` tuples.
+    """
+    series = OrderedDict()
+
+    for event in events:
+        key = (event['name'], tuple(sorted(event['labels'].items())))
+
+        if event['type'] == 'counter':
+            current = series.setdefault(key, {'type': 'counter', 'value': 0})
+            current['value'] += event['value']
+        else:
+            buckets = get_buckets(event['name'])
+            current = series.setdefault(key, {
+                'type': 'histogram',
+                'buckets': [0] * len(buckets),
+                'sum': 0,
+                'count': 0,
+            })
+            current['sum'] += event['value']
+            current['count'] += 1
+
+            for i, bucket in enumerate(buckets):
+                if event['value'] <= bucket:
+                    current['buckets'][i] += 1
+
+    return series
+
+
+def _format_labels(labels, **extra_labels):
+    labels = list(labels) + sorted(extra_labels.items())
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(
+        '{label}="{value}"'.format(
+            label=label,
+            value=(str(value).replace('\\', '\\\\').replace('"', '\\"')
+                   .replace('\n', '\\n')),
+        ) for label, value in labels
+    )
+
+
+def format_prometheus(series):
+    """
+    Return the given aggregated series in the Prometheus text format.
+    """
+    lines = []
+    described = set()
+
+    for (name, labels), current in sorted(series.items()):
+        if name not in described:
+            lines.append('# TYPE {name} {type}'.format(
+                name=name, type=current['type']))
+            described.add(name)
+
+        if current['type'] in ('counter', 'gauge'):
+            lines.append('{name}{labels} {value}'.format(
+                name=name, labels=_format_labels(labels),
+                value=current['value']))
+            continue
+
+        for bucket, count in zip(get_buckets(name), current['buckets']):
+            lines.append('{name}_bucket{labels} {count}'.format(
+                name=name, labels=_format_labels(labels, le=bucket),
+                count=count))
+
+        lines.append('{name}_bucket{labels} {count}'.format(
+            name=name, labels=_format_labels(labels, le='+Inf'),
+            count=current['count']))
+        lines.append('{name}_sum{labels} {sum}'.format(
+            name=name, labels=_format_labels(labels), sum=current['sum']))
+        lines.append('{name}_count{labels} {count}'.format(
+            name=name, labels=_format_labels(labels), count=current['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write():
+    """
+    Aggregate the metrics collected so far and write them to the metrics
+    directory, and stop collecting them. Called automatically at the end of
+    the run.
+    """
+    global _run
+
+    if _run is None or os.getpid() != _run['pid']:
+        return
+
+    spool_path = _get_spool_path()
+    events = []
+
+    if os.path.exists(spool_path):
+        with open(spool_path) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+
+    end = time.time()
+    series = aggregate(events)
+    series[('fabliip_run_duration_seconds', ())] = {
+        'type': 'gauge', 'value': end - _run['start']
+    }
+    series[('fabliip_run_timestamp_seconds', ())] = {
+        'type': 'gauge', 'value': int(end)
+    }
+    series[('fabliip_run_success', ())] = {
+        'type': 'gauge', 'value': 1 if _run['status'] == 'success' else 0
+    }
+
+    # Write the Prometheus file atomically since it's read by the collector
+    # at any time
+    prometheus_path = os.path.join(_run['path'], PROMETHEUS_FILE)
+    with open(prometheus_path + '.tmp', 'w') as f:
+        f.write(format_prometheus(series))
+    os.rename(prometheus_path + '.tmp', prometheus_path)
+
+    with open(os.path.join(_run['path'], JSON_FILE), 'a') as f:
+        for (name, labels), current in series.items():
+            f.write(json.dumps(dict(
+                current, run=_run['id'], time=end, name=name,
+                labels=dict(labels)
+            ), sort_keys=True) + '\n')
+
+    if os.path.exists(spool_path):
+        os.remove(spool_path)
+
+    _run = None
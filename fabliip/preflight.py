@@ -0,0 +1,205 @@
+"""
+Host preflight checks.
+
+:py:func:`probe` gathers in a single command the facts about the current host
+that fabliip's modules depend on: free disk space in ``releases_root``, the
+available tools and their version, the ``current`` release, the content of the
+VERSION file, whether the filesystem of the releases supports reflinks, etc::
+
+    from fabliip import preflight
+
+    @task
+    def deploy(tag):
+        facts = preflight.probe()
+        if facts['disk_free'] < 2 * 1024 ** 3:
+            abort("Less than 2GB free on {host}".format(host=env.host_string))
+
+The facts are persisted locally (in ``~/.cache/fabliip/facts``, one file per
+host and project) and :py:func:`get_facts` only probes the host again once they
+are older than the `facts_ttl` environment variable (in seconds, default 3600).
+:py:func:`get_fact` and :py:func:`has_tool` never probe the host, so modules
+use them to choose fast paths when the facts are known and fall back to the
+safe path otherwise.
+
+Keep in mind that the cached ``disk_free``, ``current`` and ``version`` facts
+reflect the state of the host at the time it was probed.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+
+from fabric import api
+
+
+TOOLS = ('git', 'drush', 'tar', 'mysqldump', 'pg_dump', 'gzip', 'pigz',
+         'zstd', 'xz', 'rsync', 'python')
+DEFAULT_TTL = 3600
+CACHE_DIRECTORY = os.path.join('~', '.cache', 'fabliip', 'facts')
+
+# Facts of the current process, so that the cache file is only read once
+_facts = {}
+
+
+PROBE_SCRIPT = """
+releases_root={releases_root}
+project_root={project_root}
+echo "hostname=$(hostname)"
+echo "cpus=$(nproc 2>/dev/null || echo 1)"
+echo "disk_free_kb=$(df -Pk "$releases_root" 2>/dev/null | awk 'NR == 2 {{ print $4 }}')"
+echo "current=$(basename "$(readlink "$project_root/current")" 2>/dev/null)"
+echo "version=$(cat "$project_root/VERSION" 2>/dev/null)"
+for tool in {tools}; do
+    if command -v $tool > /dev/null 2>&1; then
+        echo "tool.$tool=$($tool --version 2>&1 < /dev/null | head -n 1)"
+    fi
+done
+reflink=0
+tmpfile=$(mktemp "$releases_root/.reflink.XXXXXX" 2>/dev/null) \
+    && cp --reflink=always "$tmpfile" "$tmpfile.copy" 2>/dev/null && reflink=1
+rm -f "$tmpfile" "$tmpfile.copy"
+echo "reflink=$reflink"
+"""
+
+
+def get_cache_path():
+    """
+    Return the path of the local file caching the facts of the current host
+    and project.
+    """
+    project = hashlib.sha1(
+        api.env.get('releases_root', api.env.get('project_root', '')).encode(
+            'utf-8')
+    ).hexdigest()[:8]
+
+    return os.path.join(
+        os.path.expanduser(CACHE_DIRECTORY),
+        '{host}-{project}.json'.format(
+            host=re.sub(r'[^\w.@-]', '_', api.env.host_string or 'localhost'),
+            project=project,
+        )
+    )
+
+
+def parse_facts(output):
+    """
+    Return the facts printed by the probe script as a dictionary. Tool
+    versions are grouped in the ``tools`` dictionary and the free disk space is
+    given in bytes.
+    """
+    facts = {'tools': {}}
+
+    for line in output.splitlines():
+        key, separator, value = line.strip().partition('=')
+        if not separator:
+            continue
+
+        if key.startswith('tool.'):
+            facts['tools'][key[5:]] = value
+        elif key == 'cpus':
+            facts[key] = int(value) if value.isdigit() else None
+        elif key == 'disk_free_kb':
+            facts['disk_free'] = int(value) * 1024 if value.isdigit() else None
+        elif key == 'reflink':
+            facts[key] = value == '1'
+        else:
+            facts[key] = value or None
+
+    return facts
+
+
+def probe():
+    """
+    Gather the facts of the current host in a single command, persist them
+    locally and return them as a dictionary.
+    """
+    project_root = api.env.get('project_root', '.')
+
+    with api.settings(api.hide('commands', 'stdout'), warn_only=True):
+        output = api.run(PROBE_SCRIPT.format(
+            releases_root=api.env.get('releases_root', project_root),
+            project_root=project_root,
+            tools=' '.join(TOOLS),
+        ))
+
+    facts = parse_facts(output)
+    facts['time'] = time.time()
+
+    path = get_cache_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(facts, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+    _facts[path] = facts
+
+    return facts
+
+
+def get_cached_facts(max_age=None):
+    """
+    Return the persisted facts of the current host if they're not older than
+    ``max_age`` seconds (default ``facts_ttl`` env variable or 3600), None
+    otherwise.
+    """
+    if max_age is None:
+        max_age = api.env.get('facts_ttl', DEFAULT_TTL)
+
+    path = get_cache_path()
+
+    if path not in _facts:
+        try:
+            with open(path) as f:
+                _facts[path] = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    facts = _facts[path]
+
+    return facts if time.time() - facts.get('time', 0) <= max_age else None
+
+
+def get_facts(max_age=None):
+    """
+    Return the facts of the current host, probing it only if the persisted
+    facts are older than ``max_age`` seconds (default ``facts_ttl`` env
+    variable or 3600).
+    """
+    facts = get_cached_facts(max_age)
+
+    return facts if facts is not None else probe()
+
+
+def get_fact(name, default=None):
+    """
+    Return the given fact of the current host if it's known, ``default``
+    otherwise. The host is never probed.
+    """
+    facts = get_cached_facts()
+
+    if facts is None or facts.get(name) is None:
+        return default
+
+    return facts[name]
+
+
+def has_tool(tool):
+    """
+    Return True if the given tool is known to be installed on the current host.
+    The host is never probed.
+    """
+    return tool in get_fact('tools', {})
+
+
+def invalidate():
+    """
+    Forget the persisted facts of the current host.
+    """
+    path = get_cache_path()
+    _facts.pop(path, None)
+
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,160 @@
+"""
+Startup profiling of fabfiles.
+
+Set the ``FABLIIP_PROFILE_STARTUP`` environment variable to profile the startup
+of your fabfile, eg. ``FABLIIP_PROFILE_STARTUP=1 fab --list``. Once fabliip is
+imported, the time spent importing each module and the time spent in the setup
+of the fabliip decorators (:py:func:`fabliip.decorators.multisite`,
+:py:func:`fabliip.signals.task`, etc) are recorded and printed on stderr when
+the process exits. Import fabliip before any other module in your fabfile to
+get the import times of all of them.
+
+If the variable is set to a number, only this number of modules is printed
+(default 20).
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import os
+import sys
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+
+DEFAULT_REPORT_SIZE = 20
+
+_enabled = False
+_original_import = None
+# Stack of [module name, start time, time spent in nested imports]
+_import_stack = []
+# {module name: (cumulative time, self time)}
+_import_times = {}
+# {decorator name: [number of calls, total time]}
+_setup_times = defaultdict(lambda: [0, 0.0])
+
+
+def _get_imported_name(name, globals=None, locals=None, fromlist=None,
+                       level=-1):
+    """
+    Return the name of the module(s) that the given ``__import__`` call will
+    load, or None if they're all loaded already.
+    """
+    if level > 0:
+        globals = globals or {}
+        package = globals.get('__package__')
+        if not package:
+            package = globals.get('__name__', '')
+            if '__path__' not in globals:
+                package = package.rpartition('.')[0]
+
+        package = package.rsplit('.', level - 1)[0] if level > 1 else package
+        name = '.'.join(part for part in (package, name) if part)
+
+    if name not in sys.modules:
+        return name
+
+    submodules = [
+        '{name}.{submodule}'.format(name=name, submodule=submodule)
+        for submodule in (fromlist or [])
+    ]
+    submodules = [module for module in submodules if module not in sys.modules]
+
+    return ', '.join(submodules) or None
+
+
+def _timed_import(*args, **kwargs):
+    name = _get_imported_name(*args, **kwargs)
+    if name is None:
+        return _original_import(*args, **kwargs)
+
+    _import_stack.append([name, time.time(), 0.0])
+    try:
+        return _original_import(*args, **kwargs)
+    finally:
+        name, start, nested_time = _import_stack.pop()
+        duration = time.time() - start
+
+        if name not in _import_times:
+            _import_times[name] = (duration, duration - nested_time)
+        if _import_stack:
+            _import_stack[-1][2] += duration
+
+
+def enable():
+    """
+    Start recording the import and decorator setup times and print them when
+    the process exits.
+    """
+    global _enabled, _original_import
+
+    if _enabled:
+        return
+
+    import atexit
+
+    _enabled = True
+    _original_import = builtins.__import__
+    builtins.__import__ = _timed_import
+    atexit.register(report)
+
+
+@contextmanager
+def measure(name):
+    """
+    Context manager recording the time spent in its block as setup time of the
+    given decorator, if profiling is enabled.
+    """
+    if not _enabled:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        times = _setup_times[name]
+        times[0] += 1
+        times[1] += time.time() - start
+
+
+def timed(name):
+    """
+    Decorator recording the time spent in the decorated function (usually a
+    decorator) with :py:func:`measure`.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def report(stream=None):
+    """
+    Print the slowest imports and the time spent in decorator setup.
+    """
+    stream = stream or sys.stderr
+
+    try:
+        size = int(os.environ.get('FABLIIP_PROFILE_STARTUP'))
+    except (TypeError, ValueError):
+        size = DEFAULT_REPORT_SIZE
+
+    stream.write("Import times (cumulative / self, in ms):\n")
+    slowest = sorted(_import_times.items(), key=lambda item: -item[1][0])
+    for name, (cumulative, own) in slowest[:size]:
+        stream.write("{cumulative:>10.1f} {own:>10.1f}  {name}\n".format(
+            cumulative=cumulative * 1000, own=own * 1000, name=name))
+
+    stream.write("Decorator setup times (calls, total in ms):\n")
+    for name, (calls, total) in sorted(_setup_times.items()):
+        stream.write("{calls:>10} {total:>10.1f}  {name}\n".format(
+            calls=calls, total=total * 1000, name=name))
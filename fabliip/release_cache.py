@@ -0,0 +1,165 @@
+"""
+Cache of the extracted release trees, keyed by commit hash.
+
+Deploying a commit that was already deployed on the host (after a rollback, to
+another site sharing the same repository or when retrying a failed deploy)
+normally extracts the whole tree from the repository again. When the
+`release_cache_root` environment variable is set, :py:func:`create_release
+<fabliip.releases.create_release>` extracts each commit once in the cache and
+materializes the release directories by copying the cached tree, using reflinks
+or hardlinks so that the copy only takes a few seconds::
+
+    release_cache/
+        3f1c2b9...  -- Tree of commit 3f1c2b9...
+        a84e0d1...
+
+The hash of the deployed commit is written in the ``REVISION`` file of the
+release directory. The cache keeps the `release_cache_size` most recently used
+trees (default 5) and is pruned by :py:func:`clean_old_releases
+<fabliip.releases.clean_old_releases>`. The trees of the commits of the releases
+still present in ``releases_root`` are never evicted, so that redeploying any of
+them stays instant.
+
+The following variables are used by this module:
+
+`release_cache_root`
+    Path to the cache directory. The cache is disabled if it's not set
+
+`release_cache_size`
+    Number of trees to keep in the cache (default 5)
+
+`release_cache_mode`
+    Either ``reflink`` (default) or ``hardlink``. In ``reflink`` mode the files
+    are copied with ``cp --reflink=auto``, which falls back to a regular copy on
+    filesystems that don't support reflinks. In ``hardlink`` mode the release
+    files are hardlinks to the cached files, which means a file modified in
+    place in a release is also modified in the cache. Only use it if your
+    releases are never modified in place after their creation.
+"""
+from fabric import api
+
+
+REVISION_FILE = 'REVISION'
+DEFAULT_CACHE_SIZE = 5
+MODES = ('reflink', 'hardlink')
+COPY_COMMANDS = {
+    'reflink': 'cp -a --reflink=auto',
+    'hardlink': 'cp -alf',
+}
+
+
+def is_enabled():
+    """
+    Return True if the `release_cache_root` environment variable is set.
+    """
+    return bool(api.env.get('release_cache_root'))
+
+
+def materialize(tag, release_path, mode=None):
+    """
+    Create the given release directory with the contents of the given tag,
+    extracting the tree in the cache first if it's not there yet. Return a
+    dictionary with the ``commit`` hash and whether the tree was found in the
+    cache (``hit``).
+
+    Arguments:
+        tag -- The tag (or any commit-ish) to install in the release
+        release_path -- The absolute path of the release directory to create
+        mode -- Either ``reflink`` or ``hardlink`` (default
+        ``release_cache_mode`` env variable or ``reflink``)
+    """
+    return parse_materialize_output(
+        api.run(get_materialize_command(tag, release_path, mode))
+    )
+
+
+def get_materialize_command(tag, release_path, mode=None):
+    """
+    Return the shell command used by :py:func:`materialize`.
+    """
+    if mode is None:
+        mode = api.env.get('release_cache_mode', 'reflink')
+
+    if mode not in MODES:
+        raise ValueError("Unknown release cache mode {mode}, must be one of"
+                         " {modes}".format(mode=mode, modes=', '.join(MODES)))
+
+    # The tree is extracted in a temporary directory and renamed so that
+    # concurrent deploys never copy a partially extracted tree
+    return """set -e
+        commit=$(git --git-dir={repository_root} rev-parse --verify '{tag}^{{commit}}')
+        mkdir -p {cache_root}
+        cd {cache_root}
+        if [ -d "$commit" ]; then
+            touch "$commit"
+            status=hit
+        else
+            tmpdir=$(mktemp -d "$commit.XXXXXX")
+            git --git-dir={repository_root} archive "$commit" | tar xf - -C "$tmpdir"
+            chmod 755 "$tmpdir"
+            mv -T "$tmpdir" "$commit" || rm -rf "$tmpdir"
+            status=miss
+        fi
+        mkdir -p {release_path}
+        {copy} "$commit"/. {release_path}
+        echo "$commit" > {release_path}/{revision_file}
+        echo "$status $commit"
+    """.format(
+        repository_root=api.env.repository_root,
+        tag=tag,
+        cache_root=api.env.release_cache_root,
+        copy=COPY_COMMANDS[mode],
+        release_path=release_path,
+        revision_file=REVISION_FILE,
+    )
+
+
+def parse_materialize_output(output):
+    """
+    Return the dictionary returned by :py:func:`materialize` from the output
+    of its command.
+    """
+    status, commit = output.splitlines()[-1].split()
+
+    return {'commit': commit, 'hit': status == 'hit'}
+
+
+def prune(size=None):
+    """
+    Remove the least recently used trees from the cache, keeping the ``size``
+    most recent ones and the trees of the releases present in
+    ``releases_root``. Return the list of evicted commits.
+
+    Arguments:
+        size -- The number of trees to keep (default ``release_cache_size``
+        env variable or 5)
+    """
+    with api.hide('commands'):
+        output = api.run(get_prune_command(size))
+
+    return output.split()
+
+
+def get_prune_command(size=None):
+    """
+    Return the shell command used by :py:func:`prune`.
+    """
+    if size is None:
+        size = api.env.get('release_cache_size', DEFAULT_CACHE_SIZE)
+
+    return """set -e
+        mkdir -p {cache_root}
+        cd {cache_root}
+        protected=$(cat {releases_root}/*/{revision_file} 2>/dev/null || true)
+        ls -1t | grep -E '^[0-9a-f]{{40}}$' | tail -n +{first_evicted} | while read commit; do
+            if ! echo "$protected" | grep -qx "$commit"; then
+                rm -rf "$commit"
+                echo "$commit"
+            fi
+        done
+    """.format(
+        cache_root=api.env.release_cache_root,
+        releases_root=api.env.releases_root,
+        revision_file=REVISION_FILE,
+        first_evicted=size + 1,
+    )
@@ -37,24 +37,58 @@ of this module without having to pass it around :
 
 `release_name`
     Name of the release
+
+The following variables are used to warm a release before activating it (see
+:py:func:`warm_release`):
+
+`warm_commands`
+    List of commands to run in the new release directory, eg. to preload the
+    autoloader or prime the caches
+
+`warm_urls`
+    List of URLs to request, usually on a side vhost serving the
+    ``new_current`` symlink which points to the new release during warm-up
+
+`warm_timeout`
+    Time budget in seconds for the whole warm-up (default 60)
+
+Set `deduplicate_releases` to True to replace the files that are identical
+across releases by reflinks (or hardlinks if `dedup_mode` is set to
+``hardlink``) after each :py:func:`create_release` (see :py:mod:`fabliip.dedup`).
+
+Set `release_cache_root` to extract each commit only once per host and create
+the release directories by copying the cached trees (see
+:py:mod:`fabliip.release_cache`).
+
+:py:func:`get_timeline` returns the releases indexed by date and version, to
+find eg. the release that was the most recent at a given time or the last
+release of a version (see :py:mod:`fabliip.timeline`).
 """
 
+import base64
 from contextlib import nested
 import logging
 import os
+import time
 
-from fabric.api import cd, env, run
+from fabric.api import abort, cd, env, hide, run, settings
 from fabric.context_managers import quiet
 
-from . import signals
+from . import dedup, metrics, release_cache, signals
 from .file import ls
+from .timeline import ReleaseTimeline
 
 
 FAILED_RELEASE_SUFFIX = '_failed'
+DEFAULT_WARM_TIMEOUT = 60
+WARM_STEP_MARKER = 'FABLIIP_WARM_STEP '
 
 
 logger = logging.getLogger(__name__)
 
+# {(host, releases root): ReleaseTimeline}
+_timelines = {}
+
 
 def determine_release_name(release_name):
     """
@@ -83,26 +117,52 @@ def get_release_path(release_name=None):
 
 
 @signals.register
-def create_release(tag, release_name=None):
+def create_release(tag, release_name=None, deduplicate=None):
     """
     Create the directory for a new release and extract the contents from the
     git repository at the given tag and put them in this directory.
 
+    If the release cache is enabled, the tree is copied from the cache instead
+    (see :py:mod:`fabliip.release_cache`).
+
+    The release directory can already exist, eg. when a failed deployment is
+    resumed (see :py:mod:`fabliip.journal`), in which case its files are
+    overwritten.
+
     Arguments:
         release_name -- The name of the release (usually a date like YmdHMS)
         tag -- The tag to install in this release
+        deduplicate -- Whether to deduplicate the files across releases once
+        the release is created (default ``deduplicate_releases`` env variable
+        or False)
     """
     release_path = get_release_path(release_name)
 
-    run("mkdir %s" % release_path)
-    tmpfile = run("mktemp")
-    run("git archive --output={tmpfile} --remote={remote} {version}"
-        " && tar xf {tmpfile} -C {release_path}".format(
-            remote=env.repository_root,
-            version=tag,
-            release_path=release_path,
-            tmpfile=tmpfile))
-    run("rm -f {tmpfile}".format(tmpfile=tmpfile))
+    if release_cache.is_enabled():
+        cached = release_cache.materialize(tag, release_path)
+        metrics.increment('fabliip_release_cache_requests_total',
+                          result='hit' if cached['hit'] else 'miss')
+    else:
+        run("mkdir -p %s" % release_path)
+        tmpfile = run("mktemp")
+        run("git archive --output={tmpfile} --remote={remote} {version}"
+            " && tar xf {tmpfile} -C {release_path}".format(
+                remote=env.repository_root,
+                version=tag,
+                release_path=release_path,
+                tmpfile=tmpfile))
+        run("rm -f {tmpfile}".format(tmpfile=tmpfile))
+
+    if metrics.is_enabled():
+        metrics.observe_file_size('fabliip_release_size_bytes', release_path)
+
+    _update_timeline(added=[os.path.basename(release_path)])
+
+    if deduplicate is None:
+        deduplicate = env.get('deduplicate_releases', False)
+
+    if deduplicate:
+        dedup.deduplicate()
 
 
 @signals.register
@@ -122,20 +182,106 @@ def link_shared_files(release_name=None):
         target_abspath = os.path.join(env.shared_root, target)
         link_path = os.path.join(release_path, link_path)
 
-        run("ln -s {target} {link_path}".format(
+        run("ln -sfn {target} {link_path}".format(
             target=target_abspath, link_path=link_path))
 
 
 @signals.register
-def activate_release(release_name=None):
+def warm_release(release_name=None, timeout=None):
+    """
+    Run the ``warm_commands`` in the directory of the given release and request
+    the ``warm_urls``, aborting if any of them fails or if the whole warm-up
+    takes more than ``timeout`` seconds. Return the time spent warming up.
+
+    The steps are run in a single command, each one in its own subshell, and
+    the whole command is killed once the time budget is exceeded.
+
+    The ``new_current`` symlink in the project root is made to point to the
+    release while it's being warmed so that a side vhost can serve it.
+
+    If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
+
+    Arguments:
+        release_name -- The name of the release (usually a date like YmdHMS)
+        timeout -- The time budget in seconds (default ``warm_timeout`` env
+        variable or 60)
+    """
+    if timeout is None:
+        timeout = env.get('warm_timeout', DEFAULT_WARM_TIMEOUT)
+
+    release_path = get_release_path(release_name)
+    steps = list(env.get('warm_commands', []))
+    steps.extend(
+        "curl -sSf -o /dev/null {url}".format(url=url)
+        for url in env.get('warm_urls', [])
+    )
+
+    start = time.time()
+
+    with cd(env.project_root):
+        run("ln -sfn {target} new_current".format(target=release_path))
+
+    if steps:
+        # Run all the steps in a single script so that the whole warm-up is
+        # killed once the time budget is exceeded. Each step runs in a
+        # subshell from the release directory and is preceded by a marker
+        # telling which step failed
+        script = '\n'.join(
+            "echo {marker}{index}\n(\n{step}\n) || exit $?".format(
+                marker=WARM_STEP_MARKER, index=index, step=step)
+            for index, step in enumerate(steps)
+        )
+        remaining = timeout - (time.time() - start)
+
+        with nested(cd(release_path), settings(warn_only=True)):
+            result = run(
+                'timeout {remaining:.1f} bash -c "$(echo {script} | base64 -d)"'
+                .format(remaining=max(remaining, 0.1),
+                        script=base64.b64encode(script.encode('utf-8'))
+                        .decode('ascii'))
+            )
+
+        if result.failed:
+            with cd(env.project_root):
+                run("rm -f new_current")
+
+            started = [line.strip()[len(WARM_STEP_MARKER):]
+                       for line in result.splitlines()
+                       if line.startswith(WARM_STEP_MARKER)]
+            step = steps[int(started[-1])] if started else steps[0]
+
+            abort("Warm-up of release {release} failed on `{step}`{reason}"
+                  .format(release=release_path, step=step,
+                          reason=(" (time budget of %ss exceeded)" % timeout
+                                  if result.return_code == 124 else "")))
+
+    return time.time() - start
+
+
+@signals.register
+def activate_release(release_name=None, warm=None):
     """
     Activate the given release by making the ``current`` symlink point to it.
 
+    If ``warm`` is True, the release is warmed with :py:func:`warm_release`
+    before the symlink is switched, and the switch only happens if the warm-up
+    succeeded. The warm-up and switch durations are then printed and returned
+    as a dictionary ``{'warm': seconds, 'switch': seconds}``.
+
     If ``release_name is`` not given, try to get it from :py:attr:`fabric.api.env.release_name`.
 
     Arguments:
         release_name -- The name of the release (usually a date like YmdHMS)
+        warm -- Whether to warm the release before activating it (default
+        ``warm_release`` env variable or False)
     """
+    if warm is None:
+        warm = env.get('warm_release', False)
+
+    durations = {}
+    if warm:
+        durations['warm'] = warm_release(release_name)
+
     logger.debug("""
 
               ~ RELEASE THE KRAKEN!!! ~
@@ -159,11 +305,23 @@ def activate_release(release_name=None):
              `      '-;         (-'
     """)
 
+    start = time.time()
+
     with cd(env.project_root):
-        run("ln -s {target} new_current".format(
-            target=get_release_path(release_name)))
+        # new_current can be left over from a previous warm-up, in which case
+        # it must be replaced rather than followed
+        if not warm:
+            run("ln -sfn {target} new_current".format(
+                target=get_release_path(release_name)))
         run("mv -Tf new_current current")
 
+    if warm:
+        durations['switch'] = time.time() - start
+        print("Warm-up took {warm:.2f}s, switch took {switch:.2f}s".format(
+            **durations))
+
+        return durations
+
 
 @signals.register
 def clean_old_releases(keep=5):
@@ -171,6 +329,9 @@ def clean_old_releases(keep=5):
     Remove the old release directories from the releases directory, keeping x
     releases defined by the ``keep`` parameter.
 
+    If the release cache is enabled, it's pruned once the releases are removed
+    so that the trees of the kept releases stay in the cache.
+
     Arguments:
         keep -- The number of releases to keep
     """
@@ -182,6 +343,12 @@ def clean_old_releases(keep=5):
         if status.return_code != 0:
             logger.debug("Failed with status code [%s]" % status.return_code)
             result = False
+        else:
+            _update_timeline(removed=[release])
+
+    if release_cache.is_enabled():
+        release_cache.prune()
+
     return result
 
 
@@ -194,17 +361,120 @@ def invalidate_last_release():
     run("mv {release} {release}{suffix}".format(
         release=get_release_path(last_release),
         suffix=FAILED_RELEASE_SUFFIX))
+    _update_timeline(removed=[last_release])
+
+
+@signals.register
+def rollback(restore_database=None, invalidate=True):
+    """
+    Switch the ``current`` symlink back to the release preceding the current
+    one and update the VERSION file accordingly, in a single command. The
+    version is taken from the release name (the part after the first ``_``).
+    Return a dictionary with the ``from`` and ``to`` release names and the
+    time spent in seconds.
+
+    Arguments:
+        restore_database -- Optional callable to revert the database once the
+        code has been rolled back. It's given the name of the release being
+        rolled back, eg. ``lambda release: pgsql.restore_snapshot('mydb',
+        release)``
+        invalidate -- Whether to invalidate the rolled back release so that it
+        won't be a target for a future rollback (default True)
+    """
+    start = time.time()
+
+    with hide('commands'):
+        output = run("""set -e
+            cd {releases_root}
+            current=$(basename "$(readlink {project_root}/current)")
+            target=$(ls -1 | grep -v '{suffix}$' | sort | awk -v current="$current" '$0 == current {{ print previous; exit }} {{ previous = $0 }}')
+            test -n "$target"
+            cd {project_root}
+            ln -sfn {releases_root}/$target new_current
+            mv -Tf new_current current
+            echo "${{target#*_}}" > VERSION
+            {invalidate}
+            echo "$current $target"
+        """.format(
+            releases_root=env.releases_root,
+            project_root=env.project_root,
+            suffix=FAILED_RELEASE_SUFFIX,
+            invalidate=('mv {releases_root}/$current {releases_root}/${{current}}{suffix}'
+                        .format(releases_root=env.releases_root,
+                                suffix=FAILED_RELEASE_SUFFIX)
+                        if invalidate else ''),
+        ))
+
+    current_release, target_release = output.splitlines()[-1].split()
+    if invalidate:
+        _update_timeline(removed=[current_release])
+
+    result = {
+        'from': current_release,
+        'to': target_release,
+        'code': time.time() - start,
+    }
+
+    if restore_database is not None:
+        restore_database(current_release)
+        result['database'] = time.time() - start - result['code']
+
+    print("Rolled back from {from} to {to}: code in {code:.2f}s{database}"
+          .format(database=(", database in {database:.2f}s".format(**result)
+                            if 'database' in result else ''),
+                  **result))
+
+    return result
 
 
 def get_releases():
     """
     Return the list of releases on the server, sorted by oldest to newest.
     """
-    return filter(
+    releases = filter(
         lambda f: not f.endswith(FAILED_RELEASE_SUFFIX),
         sorted(ls(os.path.join(env.releases_root)))
     )
 
+    timeline = _timelines.get((env.host_string, env.releases_root))
+    if timeline is not None:
+        timeline.update(releases)
+
+    return releases
+
+
+def get_timeline(refresh=False):
+    """
+    Return the :py:class:`~fabliip.timeline.ReleaseTimeline` of the releases
+    on the server. The releases are only listed the first time for each host,
+    the timeline being then updated as releases are created, removed and
+    invalidated with the functions of this module.
+
+    Arguments:
+        refresh -- Whether to list the releases again, eg. if they were changed
+        by something else than this module
+    """
+    key = (env.host_string, env.releases_root)
+
+    if key not in _timelines:
+        _timelines[key] = ReleaseTimeline(get_releases())
+    elif refresh:
+        get_releases()
+
+    return _timelines[key]
+
+
+def _update_timeline(added=(), removed=()):
+    timeline = _timelines.get((env.host_string, env.releases_root))
+    if timeline is None:
+        return
+
+    for release in added:
+        timeline.add(release)
+
+    for release in removed:
+        timeline.remove(release)
+
 
 def get_currently_installed_version():
     """
@@ -24,6 +24,13 @@ You can also emit signals independently::
         deploy_my_app()
         signals.emit('hurray_my_app_is_deployed')
 
+Use the ``on_any`` decorator to receive every signal along with its name, eg.
+to log or measure the steps of your deployment::
+
+    @signals.on_any
+    def log_signal(signal):
+        print("Received %s" % signal)
+
 The :py:func:`task` decorator wraps the default :py:func:`fabric.api.task`
 decorator with the :py:func:`register` signal, allowing you to intercept
 pre/post signals without the need of adding the :py:func:`register` decorator
@@ -31,17 +38,20 @@ or firing the signals yourself.
 """
 
 from collections import defaultdict
-from functools import wraps
-import inspect
+from functools import partial, wraps
 import logging
 
 from fabric.api import task as fabric_task
 
+from . import profiling
+
 
 logger = logging.getLogger(__name__)
 
 
 _callbacks = defaultdict(list)
+_any_callbacks = []
+_interceptors = []
 
 
 def emit(signal):
@@ -51,10 +61,16 @@ def emit(signal):
     logger.debug("Emit signal %s" % signal)
 
     for callback in _callbacks[signal]:
-        logger.debug("Execute function %s from %s" % (callback.__name__, inspect.getfile(callback)))
+        if logger.isEnabledFor(logging.DEBUG):
+            import inspect
+            logger.debug("Execute function %s from %s" % (callback.__name__, inspect.getfile(callback)))
         callback()
 
+    for callback in _any_callbacks:
+        callback(signal)
+
 
+@profiling.timed('signals.register')
 def register(function):
     """
     Decorator that will emit pre and post signals before and after the
@@ -66,19 +82,27 @@ def register(function):
     """
     @wraps(function)
     def wrapper(*args, **kwargs):
-        emit("{module}.pre_{function}".format(
-            module=function.__module__,
-            function=function.__name__
-        ))
+        def call():
+            emit("{module}.pre_{function}".format(
+                module=function.__module__,
+                function=function.__name__
+            ))
 
-        return_value = function(*args, **kwargs)
+            return_value = function(*args, **kwargs)
 
-        emit("{module}.post_{function}".format(
-            module=function.__module__,
-            function=function.__name__
-        ))
+            emit("{module}.post_{function}".format(
+                module=function.__module__,
+                function=function.__name__
+            ))
 
-        return return_value
+            return return_value
+
+        name = "{module}.{function}".format(module=function.__module__,
+                                            function=function.__name__)
+        for interceptor in reversed(_interceptors):
+            call = partial(interceptor, name, call)
+
+        return call()
 
     return wrapper
 
@@ -97,6 +121,36 @@ def on(signal):
     return wrapper
 
 
+def on_any(function):
+    """
+    Decorator that will call the given function with the name of the signal
+    every time a signal is emitted.
+    """
+    if function not in _any_callbacks:
+        _any_callbacks.append(function)
+
+    return function
+
+
+def intercept(function):
+    """
+    Decorator that will call the given function in place of every function
+    decorated with :py:func:`register`. It's given the dotted name of the
+    decorated function and a callable that executes it (along with its pre and
+    post signals) and returns its return value, eg.::
+
+        @signals.intercept
+        def skip_cache_clear(name, call):
+            if name != 'fabliip.drupal.clear_cache':
+                return call()
+    """
+    if function not in _interceptors:
+        _interceptors.append(function)
+
+    return function
+
+
+@profiling.timed('signals.task')
 def task(function):
     """
     Convenience decorator that wraps the default Fabric task decorator with the
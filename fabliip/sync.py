@@ -0,0 +1,364 @@
+"""
+Delta synchronization of the shared files between hosts.
+
+The ``shared_root`` directory (media, uploaded files, etc) is not part of the
+releases and needs to be kept consistent between the web nodes. The
+:py:func:`sync_shared_files` task builds a manifest of the files (size, mtime
+and hash) on the source and on each target host, and only transfers the files
+that are missing or different on the targets.
+
+The hashes are kept in an index file in the synchronized directory, so that
+only new or modified files are hashed when the manifest is built again.
+
+The files are streamed from the source to the targets through the machine
+running Fabric (``tar`` over ``ssh``), split between several parallel workers,
+and the throughput can be capped. Endpoints are given as ``host:/path``, or as a
+plain ``/path`` for a local directory, which allows to run the synchronization
+between local stand-in directories::
+
+    sync('/tmp/source/shared', ['/tmp/target/shared'], workers=2)
+"""
+import subprocess
+import sys
+import threading
+import time
+
+from fabric import api
+from fabric.network import normalize
+
+from . import metrics
+from .utils import get_python_command, iter_run_lines
+
+
+INDEX_FILE = '.sync_index.json'
+DEFAULT_WORKERS = 4
+CHUNK_SIZE = 65536
+
+
+MANIFEST_SCRIPT = """
+import hashlib
+import json
+import os
+import stat
+import sys
+
+root, index_name = sys.argv[1:3]
+index_path = os.path.join(root, index_name)
+
+try:
+    with open(index_path) as f:
+        index = json.load(f)
+except (IOError, ValueError):
+    index = {}
+
+new_index = {}
+
+for dirpath, dirnames, filenames in os.walk(root):
+    for name in filenames:
+        path = os.path.join(dirpath, name)
+        relpath = os.path.relpath(path, root)
+        st = os.lstat(path)
+
+        if not stat.S_ISREG(st.st_mode) or relpath == index_name:
+            continue
+
+        key = [st.st_size, int(st.st_mtime), st.st_ino]
+        entry = index.get(relpath)
+
+        if entry is not None and entry[:3] == key:
+            digest = entry[3]
+        else:
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+
+        new_index[relpath] = key + [digest]
+        sys.stdout.write('%s %d %d %s' % (digest, key[0], key[1], relpath))
+        sys.stdout.write(os.linesep)
+
+try:
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(new_index, f)
+    os.rename(index_path + '.tmp', index_path)
+except (IOError, OSError):
+    pass
+"""
+
+
+def parse_endpoint(endpoint):
+    """
+    Return a tuple ``(host, path)`` for the given ``host:/path`` endpoint, host
+    being None for local paths.
+    """
+    if endpoint.startswith('/'):
+        return None, endpoint
+
+    host, separator, path = endpoint.rpartition(':/')
+
+    return host, '/' + path
+
+
+def get_shell_command(host, command, ssh_options=()):
+    """
+    Return the argument list to run the given shell command on the given host,
+    or locally if host is None. ``ssh_options`` is a list of additional
+    ``-o`` options given to ``ssh``, eg. ``['BatchMode=yes']``.
+    """
+    if host is None:
+        return ['/bin/sh', '-c', command]
+
+    user, hostname, port = normalize(host)
+    ssh_command = ['ssh', '-p', str(port), '-l', user]
+    for option in ssh_options:
+        ssh_command += ['-o', option]
+
+    key_filename = api.env.key_filename
+    if isinstance(key_filename, (list, tuple)):
+        key_filename = key_filename[0] if key_filename else None
+    if key_filename:
+        ssh_command += ['-i', key_filename]
+
+    return ssh_command + [hostname, command]
+
+
+def get_manifest(endpoint):
+    """
+    Return the manifest of the given endpoint as a dictionary
+    ``{relative_path: (size, mtime, hash)}``.
+    """
+    host, path = parse_endpoint(endpoint)
+    manifest = {}
+
+    if host is None:
+        process = subprocess.Popen(
+            [sys.executable, '-', path, INDEX_FILE], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        process.stdin.write(MANIFEST_SCRIPT.encode('utf-8'))
+        process.stdin.close()
+        lines = (line.decode('utf-8').rstrip('\n')
+                 for line in iter(process.stdout.readline, b''))
+    else:
+        process = None
+        with api.settings(api.hide('commands'), host_string=host):
+            remote_lines = iter_run_lines(get_python_command(
+                MANIFEST_SCRIPT, path, INDEX_FILE))
+        # Decode the paths the same way as the local ones so that both
+        # manifests have the same keys
+        lines = (line.decode('utf-8') if isinstance(line, bytes) else line
+                 for line in remote_lines)
+
+    for line in lines:
+        if not line:
+            continue
+
+        digest, size, mtime, relpath = line.split(' ', 3)
+        manifest[relpath] = (int(size), int(mtime), digest)
+
+    if process is not None and process.wait() != 0:
+        raise Exception("Couldn't build the manifest of {endpoint}".format(
+            endpoint=endpoint))
+
+    return manifest
+
+
+def diff_manifests(source_manifest, target_manifest):
+    """
+    Return a tuple ``(to_transfer, to_delete)`` of the lists of files that
+    differ between the source and target manifests.
+    """
+    to_transfer = sorted(
+        path for path, (size, mtime, digest) in source_manifest.iteritems()
+        if path not in target_manifest
+        or target_manifest[path][0] != size
+        or target_manifest[path][2] != digest
+    )
+    to_delete = sorted(set(target_manifest) - set(source_manifest))
+
+    return to_transfer, to_delete
+
+
+def split_files(files, manifest, workers):
+    """
+    Split the given files in ``workers`` lists of roughly the same total size.
+    """
+    chunks = [[] for i in range(workers)]
+    sizes = [0] * workers
+
+    for path in sorted(files, key=lambda path: -manifest[path][0]):
+        smallest = sizes.index(min(sizes))
+        chunks[smallest].append(path)
+        sizes[smallest] += manifest[path][0]
+
+    return [chunk for chunk in chunks if chunk]
+
+
+def transfer(source, target, files, bwlimit=None):
+    """
+    Copy the given files from the source endpoint to the target endpoint with
+    ``tar``, capping the throughput to ``bwlimit`` bytes per second if given.
+    Return the number of bytes transferred.
+    """
+    source_host, source_path = parse_endpoint(source)
+    target_host, target_path = parse_endpoint(target)
+
+    reader = subprocess.Popen(
+        get_shell_command(source_host, "tar cf - -C '{path}' --null -T -"
+                          .format(path=source_path)),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    writer = subprocess.Popen(
+        get_shell_command(target_host, "mkdir -p '{path}' && tar xf - -C '{path}'"
+                          .format(path=target_path)),
+        stdin=subprocess.PIPE
+    )
+
+    # Feed the file list from another thread since tar starts writing the
+    # archive before it has read the whole list. The list is always closed so
+    # that tar doesn't wait for it forever if writing it fails
+    errors = []
+
+    def write_file_list():
+        try:
+            reader.stdin.write(b'\0'.join(path.encode('utf-8')
+                                           for path in files))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            reader.stdin.close()
+
+    file_list_writer = threading.Thread(target=write_file_list)
+    file_list_writer.start()
+
+    start = time.time()
+    transferred = 0
+
+    for chunk in iter(lambda: reader.stdout.read(CHUNK_SIZE), b''):
+        writer.stdin.write(chunk)
+        transferred += len(chunk)
+
+        if bwlimit:
+            delay = transferred / float(bwlimit) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    writer.stdin.close()
+    file_list_writer.join()
+
+    if errors:
+        writer.wait()
+        reader.wait()
+        raise errors[0]
+
+    if reader.wait() != 0 or writer.wait() != 0:
+        raise Exception("Transfer from {source} to {target} failed".format(
+            source=source, target=target))
+
+    return transferred
+
+
+def delete(target, files):
+    """
+    Delete the given files from the target endpoint.
+    """
+    host, path = parse_endpoint(target)
+
+    process = subprocess.Popen(
+        get_shell_command(host, "cd '{path}' && xargs -0 rm -f".format(
+            path=path)),
+        stdin=subprocess.PIPE
+    )
+    process.communicate(b'\0'.join(path.encode('utf-8') for path in files))
+
+    if process.returncode != 0:
+        raise Exception("Couldn't delete files from {target}".format(
+            target=target))
+
+
+def sync(source, targets, workers=DEFAULT_WORKERS, bwlimit=None,
+         delete_missing=False, dry_run=False):
+    """
+    Synchronize the files of the source endpoint to the target endpoints,
+    transferring only the files that are missing or different on the targets.
+    Return a dictionary ``{target: {'transferred': files, 'deleted': files,
+    'bytes': bytes}}``.
+
+    Arguments:
+        source -- The source endpoint (``host:/path`` or ``/path``)
+        targets -- The list of target endpoints
+        workers -- The number of parallel transfers per target
+        bwlimit -- The maximum throughput in bytes per second per target
+        (default no limit)
+        delete_missing -- Whether to delete files from the targets if they
+        don't exist on the source (default False)
+        dry_run -- Only compute the differences without transferring anything
+    """
+    source_manifest = get_manifest(source)
+    results = {}
+
+    for target in targets:
+        to_transfer, to_delete = diff_manifests(source_manifest,
+                                                get_manifest(target))
+        if not delete_missing:
+            to_delete = []
+
+        results[target] = {
+            'transferred': to_transfer,
+            'deleted': to_delete,
+            'bytes': 0,
+        }
+        print("{target}: {transfer} files to transfer, {delete} files to"
+              " delete".format(target=target, transfer=len(to_transfer),
+                               delete=len(to_delete)))
+
+        if dry_run:
+            continue
+
+        chunks = split_files(to_transfer, source_manifest, workers)
+        transferred = []
+        errors = []
+
+        def transfer_chunk(chunk):
+            try:
+                transferred.append(transfer(
+                    source, target, chunk,
+                    bwlimit / len(chunks) if bwlimit else None
+                ))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=transfer_chunk, args=(chunk,))
+                   for chunk in chunks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        results[target]['bytes'] = sum(transferred)
+        metrics.increment('fabliip_sync_transferred_bytes_total',
+                          results[target]['bytes'], target=target)
+
+        if to_delete:
+            delete(target, to_delete)
+
+    return results
+
+
+def sync_shared_files(source_host, target_hosts, **kwargs):
+    """
+    Synchronize the ``shared_root`` directory from the source host to the
+    target hosts. See :py:func:`sync` for the other arguments.
+
+    Requires the `shared_root` environment variable to be set.
+    """
+    return sync(
+        '{host}:{path}'.format(host=source_host, path=api.env.shared_root),
+        ['{host}:{path}'.format(host=host, path=api.env.shared_root)
+         for host in target_hosts],
+        **kwargs
+    )
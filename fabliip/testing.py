@@ -0,0 +1,325 @@
+"""
+Helpers to run fabliip functions against a local stand-in host.
+
+The :py:class:`LocalHost` context manager replaces the transport used by
+:py:func:`fabric.api.run` and :py:func:`fabric.api.sudo` so that the commands
+are executed by a local shell instead of being sent over SSH. Everything else
+(``cd``, ``shell_env``, ``prefix``, ``warn_only``, ``quiet``, etc) behaves as
+usual, which makes it possible to exercise the deployment functions in a
+temporary directory::
+
+    from fabric.api import env
+    from fabliip import releases
+    from fabliip.testing import LocalHost
+
+    env.releases_root = '/tmp/mysite/releases'
+    env.repository_root = '/tmp/mysite/repository.git'
+
+    with LocalHost() as host:
+        releases.create_release('1.0.0', '20140830180015_1.0.0')
+
+    print(host.stats())
+
+Every command is recorded along with its duration and the number of bytes sent
+and received, so the stand-in can also be used to measure what a task costs.
+
+Note that ``sudo`` commands are run as the current user.
+
+The stand-in can also record the commands without executing them by setting
+``dry_run`` to True. Each command then returns the output of the first matching
+pattern of ``responses`` (or an empty string), which is enough to count the
+round trips issued by a task. :py:func:`assert_round_trips` builds on that to
+fail when a task exceeds a round-trip budget::
+
+    from fabliip.testing import assert_round_trips
+
+    def test_activate_release_round_trips():
+        with assert_round_trips(2):
+            releases.activate_release('20140830180015_1.2.3')
+
+Commands run with :py:func:`fabric.api.local` are not round trips and are not
+recorded.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import re
+import subprocess
+import sys
+import time
+
+from fabric import api, operations
+from fabric.utils import error
+
+
+DEFAULT_SHELL = '/bin/bash -c'
+
+
+class LocalHost(object):
+    """
+    Context manager executing the remote commands on the local machine.
+
+    Arguments:
+        host_string -- The value of ``env.host_string`` to use while the stand-in
+        is active (default localhost)
+        path -- A list of directories to prepend to the ``PATH`` of the
+        executed commands, eg. to provide fake ``drush`` or ``mysqldump``
+        executables
+        dry_run -- Record the commands without executing them (default False)
+        responses -- A list of ``(pattern, output)`` tuples used to answer
+        commands in dry run mode. ``output`` can also be a tuple ``(output,
+        return_code)``. The first pattern found in the command wins.
+        shell -- The shell the commands are wrapped in, quoted the same way
+        as Fabric does (default ``/bin/bash -c``, the login profile of the
+        local user being unrelated to the one of the remote host)
+    """
+    def __init__(self, host_string='localhost', path=None, dry_run=False,
+                 responses=None, shell=DEFAULT_SHELL):
+        self.host_string = host_string
+        self.shell = shell
+        self.path = path or []
+        self.dry_run = dry_run
+        self.responses = [
+            (re.compile(pattern), response)
+            for pattern, response in (responses or [])
+        ]
+        self.commands = []
+        self._original_run_command = None
+        self._settings = None
+
+    def __enter__(self):
+        self._original_run_command = operations._run_command
+        operations._run_command = self._run_command
+        self._settings = api.settings(host_string=self.host_string,
+                                      shell=self.shell)
+        self._settings.__enter__()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self._settings.__exit__(*exc_info)
+        operations._run_command = self._original_run_command
+
+    def _get_environment(self):
+        environment = dict(os.environ)
+
+        if self.path:
+            environment['PATH'] = os.pathsep.join(
+                self.path + [environment.get('PATH', '')]
+            )
+
+        return environment
+
+    def execute(self, command, stdout=None, capture_buffer_size=None):
+        """
+        Execute the given (already wrapped) command in a local shell and return
+        a tuple ``(stdout, stderr, return_code)``.
+        """
+        process = subprocess.Popen(
+            ['/bin/bash', '-c', command], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, env=self._get_environment()
+        )
+
+        if stdout is None:
+            result_stdout, result_stderr = process.communicate()
+        else:
+            # Stream the output to the given file-like object as it arrives,
+            # the same way Fabric does for remote commands
+            captured = []
+            captured_size = 0
+
+            for line in iter(process.stdout.readline, b''):
+                stdout.write(line)
+                captured.append(line)
+                captured_size += len(line)
+
+                while (capture_buffer_size is not None and captured
+                       and captured_size > capture_buffer_size):
+                    captured_size -= len(captured.pop(0))
+
+            result_stdout = b''.join(captured)
+            result_stderr = process.stderr.read()
+            process.wait()
+
+        return (result_stdout.strip(), result_stderr.strip(),
+                process.returncode)
+
+    def get_response(self, command):
+        """
+        Return the ``(stdout, stderr, return_code)`` tuple answering the given
+        command (as given to ``run``, before it's wrapped in the shell) in dry
+        run mode.
+        """
+        for pattern, response in self.responses:
+            if pattern.search(command):
+                if isinstance(response, tuple):
+                    return response[0], '', response[1]
+
+                return response, '', 0
+
+        return '', '', 0
+
+    def _run_command(self, command, shell=True, pty=True, combine_stderr=True,
+                     sudo=False, user=None, quiet=False, warn_only=False,
+                     stdout=None, stderr=None, group=None, timeout=None,
+                     shell_escape=None, capture_buffer_size=None):
+        """
+        Replacement for :py:func:`fabric.operations._run_command`.
+        """
+        manager = operations._noop
+        if warn_only:
+            manager = operations.warn_only_manager
+        if quiet:
+            manager = operations.quiet_manager
+
+        with manager():
+            if shell_escape is None:
+                shell_escape = api.env.get('shell_escape', True)
+
+            # Wrap the command in the shell the same way Fabric does, so that
+            # it's quoted as it would be on a remote host. The sudo prefix is
+            # left out since the commands are run as the current user
+            wrapped_command = operations._shell_wrap(
+                operations._prefix_env_vars(
+                    operations._prefix_commands(command, 'remote')
+                ),
+                shell_escape,
+                shell,
+            )
+
+            start = time.time()
+            if self.dry_run:
+                result_stdout, result_stderr, status = self.get_response(
+                    command)
+                if stdout is not None and result_stdout:
+                    stdout.write(result_stdout + '\n')
+            else:
+                result_stdout, result_stderr, status = self.execute(
+                    wrapped_command, stdout, capture_buffer_size
+                )
+            duration = time.time() - start
+
+            self.commands.append({
+                'command': command,
+                'caller': get_caller(),
+                'sudo': sudo,
+                'return_code': status,
+                'duration': duration,
+                'bytes_sent': len(wrapped_command),
+                'bytes_received': len(result_stdout) + len(result_stderr),
+            })
+
+            out = operations._AttributeString(result_stdout)
+            err = operations._AttributeString(result_stderr)
+
+            out.failed = False
+            out.command = command
+            out.real_command = wrapped_command
+            if status not in api.env.ok_ret_codes:
+                out.failed = True
+                msg = "%s() received nonzero return code %s while executing" % (
+                    'sudo' if sudo else 'run', status
+                )
+                if api.env.warn_only:
+                    msg += " '%s'!" % command
+                else:
+                    msg += "!\n\nRequested: %s\nExecuted: %s" % (
+                        command, wrapped_command
+                    )
+                error(message=msg, stdout=out, stderr=err)
+
+            out.return_code = status
+            out.succeeded = not out.failed
+            out.stderr = err
+
+            return out
+
+    def reset(self):
+        """
+        Forget the commands recorded so far.
+        """
+        self.commands = []
+
+    def stats(self):
+        """
+        Return a dictionary summarizing the commands recorded so far: number
+        of commands, total time spent executing them and bytes sent and
+        received.
+        """
+        return {
+            'commands': len(self.commands),
+            'duration': sum(c['duration'] for c in self.commands),
+            'bytes_sent': sum(c['bytes_sent'] for c in self.commands),
+            'bytes_received': sum(c['bytes_received'] for c in self.commands),
+        }
+
+    def report(self, rtt=0.05):
+        """
+        Return a cost report of the commands recorded so far, with the
+        estimated latency they add up to for the given round-trip time (in
+        seconds) and the number of round trips issued by each fabliip function.
+        """
+        by_caller = defaultdict(int)
+        for command in self.commands:
+            by_caller[command['caller']] += 1
+
+        return {
+            'round_trips': len(self.commands),
+            'rtt': rtt,
+            'estimated_latency': len(self.commands) * rtt,
+            'by_caller': dict(by_caller),
+            'commands': [command['command'] for command in self.commands],
+        }
+
+
+class RoundTripBudgetExceeded(AssertionError):
+    pass
+
+
+def get_caller():
+    """
+    Return the dotted name of the outermost fabliip function in the current
+    call stack, eg. ``fabliip.releases.clean_old_releases``, or None if the
+    command wasn't issued through fabliip. The decorators of
+    :py:mod:`fabliip.signals` and the private functions are skipped.
+    """
+    caller = None
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if (module.startswith('fabliip.')
+                and module not in (__name__, 'fabliip.signals')
+                and frame.f_code.co_name != 'wrapper'
+                and not frame.f_code.co_name.startswith('_')):
+            caller = '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+
+    return caller
+
+
+@contextmanager
+def assert_round_trips(budget, rtt=0.05, **kwargs):
+    """
+    Context manager that records the commands issued in its block and raises
+    :py:class:`RoundTripBudgetExceeded` if they exceed the given number of round
+    trips. The commands are not executed unless ``dry_run=False`` is given.
+    Other keyword arguments are passed to :py:class:`LocalHost`.
+    """
+    kwargs.setdefault('dry_run', True)
+
+    with LocalHost(**kwargs) as host:
+        yield host
+
+    report = host.report(rtt)
+    if report['round_trips'] > budget:
+        raise RoundTripBudgetExceeded(
+            "{round_trips} round trips issued (~{latency:.2f}s at {rtt}s RTT),"
+            " budget is {budget}:\n{commands}".format(
+                round_trips=report['round_trips'],
+                latency=report['estimated_latency'],
+                rtt=rtt,
+                budget=budget,
+                commands='\n'.join(report['commands']),
+            )
+        )
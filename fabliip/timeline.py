@@ -0,0 +1,273 @@
+"""
+Sorted index of the releases by date and version.
+
+Release names are made of the date of the release and the deployed version,
+eg. ``20140830180015_1.2.3``. A :py:class:`ReleaseTimeline` parses the names once
+and keeps them sorted by date and by version, so that questions such as "which
+release was the most recent at 14:05", "the last release of 3.2" or "the 3
+releases before this one" are answered with a binary search instead of a scan
+of the releases::
+
+    from datetime import datetime
+    from fabliip import releases
+
+    timeline = releases.get_timeline()
+    timeline.at(datetime(2014, 8, 30, 14, 5))
+    timeline.latest('3.2')
+    timeline.before('20140830180015_1.2.3', 3)
+
+The timeline of the current host is built by
+:py:func:`fabliip.releases.get_timeline` and kept up to date as releases are
+created, removed and invalidated.
+
+Versions are compared part by part, numeric parts as numbers (``1.10`` comes
+after ``1.9``) and other parts as strings, which come after the numbers. Dates
+are compared in the timezone the release names were generated in, and the names
+that don't start with a date are ignored.
+"""
+import bisect
+from datetime import datetime
+import re
+
+
+RELEASE_NAME_PATTERN = re.compile(r'^(\d{14})_(.+)$')
+DATE_FORMAT = '%Y%m%d%H%M%S'
+
+# Sorts after any version part
+_VERSION_PART_MAX = (2, '')
+
+
+def parse_release_name(name):
+    """
+    Return a tuple ``(date, version)`` for the given release name, the date
+    being an integer such as ``20140830180015``, or None if the name isn't
+    made of a date and a version.
+    """
+    match = RELEASE_NAME_PATTERN.match(name)
+    if match is None:
+        return None
+
+    return int(match.group(1)), match.group(2)
+
+
+def get_version_key(version):
+    """
+    Return the sort key of the given version, eg. ``((0, 1), (0, 10), (1,
+    'rc1'))`` for ``1.10-rc1``.
+    """
+    return tuple(
+        (0, int(part)) if part.isdigit() else (1, part)
+        for part in re.split(r'[._+-]', version) if part
+    )
+
+
+def get_date_key(date):
+    """
+    Return the integer date used in the timeline for the given
+    :py:class:`datetime.datetime`, ``YmdHMS`` string or integer.
+    """
+    if isinstance(date, datetime):
+        return int(date.strftime(DATE_FORMAT))
+
+    return int(date)
+
+
+class ReleaseTimeline(object):
+    """
+    Releases sorted by date and by version.
+
+    Arguments:
+        names -- The names of the releases. The names that can't be parsed
+        are ignored
+    """
+    def __init__(self, names=()):
+        # (date, name) tuples sorted by date, and their dates for the lookups
+        # by date
+        self._releases = []
+        self._dates = []
+        # (version key, date, name) tuples sorted by version
+        self._versions = []
+        # {name: (date, version key)}
+        self._index = {}
+
+        self.update(names)
+
+    def __len__(self):
+        return len(self._releases)
+
+    def __iter__(self):
+        return (name for date, name in self._releases)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, position):
+        """
+        Return the name of the release at the given position (or the list of
+        names for a slice), from oldest to newest.
+        """
+        if isinstance(position, slice):
+            return [name for date, name in self._releases[position]]
+
+        return self._releases[position][1]
+
+    def add(self, name):
+        """
+        Add the given release to the timeline. Return False if the name can't
+        be parsed or is already part of the timeline.
+        """
+        parsed = parse_release_name(name)
+        if parsed is None or name in self._index:
+            return False
+
+        date, version = parsed
+        version_key = get_version_key(version)
+        position = bisect.bisect_left(self._releases, (date, name))
+
+        self._releases.insert(position, (date, name))
+        self._dates.insert(position, date)
+        bisect.insort(self._versions, (version_key, date, name))
+        self._index[name] = (date, version_key)
+
+        return True
+
+    def remove(self, name):
+        """
+        Remove the given release from the timeline. Return False if it's not
+        part of the timeline.
+        """
+        if name not in self._index:
+            return False
+
+        date, version_key = self._index.pop(name)
+        position = bisect.bisect_left(self._releases, (date, name))
+        del self._releases[position]
+        del self._dates[position]
+        del self._versions[bisect.bisect_left(self._versions,
+                                              (version_key, date, name))]
+
+        return True
+
+    def update(self, names):
+        """
+        Make the timeline contain exactly the given releases, only adding and
+        removing the releases that changed.
+        """
+        names = set(names)
+
+        for name in set(self._index) - names:
+            self.remove(name)
+
+        new_names = names - set(self._index)
+        if len(new_names) > len(self._releases):
+            # Sort once rather than inserting the releases one by one
+            self._rebuild(list(self) + list(new_names))
+        else:
+            for name in new_names:
+                self.add(name)
+
+    def _rebuild(self, names):
+        parsed = []
+        for name in names:
+            date_version = parse_release_name(name)
+            if date_version is not None:
+                parsed.append((name,) + date_version)
+
+        self._releases = sorted((date, name) for name, date, version in parsed)
+        self._dates = [date for date, name in self._releases]
+        self._versions = sorted(
+            (get_version_key(version), date, name)
+            for name, date, version in parsed
+        )
+        self._index = dict(
+            (name, (date, version_key))
+            for version_key, date, name in self._versions
+        )
+
+    def index(self, name):
+        """
+        Return the position of the given release, from oldest to newest.
+        Raise ValueError if it's not part of the timeline.
+        """
+        if name not in self._index:
+            raise ValueError("{name} is not in the timeline".format(name=name))
+
+        return bisect.bisect_left(self._releases, (self._index[name][0], name))
+
+    def at(self, date):
+        """
+        Return the name of the most recent release made at or before the given
+        date (:py:class:`datetime.datetime`, ``YmdHMS`` string or integer), or
+        None if there's none.
+        """
+        position = bisect.bisect_right(self._dates, get_date_key(date))
+
+        return self._releases[position - 1][1] if position else None
+
+    def between(self, start=None, end=None):
+        """
+        Return the names of the releases made between the given dates
+        (inclusive), from oldest to newest.
+        """
+        first = (bisect.bisect_left(self._dates, get_date_key(start))
+                 if start is not None else 0)
+        last = (bisect.bisect_right(self._dates, get_date_key(end))
+                if end is not None else len(self._dates))
+
+        return self[first:last]
+
+    def in_version_range(self, low=None, high=None):
+        """
+        Return the names of the releases whose version is at least ``low`` and
+        lower than ``high``, sorted by version.
+        """
+        return [name for version_key, date, name
+                in self._versions[self._get_version_slice(low, high)]]
+
+    def latest(self, version=None):
+        """
+        Return the name of the most recent release of the given version or of
+        its sub-versions (eg. ``3.2`` for ``3.2``, ``3.2.1``, etc), or of the
+        most recent release if no version is given. Return None if there's no
+        such release.
+        """
+        if version is None:
+            return self._releases[-1][1] if self._releases else None
+
+        low = get_version_key(version)
+        candidates = self._versions[self._get_version_slice(
+            low, low + (_VERSION_PART_MAX,), keys=True
+        )]
+
+        return max((date, name) for version_key, date, name
+                   in candidates)[1] if candidates else None
+
+    def before(self, name, count=1):
+        """
+        Return the names of the ``count`` releases preceding the given one,
+        from oldest to newest.
+        """
+        position = self.index(name)
+
+        return self[max(0, position - count):position]
+
+    def after(self, name, count=1):
+        """
+        Return the names of the ``count`` releases following the given one,
+        from oldest to newest.
+        """
+        position = self.index(name)
+
+        return self[position + 1:position + 1 + count]
+
+    def _get_version_slice(self, low, high, keys=False):
+        if not keys:
+            low = get_version_key(low) if low is not None else None
+            high = get_version_key(high) if high is not None else None
+
+        return slice(
+            bisect.bisect_left(self._versions, (low,))
+            if low is not None else 0,
+            bisect.bisect_left(self._versions, (high,))
+            if high is not None else len(self._versions)
+        )
@@ -1,4 +1,31 @@
+import base64
+from contextlib import nested
+import pipes
+import subprocess
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 from fabric import api
+from fabric.state import output
+from fabric.utils import abort, warn
+
+
+# Maximum number of lines buffered by iter_run_lines before the remote output
+# stops being read
+STREAM_BUFFER_LINES = 1000
+
+# Number of bytes of output Fabric keeps in the return value of streamed
+# commands (the lines are consumed through the stream instead)
+STREAM_CAPTURE_SIZE = 4096
+
+# Printed after the output of streamed commands, followed by their exit status
+STREAM_STATUS_MARKER = '__FABLIIP_EXIT_STATUS__'
+
+_END_OF_STREAM = object()
 
 
 def local_run_wrapper(*args, **kwargs):
@@ -9,3 +36,178 @@ def local_run_wrapper(*args, **kwargs):
     kwargs['capture'] = True
 
     return api.local(*args, **kwargs)
+
+
+def run_python(script, *args, **kwargs):
+    """
+    Run the given Python script on the remote host in a single command and
+    return its output. The script is sent base64-encoded so that it doesn't
+    need any escaping.
+
+    The interpreter can be set with the `remote_python` environment variable
+    (default python). Other keyword arguments are passed to `run`, or to `sudo`
+    if `use_sudo` is True.
+
+    Arguments:
+        script -- The source code of the script
+        args -- Arguments passed to the script (available in sys.argv[1:])
+    """
+    use_sudo = kwargs.pop('use_sudo', False)
+
+    return (api.sudo if use_sudo else api.run)(
+        get_python_command(script, *args), **kwargs
+    )
+
+
+def get_python_command(script, *args):
+    """
+    Return the shell command used by :py:func:`run_python` to run the given
+    script with the given arguments.
+    """
+    return 'echo {script} | base64 -d | {python} - {args}'.format(
+        script=base64.b64encode(script.encode('utf-8')).decode('ascii'),
+        python=api.env.get('remote_python', 'python'),
+        args=' '.join(pipes.quote(str(arg)) for arg in args),
+    )
+
+
+class _LineQueueWriter(object):
+    """
+    File-like object splitting what's written to it in lines and putting them
+    in the given queue.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.partial_line = ''
+        self.cancelled = False
+
+    def put(self, line):
+        if not self.cancelled:
+            self.lines.put(line.rstrip('\r'))
+
+    def write(self, data):
+        lines = (self.partial_line + data).split('\n')
+        self.partial_line = lines.pop()
+
+        for line in lines:
+            self.put(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.partial_line:
+            self.put(self.partial_line)
+            self.partial_line = ''
+
+
+def iter_run_lines(command, buffer_lines=STREAM_BUFFER_LINES, use_sudo=False):
+    """
+    Run the given command on the remote host and return an iterator over the
+    lines of its output as they arrive, without keeping the whole output in
+    memory. At most ``buffer_lines`` lines are buffered; the output stops being
+    read until the consumer catches up.
+
+    The command is started right away with the current Fabric settings (eg.
+    ``cd`` or ``host_string``), which can then change while the output is read
+    in a separate thread. Aborts the same way as `run` (or `sudo` if `use_sudo`
+    is True) once the output is consumed if the command failed, or only warns
+    if ``warn_only`` was set when the command was started (and warnings were
+    not hidden).
+    """
+    lines = queue.Queue(maxsize=buffer_lines)
+    writer = _LineQueueWriter(lines)
+    result = {}
+
+    # The command is run in a subshell and followed by its exit status, so
+    # that the reading thread never aborts or warns: the failure is handled
+    # by the consumer with the settings the command was started with
+    status_command = '({command}); echo "{marker}$?"'.format(
+        command=command, marker=STREAM_STATUS_MARKER
+    )
+
+    def read_output():
+        try:
+            (api.sudo if use_sudo else api.run)(
+                status_command, stdout=writer,
+                capture_buffer_size=STREAM_CAPTURE_SIZE
+            )
+        except BaseException as e:
+            result['exception'] = e
+        finally:
+            writer.close()
+            lines.put(_END_OF_STREAM)
+
+    thread = threading.Thread(target=read_output)
+    thread.daemon = True
+
+    # Fabric reads the settings (the current directory, the host, the output
+    # prefix, etc) when the command starts and when its output starts being
+    # read, so they're only applied until the first line arrives
+    with nested(api.settings(output_prefix=False), api.show('stdout')):
+        thread.start()
+        first_line = lines.get()
+
+    return _iter_queued_lines(command, first_line, lines, writer, thread,
+                              result, api.env.warn_only, output.warnings,
+                              use_sudo)
+
+
+def _iter_queued_lines(command, first_line, lines, writer, thread, result,
+                       warn_only, show_warnings, use_sudo):
+    status = 0
+    exhausted = False
+
+    try:
+        line = first_line
+        while line is not _END_OF_STREAM:
+            if STREAM_STATUS_MARKER in line:
+                # The output may not end with a new line
+                line, _, status = line.rpartition(STREAM_STATUS_MARKER)
+                status = int(status)
+                if line:
+                    yield line
+            else:
+                yield line
+
+            line = lines.get()
+        exhausted = True
+    finally:
+        if not exhausted:
+            # Unblock the reading thread if the generator is closed early
+            writer.cancelled = True
+            while thread.is_alive():
+                try:
+                    lines.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    thread.join()
+
+    if 'exception' in result:
+        raise result['exception']
+
+    if status not in api.env.ok_ret_codes:
+        message = ("{function}() received nonzero return code {status} while"
+                   " executing '{command}'!".format(
+                       function='sudo' if use_sudo else 'run', status=status,
+                       command=command))
+        if not warn_only:
+            abort(message)
+        elif show_warnings:
+            warn(message)
+
+
+def iter_local_lines(command):
+    """
+    Run the given command locally and yield the lines of its output as they
+    arrive. Raises ``subprocess.CalledProcessError`` if the command fails.
+    """
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                               cwd=api.env.lcwd or None)
+
+    for line in iter(process.stdout.readline, b''):
+        yield line.rstrip(b'\n')
+
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
@@ -3,6 +3,8 @@ from contextlib import nested
 from fabric import api
 from fabric.context_managers import quiet
 
+from fabliip.utils import iter_local_lines
+
 
 def push_tag(tag, remote='origin'):
     """
@@ -94,3 +96,44 @@ def get_commit_messages(first_commit, last_commit):
         )
 
     return changes
+
+
+def get_changed_files(first_commit, last_commit, run_locally=True):
+    """
+    Return the list of the paths of the files that changed between
+    first_commit and last_commit.
+
+    Arguments:
+        first_commit -- The name of the first commit (tag, hash, etc)
+        last_commit -- The name of the last commit (tag, hash, etc)
+        run_locally -- Whether to use the local or the remote repository
+        (default True)
+    """
+    git_command = 'git diff --name-only {first_commit} {last_commit}'.format(
+        first_commit=first_commit,
+        last_commit=last_commit
+    )
+
+    with api.hide('commands'):
+        if run_locally:
+            changes = api.local(git_command, capture=True)
+        else:
+            with api.cd(api.env.repository_root):
+                changes = api.run(git_command)
+
+    return changes.splitlines()
+
+
+def iter_commit_messages(first_commit, last_commit):
+    """
+    Yield the commit messages between first_commit and last_commit in an
+    abbreviated form as git outputs them, without building the whole log in
+    memory.
+    """
+    return iter_local_lines(
+        'git log --reverse --oneline {first_commit}..{last_commit}'
+        .format(
+            first_commit=first_commit,
+            last_commit=last_commit
+        )
+    )
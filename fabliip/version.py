@@ -1,4 +1,3 @@
-from distutils.version import LooseVersion
 import glob
 import os
 
@@ -16,6 +15,8 @@ def get_version_files(from_version, to_version, directory):
     directory -- The path to the directory that holds the version files
     """
 
+    from distutils.version import LooseVersion
+
     files = []
 
     from_version = LooseVersion(from_version)
@@ -0,0 +1,177 @@
+import base64
+import json
+import os
+import re
+import shutil
+import stat
+import tempfile
+import unittest
+
+from fabric import api
+
+from fabliip.database import has_data, mysql, pgsql
+from fabliip.testing import LocalHost
+
+
+def sql_pattern(sql):
+    """
+    Return a pattern matching the commands piping SQL statements starting with
+    the given ones.
+    """
+    sql = sql[:len(sql) // 3 * 3].encode('utf-8')
+
+    return 'echo ' + base64.b64encode(sql).decode('ascii')
+
+
+class HasDataTestCase(unittest.TestCase):
+    def test_defaults(self):
+        self.assertTrue(has_data('node'))
+
+    def test_exclude_data(self):
+        self.assertFalse(has_data('cache_page', exclude_data=['cache_*']))
+        self.assertTrue(has_data('node', exclude_data=['cache_*']))
+
+    def test_include_data(self):
+        self.assertTrue(has_data('node', include_data=['node*']))
+        self.assertFalse(has_data('users', include_data=['node*']))
+
+    def test_exclude_data_takes_precedence(self):
+        self.assertFalse(has_data('node_revision', include_data=['node*'],
+                                  exclude_data=['node_revision']))
+
+    def test_patterns_are_case_sensitive(self):
+        self.assertTrue(has_data('Cache', exclude_data=['cache*']))
+
+
+class PgsqlCommandsTestCase(unittest.TestCase):
+    def run_dump(self, **kwargs):
+        with api.hide('everything'), LocalHost(dry_run=True) as host:
+            pgsql.dump('/backups/{date}.dump', 'site',
+                       exclude_data=['cache_{page}'], **kwargs)
+
+        return host.commands[0]['command']
+
+    def test_braces_in_arguments(self):
+        command = self.run_dump()
+
+        self.assertIn("--exclude-table-data='cache_{page}'", command)
+        self.assertIn('> /backups/{date}.dump', command)
+
+    def test_remote_connection(self):
+        command = self.run_dump(host='db.example.com', password='secret')
+
+        self.assertIn('pg_dump -Fc -U postgres -h db.example.com ', command)
+
+    def test_create_snapshot_blocks_connections(self):
+        with api.hide('everything'), LocalHost(dry_run=True) as host:
+            pgsql.create_snapshot('site', '20140830180015_1.2.3')
+
+        statements = [
+            base64.b64decode(re.match(r'echo (\S+)', command['command'])
+                             .group(1)).decode('utf-8')
+            for command in host.commands
+        ]
+
+        self.assertIn('ALLOW_CONNECTIONS false', statements[0])
+        self.assertIn('pg_terminate_backend', statements[0])
+        self.assertIn('TEMPLATE "site"', statements[1])
+        self.assertIn('ALLOW_CONNECTIONS true', statements[2])
+
+    def test_create_snapshot_allows_connections_on_failure(self):
+        responses = [(sql_pattern('CREATE DATABASE'), ('', 1))]
+
+        with api.hide('everything', 'aborts'), LocalHost(
+                dry_run=True, responses=responses) as host:
+            with self.assertRaises(SystemExit):
+                pgsql.create_snapshot('site', '20140830180015_1.2.3')
+
+        self.assertEqual(len(host.commands), 3)
+
+
+class MysqlSnapshotTestCase(unittest.TestCase):
+    def test_foreign_keys_are_recreated(self):
+        with api.hide('everything'), LocalHost(dry_run=True, responses=[
+            (sql_pattern('SELECT trigger_name'), ''),
+            ('base64 -d \\| mysql .* -N -B site$', 'node\nusers'),
+        ]) as host:
+            snapshot = mysql.create_snapshot('site', '20140830180015_1.2.3',
+                                             password='')
+
+        command = host.commands[-1]['command']
+        sql = base64.b64decode(re.match(r'echo (\S+)', command).group(1))
+
+        self.assertIn("--init-command='SET foreign_key_checks = 0' " + snapshot,
+                      command)
+        self.assertIn("'%s'" % snapshot, sql.decode('utf-8'))
+        self.assertIn('information_schema.referential_constraints',
+                      sql.decode('utf-8'))
+
+    def test_triggers_are_refused(self):
+        for function in (mysql.create_snapshot, mysql.restore_snapshot):
+            with api.hide('everything'), LocalHost(dry_run=True, responses=[
+                (sql_pattern('SELECT trigger_name'), 'node_insert'),
+            ]) as host:
+                with self.assertRaises(Exception) as context:
+                    function('site', '20140830180015_1.2.3', password='')
+
+            self.assertIn('node_insert', str(context.exception))
+            self.assertEqual(len(host.commands), 1)
+
+
+# Logs its invocation and fails after reading the start of the statements,
+# which breaks the pipe they're written to
+FAKE_MYSQL = """#!/bin/sh
+echo "$@" >> {log}
+head -c 100 > /dev/null
+exit 1
+"""
+
+
+class MysqlRestoreParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        self.backup_path = os.path.join(self.root, 'backup')
+        os.makedirs(self.backup_path)
+        tables = []
+
+        for name in ('node', 'users'):
+            with open(os.path.join(self.backup_path, name + '.sql'), 'w') as f:
+                f.write('CREATE TABLE `{name}` (\n  `id` int(11) NOT NULL\n'
+                        ');\n'.format(name=name))
+                for i in range(20000):
+                    f.write('INSERT INTO `{name}` VALUES ({i});\n'.format(
+                        name=name, i=i))
+
+            tables.append({'name': name, 'file': name + '.sql', 'data': True,
+                           'size': 1})
+
+        for name in ('header.sql', 'footer.sql'):
+            open(os.path.join(self.backup_path, name), 'w').close()
+
+        with open(os.path.join(self.backup_path, 'manifest.json'), 'w') as f:
+            json.dump({'database': 'site', 'tables': tables,
+                       'header': 'header.sql', 'footer': 'footer.sql'}, f)
+
+        self.bin_path = os.path.join(self.root, 'bin')
+        os.makedirs(self.bin_path)
+        self.log_path = os.path.join(self.root, 'mysql.log')
+        mysql_path = os.path.join(self.bin_path, 'mysql')
+        with open(mysql_path, 'w') as f:
+            f.write(FAKE_MYSQL.format(log=self.log_path))
+        os.chmod(mysql_path, stat.S_IRWXU)
+
+    def test_broken_pipe_fails_the_restore(self):
+        with api.hide('everything', 'aborts'), LocalHost(path=[self.bin_path]):
+            with self.assertRaises(SystemExit):
+                mysql.restore_parallel(self.backup_path, 'site', password='',
+                                       jobs=1)
+
+        # The worker carried on with the next table after the first failed
+        with open(self.log_path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
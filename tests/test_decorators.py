@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric import api
+
+from fabliip.decorators import execute_multisite
+from fabliip.testing import LocalHost
+
+
+SITES = {
+    'site_a': {'prod': {'project_root': '/srv/a',
+                        'repository_root': '/srv/shared.git'}},
+    'site_b': {'prod': {'project_root': '/srv/b',
+                        'repository_root': '/srv/shared.git'}},
+    'site_c': {'prod': {'project_root': '/srv/c',
+                        'repository_root': '/srv/c.git',
+                        'hosts': ['web1']}},
+    'site_d': {'staging': {'project_root': '/srv/d-staging'}},
+}
+
+
+def get_site_settings():
+    return api.env.site, api.env.project_root
+
+
+def fail_on_site_b():
+    if api.env.site == 'site_b':
+        raise Exception("Deployment of site_b failed")
+
+    return api.env.site
+
+
+class ExecuteMultisiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.log = os.path.join(self.root, 'shared.log')
+
+        settings = api.settings(api.hide('everything'), sites=SITES,
+                                hosts=['web1', 'web2'])
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def log_shared_work(self):
+        api.run('echo "{host} $(basename {repository})" >> {log}'.format(
+            host=api.env.host_string, repository=api.env.repository_root,
+            log=self.log))
+
+    def test_site_settings_are_isolated(self):
+        with LocalHost():
+            results = execute_multisite(get_site_settings, 'prod')
+
+        self.assertEqual(results, {
+            'site_a': {'web1': ('site_a', '/srv/a'),
+                       'web2': ('site_a', '/srv/a')},
+            'site_b': {'web1': ('site_b', '/srv/b'),
+                       'web2': ('site_b', '/srv/b')},
+            'site_c': {'web1': ('site_c', '/srv/c')},
+        })
+        self.assertNotIn('project_root', api.env)
+        self.assertNotIn('site', api.env)
+
+    def test_shared_task_runs_once_per_group(self):
+        with LocalHost():
+            execute_multisite(get_site_settings, 'prod',
+                              shared_task=self.log_shared_work)
+
+        with open(self.log) as f:
+            self.assertEqual(sorted(f.read().splitlines()), [
+                'web1 c.git',
+                'web1 shared.git',
+                'web2 shared.git',
+            ])
+
+    def test_abort_when_a_site_fails(self):
+        with LocalHost(), self.assertRaises(SystemExit):
+            execute_multisite(fail_on_site_b, 'prod', sites=['site_a',
+                                                             'site_b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
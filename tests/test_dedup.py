@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fabric import api
+
+from fabliip import dedup, preflight
+from fabliip.testing import LocalHost
+
+
+class DeduplicateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        for release in ('r1', 'r2'):
+            os.makedirs(os.path.join(self.root, release))
+            with open(os.path.join(self.root, release, 'index.php'), 'w') as f:
+                f.write('<?php echo "hello";\n')
+
+        settings = api.settings(api.hide('everything'), releases_root=self.root)
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def set_reflink_fact(self, reflink):
+        with api.settings(host_string='localhost'):
+            path = preflight.get_cache_path()
+
+        preflight._facts[path] = {'time': time.time(), 'reflink': reflink}
+        self.addCleanup(preflight._facts.pop, path, None)
+
+    def get_inodes(self):
+        return set(
+            os.stat(os.path.join(self.root, release, 'index.php')).st_ino
+            for release in ('r1', 'r2')
+        )
+
+    def test_skipped_without_reflinks(self):
+        self.set_reflink_fact(False)
+
+        with LocalHost() as host:
+            self.assertIsNone(dedup.deduplicate())
+
+        self.assertEqual(host.commands, [])
+        self.assertEqual(len(self.get_inodes()), 2)
+
+    def test_hardlink_mode_is_opt_in(self):
+        self.set_reflink_fact(False)
+
+        with api.settings(dedup_mode='hardlink'), LocalHost():
+            stats = dedup.deduplicate()
+
+        self.assertEqual(stats['linked'], 1)
+        self.assertEqual(len(self.get_inodes()), 1)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            dedup.deduplicate(mode='symlink')
@@ -0,0 +1,110 @@
+import json
+import unittest
+
+from fabric import api
+
+from fabliip import drupal
+from fabliip.testing import LocalHost
+
+
+class PlanCacheClearTestCase(unittest.TestCase):
+    def test_modules_changed(self):
+        self.assertEqual(drupal.plan_cache_clear([], modules_changed=True),
+                         set(['all']))
+
+    def test_no_changes(self):
+        self.assertEqual(drupal.plan_cache_clear([]), set())
+
+    def test_assets_only(self):
+        self.assertEqual(drupal.plan_cache_clear([
+            'sites/all/themes/site/logo.png',
+            'sites/all/themes/site/sass/main.scss',
+            'README.md',
+        ]), set())
+
+    def test_templates_clear_page_and_block_caches(self):
+        self.assertEqual(drupal.plan_cache_clear([
+            'sites/all/themes/site/templates/node.tpl.php',
+            'sites/all/themes/site/template.php',
+        ]), set(['theme-registry', 'page-block']))
+
+    def test_css_js_clear_page_and_block_caches(self):
+        self.assertEqual(drupal.plan_cache_clear([
+            'sites/all/themes/site/css/main.css',
+            'sites/all/themes/site/js/main.js',
+        ]), set(['css-js', 'page-block']))
+
+    def test_rules_are_combined(self):
+        self.assertEqual(drupal.plan_cache_clear([
+            'sites/all/modules/site/site.views_default.inc',
+            'sites/all/modules/site/site.features.menu_links.inc',
+        ]), set(['views', 'menu', 'page-block']))
+
+    def test_unknown_file_needs_full_clear(self):
+        self.assertEqual(drupal.plan_cache_clear([
+            'sites/all/themes/site/css/main.css',
+            'sites/all/modules/site/site.module',
+        ]), set(['all']))
+
+    def test_every_cache_can_be_cleared(self):
+        for pattern, caches in drupal.CACHE_INVALIDATION_RULES:
+            for cache in caches:
+                self.assertIn(cache, drupal.CACHE_CLEAR_OPERATIONS)
+
+
+class DrushSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        settings = api.settings(api.hide('everything'), drupal_root='/srv/www')
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def respond(self, *results):
+        return LocalHost(dry_run=True, responses=[('php-script', '\n'.join(
+            drupal.SESSION_RESULT_MARKER + json.dumps(result)
+            for result in results
+        ))])
+
+    def test_success(self):
+        with self.respond({'operation': 'clear_cache', 'success': True,
+                           'result': None}):
+            with drupal.DrushSession() as session:
+                session.clear_cache('menu')
+
+        self.assertEqual(len(session.results), 1)
+        self.assertEqual(session.operations, [])
+
+    def test_failed_operation_raises(self):
+        with self.respond({'operation': 'clear_cache', 'success': True,
+                           'result': None},
+                          {'operation': 'enable_modules', 'success': False,
+                           'result': 'Some dependencies are missing'}):
+            with self.assertRaises(Exception) as context:
+                with drupal.DrushSession() as session:
+                    session.clear_cache('menu')
+                    session.enable_modules(['views'])
+                    session.clear_cache('views')
+
+        self.assertIn('enable_modules', str(context.exception))
+        self.assertEqual(len(session.results), 2)
+
+    def test_clear_caches_reports_failures(self):
+        with self.respond({'operation': 'clear_cache', 'success': False,
+                           'result': 'Unknown cache'}):
+            with self.assertRaises(Exception) as context:
+                drupal.clear_caches(['menu'])
+
+        self.assertIn('Unknown cache', str(context.exception))
+
+    def test_interrupted_session_raises(self):
+        with self.respond({'operation': 'clear_cache', 'success': True,
+                           'result': None}):
+            with self.assertRaises(Exception) as context:
+                with drupal.DrushSession() as session:
+                    session.clear_cache('menu')
+                    session.clear_cache('views')
+
+        self.assertIn('1 of 2', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric import api
+
+from fabliip import fleet
+
+
+def echo(text):
+    output = yield fleet.run('echo {text}'.format(text=text))
+    raise fleet.Return(output)
+
+
+def echo_twice(text):
+    first = yield echo(text)
+    second = yield echo(first)
+    raise fleet.Return([first, second])
+
+
+def fail():
+    yield fleet.run('echo oops >&2; exit 3')
+
+
+class FailingRecordTransport(fleet.LocalTransport):
+    def record(self, host, command, return_code, duration):
+        if host == 'b':
+            raise IOError("Couldn't record the command")
+
+        super(FailingRecordTransport, self).record(host, command,
+                                                   return_code, duration)
+
+
+class FleetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.releases_root = os.path.join(self.root, 'releases')
+
+        for release in ('20140830151210_1.2.2', '20140830180015_1.2.3',
+                        '20140830190000_1.2.4_failed', 'Pr\xc3\xa4sentation'):
+            os.makedirs(os.path.join(self.releases_root, release))
+
+        settings = api.settings(releases_root=self.releases_root)
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+        self.transport = fleet.LocalTransport()
+
+    def get_fleet(self, hosts=('a', 'b'), **kwargs):
+        return fleet.Fleet(list(hosts), transport=self.transport, **kwargs)
+
+    def test_run(self):
+        results, failures = self.get_fleet().run(echo_twice, 'hello')
+
+        self.assertEqual(failures, {})
+        self.assertEqual(results, {'a': ['hello', 'hello'],
+                                   'b': ['hello', 'hello']})
+        self.assertEqual(len(self.transport.commands), 4)
+
+    def test_non_ascii_output(self):
+        results, failures = self.get_fleet().run(echo, 'caf\xc3\xa9')
+
+        self.assertEqual(failures, {})
+        self.assertEqual(results['a'], 'caf\xc3\xa9')
+
+    def test_get_releases(self):
+        results, failures = self.get_fleet().run(fleet.get_releases)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(results['a'], ['20140830151210_1.2.2',
+                                        '20140830180015_1.2.3',
+                                        'Pr\xc3\xa4sentation'])
+
+    def test_clean_old_releases(self):
+        results, failures = self.get_fleet(hosts=['a']).run(
+            fleet.clean_old_releases, keep=1)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(results['a'], ['20140830151210_1.2.2',
+                                        '20140830180015_1.2.3'])
+        self.assertEqual(sorted(os.listdir(self.releases_root)),
+                         ['20140830190000_1.2.4_failed', 'Pr\xc3\xa4sentation'])
+
+    def test_failed_command(self):
+        results, failures = self.get_fleet().run(fail)
+
+        self.assertEqual(results, {})
+        self.assertIsInstance(failures['a'], fleet.CommandFailed)
+        self.assertEqual(failures['a'].output.return_code, 3)
+        self.assertEqual(failures['a'].output.stderr, 'oops')
+
+    def test_errors_only_fail_their_job(self):
+        self.transport = FailingRecordTransport()
+        results, failures = self.get_fleet().run(echo, 'hello')
+
+        self.assertEqual(results, {'a': 'hello'})
+        self.assertIsInstance(failures['b'], IOError)
+
+    def test_concurrency_limits(self):
+        results, failures = self.get_fleet(
+            hosts=['host%d' % i for i in range(20)], concurrency=3, per_host=1
+        ).run(echo_twice, 'hello')
+
+        self.assertEqual(failures, {})
+        self.assertEqual(len(results), 20)
+
+    def test_concurrency_above_open_files_limit(self):
+        with self.assertRaises(ValueError):
+            self.get_fleet(concurrency=fleet.get_max_concurrency() + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fabric import api
+
+from fabliip import journal, signals
+from fabliip.testing import LocalHost
+
+
+executions = []
+failing_hosts = set()
+
+steps = []
+# Number of times each step fails before succeeding
+failures = {}
+
+
+@signals.register
+def step(name):
+    steps.append(name)
+
+    if failures.get(name):
+        failures[name] -= 1
+        raise Exception("Step {name} failed".format(name=name))
+
+    return name.upper()
+
+
+@signals.register
+def outer_step():
+    step('inner')
+
+    if failures.get('outer_step'):
+        failures['outer_step'] -= 1
+        raise Exception("Step outer_step failed")
+
+    step('outer')
+
+
+@api.task
+def deploy(version):
+    executions.append((api.env.host_string, version))
+
+    if api.env.host_string in failing_hosts:
+        raise Exception("Deployment failed")
+
+
+class ExecuteTestCase(unittest.TestCase):
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        settings = api.settings(
+            api.hide('everything'),
+            journal_state_file=os.path.join(path, 'state.json'),
+        )
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+        del executions[:]
+        failing_hosts.clear()
+
+    def execute(self, version, hosts=('a', 'b')):
+        del executions[:]
+        journal.execute(deploy, version, hosts=list(hosts))
+
+        return executions
+
+    def test_retries_failed_hosts_only(self):
+        failing_hosts.add('b')
+        with self.assertRaises(SystemExit):
+            self.execute('1.0')
+
+        failing_hosts.clear()
+        self.assertEqual(self.execute('1.0'), [('b', '1.0')])
+        self.assertEqual(self.execute('1.0'), [('a', '1.0'), ('b', '1.0')])
+
+    def test_other_arguments_run_on_all_hosts(self):
+        failing_hosts.add('b')
+        with self.assertRaises(SystemExit):
+            self.execute('1.0')
+
+        failing_hosts.clear()
+        self.assertEqual(self.execute('2.0'), [('a', '2.0'), ('b', '2.0')])
+
+    def test_reset_failed_hosts(self):
+        failing_hosts.add('b')
+        with self.assertRaises(SystemExit):
+            self.execute('1.0')
+
+        failing_hosts.clear()
+        journal.reset_failed_hosts(deploy)
+        self.assertEqual(self.execute('1.0'), [('a', '1.0'), ('b', '1.0')])
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.sleeps = []
+
+    def time(self):
+        return 0
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+
+
+class ResumeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        settings = api.settings(
+            api.hide('everything'),
+            releases_root=self.root,
+            release_name='20140830180015_1.0',
+            journal_retries=0,
+            journal_backoff=0,
+        )
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+        host = LocalHost()
+        host.__enter__()
+        self.addCleanup(host.__exit__, None, None, None)
+
+        self.time = FakeTime()
+        journal.time = self.time
+        self.addCleanup(setattr, journal, 'time', time)
+
+        del steps[:]
+        failures.clear()
+
+    def deploy(self, **kwargs):
+        del steps[:]
+
+        with journal.resume(**kwargs):
+            return [step('a'), step('b'), step('a')]
+
+    def test_completed_steps_are_skipped(self):
+        failures['b'] = 1
+        with self.assertRaises(Exception):
+            self.deploy()
+        self.assertEqual(steps, ['a', 'b'])
+
+        self.assertEqual(self.deploy(), ['A', 'B', 'A'])
+        self.assertEqual(steps, ['b', 'a'])
+
+        # The journal is removed once the deployment completed
+        self.assertEqual(self.deploy(), ['A', 'B', 'A'])
+        self.assertEqual(steps, ['a', 'b', 'a'])
+
+    def test_failed_step_is_retried_with_backoff(self):
+        failures['b'] = 2
+
+        self.assertEqual(self.deploy(retries=2, backoff=1), ['A', 'B', 'A'])
+        self.assertEqual(steps, ['a', 'b', 'b', 'b', 'a'])
+        self.assertEqual(self.time.sleeps, [1, 2])
+
+    def test_gives_up_after_retries(self):
+        failures['b'] = 3
+
+        with self.assertRaises(Exception):
+            self.deploy(retries=2)
+        self.assertEqual(steps, ['a', 'b', 'b', 'b'])
+
+    def test_retried_step_restarts_its_numbering(self):
+        failures['outer_step'] = 1
+
+        with journal.resume(retries=1):
+            outer_step()
+
+        # The inner step completed before the outer step failed, so it's
+        # skipped when the outer step is retried rather than run again as a
+        # second occurrence
+        self.assertEqual(steps, ['inner', 'outer'])
+
+
+if __name__ == '__main__':
+    unittest.main()
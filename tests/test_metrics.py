@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabliip import metrics, signals
+
+
+@signals.register
+def succeeding_step():
+    return 42
+
+
+@signals.register
+def failing_step():
+    raise ValueError("Step failed")
+
+
+@signals.register
+def outer_step():
+    succeeding_step()
+    failing_step()
+
+
+class AggregateTestCase(unittest.TestCase):
+    def test_counters_are_summed_by_labels(self):
+        series = metrics.aggregate([
+            {'type': 'counter', 'name': 'requests_total', 'value': 1,
+             'labels': {'result': 'hit'}},
+            {'type': 'counter', 'name': 'requests_total', 'value': 2,
+             'labels': {'result': 'hit'}},
+            {'type': 'counter', 'name': 'requests_total', 'value': 1,
+             'labels': {'result': 'miss'}},
+        ])
+
+        self.assertEqual(series[('requests_total', (('result', 'hit'),))],
+                         {'type': 'counter', 'value': 3})
+        self.assertEqual(series[('requests_total', (('result', 'miss'),))],
+                         {'type': 'counter', 'value': 1})
+
+    def test_histogram_buckets(self):
+        series = metrics.aggregate([
+            {'type': 'histogram', 'name': 'step_seconds', 'value': value,
+             'labels': {}}
+            for value in (0.05, 3, 4000)
+        ])
+        histogram = series[('step_seconds', ())]
+
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['sum'], 4003.05)
+        self.assertEqual(histogram['buckets'][0], 1)
+        self.assertEqual(histogram['buckets'][-1], 2)
+        self.assertEqual(len(histogram['buckets']),
+                         len(metrics.DURATION_BUCKETS))
+
+    def test_size_buckets(self):
+        self.assertEqual(metrics.get_buckets('dump_size_bytes'),
+                         metrics.SIZE_BUCKETS)
+
+
+class FormatPrometheusTestCase(unittest.TestCase):
+    def test_format(self):
+        series = metrics.aggregate([
+            {'type': 'counter', 'name': 'requests_total', 'value': 2,
+             'labels': {'host': 'web"1'}},
+            {'type': 'histogram', 'name': 'step_seconds', 'value': 1,
+             'labels': {'step': 'deploy'}},
+        ])
+        lines = metrics.format_prometheus(series).splitlines()
+
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{host="web\\"1"} 2', lines)
+        self.assertIn('# TYPE step_seconds histogram', lines)
+        self.assertIn('step_seconds_bucket{step="deploy",le="0.5"} 0', lines)
+        self.assertIn('step_seconds_bucket{step="deploy",le="1"} 1', lines)
+        self.assertIn('step_seconds_bucket{step="deploy",le="+Inf"} 1', lines)
+        self.assertIn('step_seconds_sum{step="deploy"} 1', lines)
+        self.assertIn('step_seconds_count{step="deploy"} 1', lines)
+
+
+class CollectTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        metrics.enable(self.path)
+        self.addCleanup(metrics.write)
+
+    def get_series(self):
+        metrics.write()
+
+        with open(os.path.join(self.path, metrics.JSON_FILE)) as f:
+            return dict(
+                ((entry['name'], entry['labels'].get('step'),
+                  entry['labels'].get('status')), entry)
+                for entry in (json.loads(line) for line in f)
+            )
+
+    def test_step_durations(self):
+        self.assertEqual(succeeding_step(), 42)
+        series = self.get_series()
+
+        step = series[('fabliip_step_duration_seconds',
+                       __name__ + '.succeeding_step', 'success')]
+        self.assertEqual(step['count'], 1)
+        self.assertEqual(
+            series[('fabliip_run_success', None, None)]['value'], 1)
+
+    def test_failed_steps(self):
+        with self.assertRaises(ValueError):
+            outer_step()
+        series = self.get_series()
+
+        for name, status in (('succeeding_step', 'success'),
+                             ('failing_step', 'failure'),
+                             ('outer_step', 'failure')):
+            self.assertEqual(series[('fabliip_step_duration_seconds',
+                                     __name__ + '.' + name, status)]['count'],
+                             1)
+        self.assertEqual(
+            series[('fabliip_run_success', None, None)]['value'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
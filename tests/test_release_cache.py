@@ -0,0 +1,155 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from fabric import api
+
+from fabliip import release_cache, releases
+from fabliip.testing import LocalHost
+
+
+TAGS = ['1.0.0', '1.0.1', '1.0.2']
+
+
+def git(path, *args):
+    return subprocess.check_output(['git', '-C', path] + list(args)).strip()
+
+
+class ReleaseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        # A bare repository with a commit per tag, the same way as the
+        # lifecycle benchmark sets it up
+        source = os.path.join(self.root, 'source')
+        os.makedirs(source)
+        git(source, 'init', '-q')
+        git(source, 'config', 'user.email', 'test@example.com')
+        git(source, 'config', 'user.name', 'Test')
+
+        for tag in TAGS:
+            with open(os.path.join(source, 'index.php'), 'w') as f:
+                f.write('<?php echo "{tag}";\n'.format(tag=tag))
+            git(source, 'add', '-A')
+            git(source, 'commit', '-q', '-m', 'Release %s' % tag)
+            git(source, 'tag', tag)
+
+        repository_root = os.path.join(self.root, 'repository.git')
+        subprocess.check_call(['git', 'clone', '-q', '--bare', source,
+                               repository_root])
+        self.commits = dict(
+            (tag, git(repository_root, 'rev-parse', tag + '^{commit}')
+             .decode('ascii'))
+            for tag in TAGS
+        )
+
+        self.releases_root = os.path.join(self.root, 'releases')
+        self.cache_root = os.path.join(self.root, 'release_cache')
+        os.makedirs(self.releases_root)
+
+        settings = api.settings(
+            api.hide('everything'),
+            releases_root=self.releases_root,
+            repository_root=repository_root,
+            release_cache_root=self.cache_root,
+            release_cache_size=1,
+        )
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+        host = LocalHost()
+        host.__enter__()
+        self.addCleanup(host.__exit__, None, None, None)
+
+    def create_release(self, tag, index):
+        release_name = '2014083018{index:04d}_{tag}'.format(index=index,
+                                                             tag=tag)
+        releases.create_release(tag, release_name)
+
+        return os.path.join(self.releases_root, release_name)
+
+    def read(self, *path):
+        with open(os.path.join(*path)) as f:
+            return f.read()
+
+    def get_cached_commits(self):
+        return sorted(os.listdir(self.cache_root))
+
+    def age_cache(self):
+        # Prune evicts the least recently used trees, make the order of the
+        # cached trees explicit rather than depending on the mtime resolution
+        for age, tag in enumerate(reversed(TAGS)):
+            path = os.path.join(self.cache_root, self.commits[tag])
+            if os.path.exists(path):
+                mtime = time.time() - 60 * (age + 1)
+                os.utime(path, (mtime, mtime))
+
+    def test_miss_then_hit(self):
+        first = release_cache.materialize(
+            '1.0.0', os.path.join(self.releases_root, 'r1'))
+        second = release_cache.materialize(
+            '1.0.0', os.path.join(self.releases_root, 'r2'))
+
+        self.assertEqual(first, {'commit': self.commits['1.0.0'],
+                                 'hit': False})
+        self.assertEqual(second, {'commit': self.commits['1.0.0'],
+                                  'hit': True})
+
+        for release in ('r1', 'r2'):
+            self.assertEqual(self.read(self.releases_root, release,
+                                       'index.php'), '<?php echo "1.0.0";\n')
+            self.assertEqual(self.read(self.releases_root, release,
+                                       release_cache.REVISION_FILE).strip(),
+                             self.commits['1.0.0'])
+
+    def test_create_release_uses_cache(self):
+        self.create_release('1.0.1', 0)
+        release_path = self.create_release('1.0.1', 1)
+
+        self.assertEqual(self.read(release_path, 'index.php'),
+                         '<?php echo "1.0.1";\n')
+        self.assertEqual(self.get_cached_commits(), [self.commits['1.0.1']])
+
+    def test_prune_keeps_released_trees(self):
+        release_paths = [self.create_release(tag, index)
+                         for index, tag in enumerate(TAGS)]
+        self.age_cache()
+
+        self.assertEqual(release_cache.prune(), [])
+        self.assertEqual(len(self.get_cached_commits()), 3)
+
+        shutil.rmtree(release_paths[0])
+
+        self.assertEqual(release_cache.prune(), [self.commits['1.0.0']])
+        self.assertEqual(self.get_cached_commits(), sorted(
+            [self.commits['1.0.1'], self.commits['1.0.2']]))
+
+    def test_prune_keeps_most_recent_trees(self):
+        for tag in TAGS:
+            release_path = os.path.join(self.root, 'tmp')
+            release_cache.materialize(tag, release_path)
+            shutil.rmtree(release_path)
+        self.age_cache()
+
+        self.assertEqual(sorted(release_cache.prune(size=2)),
+                         [self.commits['1.0.0']])
+        self.assertEqual(self.get_cached_commits(), sorted(
+            [self.commits['1.0.1'], self.commits['1.0.2']]))
+
+    def test_clean_old_releases_prunes_cache(self):
+        for index, tag in enumerate(TAGS):
+            self.create_release(tag, index)
+        self.age_cache()
+
+        self.assertTrue(releases.clean_old_releases(keep=1))
+
+        self.assertEqual(len(os.listdir(self.releases_root)), 1)
+        self.assertEqual(self.get_cached_commits(), [self.commits['1.0.2']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fabric import api
+
+from fabliip import releases
+from fabliip.testing import LocalHost
+
+
+class WarmReleaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'releases', 'r1', 'web'))
+        os.makedirs(os.path.join(self.root, 'releases', 'r2'))
+
+        settings = api.settings(
+            api.hide('everything'),
+            project_root=self.root,
+            releases_root=os.path.join(self.root, 'releases'),
+        )
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def warm(self, commands, timeout=5):
+        with api.settings(warm_commands=commands), LocalHost():
+            return releases.warm_release('r1', timeout=timeout)
+
+    def test_time_budget_covers_whole_steps(self):
+        start = time.time()
+
+        with self.assertRaises(SystemExit):
+            self.warm(['true && sleep 3'], timeout=1)
+
+        self.assertLess(time.time() - start, 2.5)
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.root, 'new_current')))
+
+    def test_shell_steps(self):
+        self.warm([
+            'cd web && test -d ../web',
+            'FOO=1 env | grep -q FOO',
+            'test "$(basename "$(pwd)")" = r1',
+        ])
+
+        self.assertEqual(
+            os.readlink(os.path.join(self.root, 'new_current')),
+            os.path.join(self.root, 'releases', 'r1')
+        )
+
+    def test_failing_step_stops_the_warm_up(self):
+        marker = os.path.join(self.root, 'marker')
+
+        with self.assertRaises(SystemExit):
+            self.warm(['true', 'false', 'touch %s' % marker])
+
+        self.assertFalse(os.path.exists(marker))
+
+    def test_activate_after_warm_up(self):
+        self.warm(['true'])
+
+        with LocalHost():
+            releases.activate_release('r2')
+
+        self.assertEqual(os.readlink(os.path.join(self.root, 'current')),
+                         os.path.join(self.root, 'releases', 'r2'))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'releases', 'r1')),
+                         ['web'])
+
+
+class LinkSharedFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'releases', 'r1'))
+        os.makedirs(os.path.join(self.root, 'shared', 'media'))
+
+        settings = api.settings(
+            api.hide('everything'),
+            releases_root=os.path.join(self.root, 'releases'),
+            shared_root=os.path.join(self.root, 'shared'),
+            shared_files={'media': 'media'},
+        )
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def test_can_be_run_again(self):
+        with LocalHost():
+            releases.link_shared_files('r1')
+            releases.link_shared_files('r1')
+
+        self.assertEqual(
+            os.readlink(os.path.join(self.root, 'releases', 'r1', 'media')),
+            os.path.join(self.root, 'shared', 'media')
+        )
+        self.assertEqual(os.listdir(os.path.join(self.root, 'shared',
+                                                 'media')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
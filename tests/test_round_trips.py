@@ -0,0 +1,86 @@
+"""
+Round-trip budgets of the deployment steps. The commands are recorded without
+being executed (see :py:func:`fabliip.testing.assert_round_trips`), so a step
+issuing more commands than its budget fails the test.
+"""
+import unittest
+
+from fabric import api
+
+from fabliip import drupal, releases
+from fabliip.testing import assert_round_trips
+
+
+RELEASE_NAME = '20140830180015_1.2.3'
+
+MODULES_RESPONSES = [
+    ('cat modules.enabled', 'views\nctools'),
+    ('cat modules.disabled', 'overlay'),
+    ('--status=enabled', 'overlay\nnode'),
+    ('not installed', 'views\nctools'),
+    ('php-script', '\n'.join(
+        'FABLIIP_RESULT {"operation": "%s", "success": true, "result": null}'
+        % operation
+        for operation in ('enable_modules', 'disable_modules', 'clear_cache')
+    )),
+]
+
+
+class RoundTripsTestCase(unittest.TestCase):
+    def setUp(self):
+        settings = api.settings(
+            api.hide('everything'),
+            project_root='/srv/site',
+            releases_root='/srv/site/releases',
+            repository_root='/srv/site/repository.git',
+            shared_root='/srv/site/shared',
+            drupal_root='/srv/site/current',
+            shared_files={'config.yml': 'config.yml', 'media': 'media'},
+            release_name=RELEASE_NAME,
+        )
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+    def test_create_release(self):
+        with assert_round_trips(4, responses=[('mktemp', '/tmp/release')]):
+            releases.create_release('1.2.3')
+
+    def test_link_shared_files(self):
+        with assert_round_trips(len(api.env.shared_files)):
+            releases.link_shared_files()
+
+    def test_activate_release(self):
+        with assert_round_trips(2):
+            releases.activate_release()
+
+    def test_clean_old_releases(self):
+        listing = '\n'.join('2014083018000%d_1.0.%d' % (i, i) for i in range(5))
+
+        # One listing and one removal per old release
+        with assert_round_trips(4, responses=[('for i in', listing)]):
+            releases.clean_old_releases(keep=2)
+
+    def test_rollback(self):
+        with assert_round_trips(1, responses=[
+            ('readlink', RELEASE_NAME + ' 20140830170000_1.2.2'),
+        ]):
+            result = releases.rollback()
+
+        self.assertEqual(result['to'], '20140830170000_1.2.2')
+
+    def test_enable_disable_modules(self):
+        with assert_round_trips(5, responses=MODULES_RESPONSES):
+            self.assertTrue(drupal.enable_disable_modules())
+
+    def test_enable_disable_modules_unchanged(self):
+        responses = MODULES_RESPONSES[:2] + [
+            ('--status=enabled', 'views\nctools'),
+            ('not installed', 'overlay'),
+        ]
+
+        with assert_round_trips(4, responses=responses):
+            self.assertFalse(drupal.enable_disable_modules())
+
+
+if __name__ == '__main__':
+    unittest.main()
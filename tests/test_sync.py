@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric import api
+
+from fabliip import sync
+from fabliip.testing import LocalHost
+
+
+FILENAME = u'Pr\xe4sentation.pdf'
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.source = os.path.join(self.root, 'source')
+        self.target = os.path.join(self.root, 'target')
+
+        os.makedirs(os.path.join(self.source, 'media'))
+        for path, content in ((FILENAME, 'slides'),
+                              (os.path.join('media', 'logo.png'), 'logo')):
+            with open(os.path.join(self.source, path).encode('utf-8'),
+                      'w') as f:
+                f.write(content)
+
+    def get_remote_manifest(self, path):
+        with api.hide('everything'), LocalHost():
+            return sync.get_manifest('localhost:' + path)
+
+    def test_manifests_have_the_same_keys(self):
+        local_manifest = sync.get_manifest(self.source)
+        remote_manifest = self.get_remote_manifest(self.source)
+
+        self.assertEqual(local_manifest, remote_manifest)
+        self.assertIn(FILENAME, remote_manifest)
+        self.assertEqual(sync.diff_manifests(local_manifest, remote_manifest),
+                         ([], []))
+
+    def test_transfer_files_of_remote_manifest(self):
+        files, deleted = sync.diff_manifests(
+            self.get_remote_manifest(self.source), {})
+
+        self.assertEqual(deleted, [])
+        sync.transfer(self.source, self.target, files)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.target, FILENAME).encode('utf-8')))
+
+        sync.delete(self.target, [FILENAME])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.target, FILENAME).encode('utf-8')))
+
+    def test_sync(self):
+        with open(os.path.join(self.source, 'media', 'new.txt'), 'w') as f:
+            f.write('new')
+        os.makedirs(self.target)
+        with open(os.path.join(self.target, 'old.txt'), 'w') as f:
+            f.write('old')
+
+        results = sync.sync(self.source, [self.target], workers=2,
+                            delete_missing=True)
+
+        self.assertEqual(sorted(results[self.target]['transferred']),
+                         sorted([FILENAME, os.path.join('media', 'logo.png'),
+                                 os.path.join('media', 'new.txt')]))
+        self.assertEqual(results[self.target]['deleted'], ['old.txt'])
+        self.assertEqual(sync.diff_manifests(sync.get_manifest(self.source),
+                                             sync.get_manifest(self.target)),
+                         ([], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
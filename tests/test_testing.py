@@ -0,0 +1,34 @@
+import unittest
+
+from fabric import api
+
+from fabliip.testing import LocalHost
+
+
+class LocalHostTestCase(unittest.TestCase):
+    def run_command(self, command):
+        with api.hide('everything'), LocalHost():
+            return api.run(command)
+
+    def test_commands_are_wrapped_like_fabric(self):
+        output = self.run_command('echo hello')
+
+        self.assertEqual(output, 'hello')
+        self.assertEqual(output.real_command, '/bin/bash -c "echo hello"')
+
+    def test_quoting(self):
+        self.assertEqual(
+            self.run_command('words="a b"; echo "$words" `echo c` $(echo d)'),
+            'a b c d'
+        )
+        self.assertEqual(self.run_command("echo '\"quoted\"'"), '"quoted"')
+
+    def test_cd_and_shell_env(self):
+        with api.hide('everything'), LocalHost(), api.cd('/tmp'), \
+                api.shell_env(GREETING='hello world'):
+            self.assertEqual(api.run('echo "$GREETING from $(pwd)"'),
+                             'hello world from /tmp')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+from datetime import datetime
+import random
+import unittest
+
+from fabliip.timeline import ReleaseTimeline, get_version_key
+
+
+RELEASES = [
+    '20140830151210_1.2.2',
+    '20140830180015_1.2.3',
+    '20140901100000_3.2.1',
+    '20140902100000_3.2.10',
+    '20140903100000_3.3.0',
+    '20140904100000_3.2.2-hotfix',
+    '20140905100000_3.20',
+]
+
+
+class ReleaseTimelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.timeline = ReleaseTimeline(RELEASES + ['not_a_release'])
+
+    def test_releases_are_sorted_by_date(self):
+        self.assertEqual(list(self.timeline), RELEASES)
+        self.assertEqual(self.timeline[-1], '20140905100000_3.20')
+        self.assertNotIn('not_a_release', self.timeline)
+
+    def test_at(self):
+        self.assertEqual(self.timeline.at(datetime(2014, 8, 30, 17, 0)),
+                         '20140830151210_1.2.2')
+        self.assertEqual(self.timeline.at('20140830180015'),
+                         '20140830180015_1.2.3')
+        self.assertIsNone(self.timeline.at(20140830151209))
+
+    def test_between(self):
+        self.assertEqual(
+            self.timeline.between('20140901000000', '20140903100000'),
+            RELEASES[2:5]
+        )
+
+    def test_versions(self):
+        self.assertEqual(self.timeline.in_version_range('3.2', '3.3'), [
+            '20140901100000_3.2.1',
+            '20140904100000_3.2.2-hotfix',
+            '20140902100000_3.2.10',
+        ])
+        self.assertEqual(self.timeline.latest('3.2'),
+                         '20140904100000_3.2.2-hotfix')
+        self.assertEqual(self.timeline.latest('3'), '20140905100000_3.20')
+        self.assertIsNone(self.timeline.latest('4'))
+
+    def test_version_key(self):
+        self.assertLess(get_version_key('1.9'), get_version_key('1.10'))
+        self.assertLess(get_version_key('1.2'), get_version_key('1.2.1'))
+
+    def test_positions(self):
+        self.assertEqual(self.timeline.before('20140903100000_3.3.0', 2),
+                         RELEASES[2:4])
+        self.assertEqual(self.timeline.after('20140830151210_1.2.2'),
+                         RELEASES[1:2])
+        self.assertEqual(self.timeline.before(RELEASES[0]), [])
+
+        with self.assertRaises(ValueError):
+            self.timeline.index('20140830151210_9.9.9')
+
+    def test_add_remove(self):
+        self.assertTrue(self.timeline.remove('20140904100000_3.2.2-hotfix'))
+        self.assertFalse(self.timeline.remove('20140904100000_3.2.2-hotfix'))
+        self.assertEqual(self.timeline.latest('3.2'), '20140902100000_3.2.10')
+
+        self.assertTrue(self.timeline.add('20140906100000_3.2.3'))
+        self.assertFalse(self.timeline.add('20140906100000_3.2.3'))
+        self.assertEqual(self.timeline.latest('3.2'), '20140906100000_3.2.3')
+        self.assertEqual(self.timeline.index('20140906100000_3.2.3'), 6)
+
+    def test_incremental_updates(self):
+        rng = random.Random(1)
+        pool = ['2014%02d%02d%02d0000_%d.%d' % (
+            rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+            rng.randint(0, 3), rng.randint(0, 12)
+        ) for i in range(200)]
+        timeline = ReleaseTimeline(pool[:50])
+        current = set(pool[:50])
+
+        for i in range(1000):
+            name = rng.choice(pool)
+            if name in current:
+                timeline.remove(name)
+                current.discard(name)
+            else:
+                timeline.add(name)
+                current.add(name)
+
+            if i % 100 == 0:
+                current = set(rng.sample(pool, 100))
+                timeline.update(current)
+
+        self.assertEqual(list(timeline), sorted(current))
+        self.assertEqual(timeline.at(20140615000000),
+                         max(name for name in current
+                             if name < '20140615000000_'))
+
+
+if __name__ == '__main__':
+    unittest.main()
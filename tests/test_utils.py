@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fabric import api
+from fabric.state import output
+
+from fabliip import file, utils
+from fabliip.testing import LocalHost
+
+
+class IterRunLinesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        settings = api.settings(api.hide('everything'))
+        settings.__enter__()
+        self.addCleanup(settings.__exit__, None, None, None)
+
+        host = LocalHost()
+        host.__enter__()
+        self.addCleanup(host.__exit__, None, None, None)
+
+    def test_lines(self):
+        self.assertEqual(list(utils.iter_run_lines('echo a; echo; printf b')),
+                         ['a', '', 'b'])
+
+    def test_settings_are_read_when_starting(self):
+        with api.cd(self.root):
+            lines = utils.iter_run_lines('pwd; sleep 0.2; pwd')
+
+        with api.cd('/'):
+            self.assertEqual(list(lines), [os.path.realpath(self.root)] * 2)
+
+    def test_global_settings_are_left_unchanged(self):
+        lines = utils.iter_run_lines('echo a; sleep 0.2; echo b')
+
+        self.assertEqual(next(lines), 'a')
+        self.assertTrue(api.env.output_prefix)
+        self.assertFalse(output.stdout)
+        self.assertEqual(list(lines), ['b'])
+
+    def test_failure_aborts(self):
+        lines = utils.iter_run_lines('echo a; exit 3')
+
+        with api.hide('aborts'), self.assertRaises(SystemExit):
+            list(lines)
+
+    def test_warn_only_when_starting(self):
+        with api.settings(warn_only=True):
+            lines = utils.iter_run_lines('echo a; false')
+
+        self.assertEqual(list(lines), ['a'])
+
+    def test_closed_early(self):
+        lines = utils.iter_run_lines('seq 10000', buffer_lines=10)
+
+        self.assertEqual(next(lines), '1')
+        lines.close()
+
+    def test_iter_ls(self):
+        for name in ('a', 'b'):
+            open(os.path.join(self.root, name), 'w').close()
+
+        names = file.iter_ls(self.root)
+
+        with api.cd('/'):
+            self.assertEqual(sorted(names), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()